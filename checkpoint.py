@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Checkpoint:
+----------
+
+Durable journal of the (country, endpoint) pairs whose data was fetched, processed and published in a run, with the
+files they were saved to in the temporary folder, so that an interrupted run can be resumed where it stopped
+without downloading the data again.
+
+"""
+import json
+import logging
+import os
+import threading
+from os.path import exists, join
+from shutil import rmtree
+
+import pandas as pd
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.data.showcase import Showcase
+
+logger = logging.getLogger(__name__)
+
+class Checkpoint(object):
+    """
+    Records are appended to a JSON lines journal and synced to disk one by one, so that a run killed at any point
+    leaves at most a partial last line, which is ignored. Fetched data is pickled to folder and processed data is
+    recorded with the metadata of its dataset and showcase and the csv files of its resources. When resuming, the
+    latest record of each pair whose files still exist is used.
+    """
+
+    def __init__(self, path, folder, resume=False):
+        self.path = path
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.records = dict()
+        self.names = dict()
+        if resume and exists(path):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning('Ignoring incomplete line in checkpoint %s' % path)
+                        continue
+                    self.add(record)
+            logger.info('Resuming from checkpoint %s with %d country endpoints' % (path, len(self.records)))
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(join(folder, 'checkpoint'), exist_ok=True)
+        self.file = open(path, 'a' if resume else 'w')
+        if self.file.tell() > 0:
+            self.file.write('\n')  # ends a partial last line so that it stays separate from new records
+
+    def add(self, record):
+        key = (record['country'], record['endpoint'])
+        self.records.setdefault(key, list()).append(record)
+        if record.get('name'):
+            self.names[record['name']] = key
+
+    def write(self, record):
+        line = '%s\n' % json.dumps(record, sort_keys=True, default=str)
+        with self.lock:
+            self.add(record)
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def get(self, countryiso2, endpoint):
+        """
+        Get the latest record of a country endpoint whose files still exist
+        :param countryiso2: country ISO2
+        :param endpoint: endpoint
+        :return: record or None if there is nothing to resume from
+        """
+        with self.lock:
+            records = list(self.records.get((countryiso2, endpoint), list()))
+        for record in reversed(records):
+            if all(exists(path) for path in record['files']):
+                return record
+            logger.warning('Files of %s checkpoint of %s %s are missing' % (record['stage'], countryiso2, endpoint))
+        return None
+
+    def pending(self, countriesdata, endpoints):
+        """
+        Get the countries with an endpoint whose data still has to be fetched
+        :param countriesdata: list of country datastructures from UNESCO API
+        :param endpoints: endpoints
+        :return: list of country datastructures
+        """
+        return [countrydata for countrydata in countriesdata
+                if any(self.get(countrydata['id'], endpoint) is None for endpoint in endpoints)]
+
+    def fetched(self, countryiso2, endpoint, structure_name, time_periods, df):
+        """
+        Save the data downloaded for a country endpoint and record it
+        :param countryiso2: country ISO2
+        :param endpoint: endpoint
+        :param structure_name: name of the endpoint's structure
+        :param time_periods: dictionary of years -> number of observations
+        :param df: DataFrame or None if there is no data
+        :return: None
+        """
+        files = list()
+        if df is not None:
+            path = join(self.folder, 'checkpoint', '%s_%s.pkl' % (countryiso2, endpoint))
+            df.to_pickle(path)
+            files.append(path)
+        self.write({'stage': 'fetched', 'country': countryiso2, 'endpoint': endpoint,
+                    'structure_name': structure_name, 'time_periods': time_periods, 'files': files})
+
+    @staticmethod
+    def load_fetched(record):
+        """
+        Load the data of a fetched record
+        :param record: record returned by get
+        :return: (structure name, time periods, DataFrame or None)
+        """
+        time_periods = {int(year): count for year, count in record['time_periods'].items()}
+        df = pd.read_pickle(record['files'][0]) if record['files'] else None
+        return record['structure_name'], time_periods, df
+
+    def processed(self, countryiso2, endpoint, dataset, showcase):
+        """
+        Record the dataset and showcase generated for a country endpoint, with the csv files of its resources
+        :param countryiso2: country ISO2
+        :param endpoint: endpoint
+        :param dataset: Dataset
+        :param showcase: Showcase
+        :return: None
+        """
+        resources = [(resource.data, resource.get_file_to_upload()) for resource in dataset.get_resources()]
+        self.write({'stage': 'processed', 'country': countryiso2, 'endpoint': endpoint, 'name': dataset['name'],
+                    'dataset': dataset.data, 'showcase': showcase.data, 'resources': resources,
+                    'files': [path for _, path in resources if path]})
+
+    @staticmethod
+    def load_processed(record):
+        """
+        Create the dataset and showcase of a processed record
+        :param record: record returned by get
+        :return: (Dataset, Showcase)
+        """
+        dataset = Dataset(record['dataset'])
+        for data, path in record['resources']:
+            resource = Resource(data)
+            if path:
+                resource.set_file_to_upload(path)
+            dataset.add_update_resource(resource)
+        return dataset, Showcase(record['showcase'])
+
+    def published(self, name):
+        """
+        Record that a dataset was published (or found unchanged)
+        :param name: name of the dataset
+        :return: None
+        """
+        with self.lock:
+            key = self.names.get(name)
+        if key is None:
+            return
+        self.write({'stage': 'published', 'country': key[0], 'endpoint': key[1], 'name': name, 'files': list()})
+
+    def finish(self):
+        """
+        Remove the journal and the temporary folder after a complete run
+        :return: None
+        """
+        self.file.close()
+        os.remove(self.path)
+        rmtree(self.folder, ignore_errors=True)
+
+
+def get_checkpoint(configuration, folder, resume=False):
+    """
+    Open the checkpoint journal named in the configuration
+    :param configuration: project configuration
+    :param folder: temporary folder, which must not be deleted if the run fails
+    :param resume: if true, resume from the journal of the last run, otherwise start a new one
+    :return: Checkpoint or None if no checkpoint is configured
+    """
+    path = configuration.get('checkpoint')
+    if not path:
+        if resume:
+            raise ValueError('Cannot resume without a checkpoint in the configuration!')
+        return None
+    return Checkpoint(os.path.expanduser(path), folder, resume)
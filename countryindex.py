@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Country index:
+-------------
+
+Persisted resolution of the entries of the UNESCO area codelist (CL_AREA) to country ISO3 codes, so that aggregates
+are recognised and names without an ISO2 match are fuzzy matched once rather than in every run. An overrides file
+fixes the resolution of entries by hand.
+
+"""
+import json
+import logging
+import os
+import threading
+from os.path import dirname, exists, expanduser
+from tempfile import mkstemp
+
+from hdx.location.country import Country
+from hdx.utilities.loader import LoadError, load_yaml
+
+logger = logging.getLogger(__name__)
+
+
+def is_aggregate(countryname):
+    """
+    Whether a CL_AREA entry is a regional or other aggregate rather than a country
+    :param countryname: name of the entry
+    :return: True for aggregates
+    """
+    return countryname[:4] in ['WB: ', 'SDG:', 'MDG:', 'UIS:', 'EFA:'] or countryname[:5] in ['GEMR:', 'AIMS:'] or \
+        countryname[:7] in ['UNICEF:', 'UNESCO:']
+
+
+def resolve_country(countryiso2, countryname):
+    """
+    Resolve a CL_AREA entry: aggregates are ignored, then the ISO2 code is looked up and failing that the name is
+    fuzzy matched
+    :param countryiso2: code of the entry
+    :param countryname: name of the entry
+    :return: dictionary with name, iso3 (None if it has none), aggregate and match ('iso2', 'fuzzy' or None)
+    """
+    if is_aggregate(countryname):
+        return {'name': countryname, 'iso3': None, 'aggregate': True, 'match': None}
+    countryiso3 = Country.get_iso3_from_iso2(countryiso2)
+    match = 'iso2'
+    if countryiso3 is None:
+        countryiso3, _ = Country.get_iso3_country_code_fuzzy(countryname)
+        match = 'fuzzy' if countryiso3 is not None else None
+    return {'name': countryname, 'iso3': countryiso3, 'aggregate': False, 'match': match}
+
+
+class CountryIndex(object):
+    """
+    Resolutions of CL_AREA entries by ISO2 code, loaded from and saved to a JSON file. An entry is resolved again
+    if its name in the codelist changes. Overrides map ISO2 codes to the ISO3 code to use, or to None to ignore the
+    entry as an aggregate, and take precedence over the resolutions without being saved with them.
+    """
+
+    def __init__(self, path=None, overrides=None):
+        self.path = path
+        self.overrides = dict(overrides or dict())
+        self.lock = threading.Lock()
+        self.entries = dict()
+        if path and exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def resolve(self, countryiso2, countryname):
+        """
+        Resolve a CL_AREA entry from the index, resolving it and adding it to the index if it is missing or its
+        name changed
+        :param countryiso2: code of the entry
+        :param countryname: name of the entry
+        :return: dictionary with name, iso3, aggregate and match ('iso2', 'fuzzy', 'override' or None)
+        """
+        if countryiso2 in self.overrides:
+            countryiso3 = self.overrides[countryiso2]
+            return {'name': countryname, 'iso3': countryiso3, 'aggregate': countryiso3 is None, 'match': 'override'}
+        with self.lock:
+            entry = self.entries.get(countryiso2)
+        if entry is None or entry['name'] != countryname:
+            entry = resolve_country(countryiso2, countryname)
+            with self.lock:
+                self.entries[countryiso2] = entry
+        return entry
+
+    def update(self, countriesdata):
+        """
+        Resolve the entries of the codelist and save the index if any were added or changed
+        :param countriesdata: items of the CL_AREA codelist
+        :return: number of entries resolved
+        """
+        with self.lock:
+            before = dict(self.entries)
+        for countrydata in countriesdata:
+            self.resolve(countrydata['id'], countrydata['names'][0]['value'])
+        with self.lock:
+            resolved = sum(1 for key, entry in self.entries.items() if before.get(key) != entry)
+        if resolved:
+            logger.info('Resolved %d CL_AREA entries' % resolved)
+            self.save()
+        return resolved
+
+    def save(self):
+        """
+        Write the index atomically, so that processes sharing it never read it half written
+        :return: None
+        """
+        if not self.path:
+            return
+        if dirname(self.path):
+            os.makedirs(dirname(self.path), exist_ok=True)
+        with self.lock:
+            text = json.dumps(self.entries, indent=1, sort_keys=True)
+        fd, path = mkstemp(dir=dirname(self.path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(path, self.path)
+
+
+def get_country_index(configuration):
+    """
+    Load the country index and its overrides named in the configuration
+    :param configuration: project configuration
+    :return: CountryIndex or None if no country index is configured
+    """
+    country_index = configuration.get('country_index')
+    if not country_index:
+        return None
+    path = country_index.get('path')
+    if path:
+        path = expanduser(path)
+    overrides = None
+    if country_index.get('overrides') and exists(country_index['overrides']):
+        try:
+            overrides = load_yaml(country_index['overrides'])
+        except LoadError:  # only comments
+            pass
+    return CountryIndex(path, overrides)
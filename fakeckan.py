@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Fake CKAN:
+---------
+
+In-memory stand-in for the HDX CKAN API covering the calls made when publishing datasets, resources and showcases,
+so that publishing throughput can be measured offline. Every call takes a configurable latency and uploads take
+extra time in proportion to the file size.
+
+"""
+import copy
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+
+from ckanapi.errors import NotFound
+
+logger = logging.getLogger(__name__)
+
+
+class FakeCKAN(object):
+    """
+    Thread safe fake of ckanapi.RemoteCKAN keeping packages, resources and showcases in memory. Actions it does not
+    implement (such as the vocabulary and location lookups made while generating datasets) are passed on to
+    remoteckan if given.
+    """
+
+    def __init__(self, latency=0.0, upload_mb_per_second=None, remoteckan=None):
+        self.latency = latency
+        self.upload_rate = upload_mb_per_second * 1024 * 1024 if upload_mb_per_second else None
+        self.remoteckan = remoteckan
+        self.lock = threading.Lock()
+        self.packages = dict()
+        self.resources = dict()
+        self.showcases = dict()
+        self.associations = dict()
+        self.calls = Counter()
+        self.uploaded_bytes = 0
+        self.started = time.time()
+
+    def call_action(self, action, data_dict=None, context=None, apikey=None, files=None, requests_kwargs=None):
+        function = getattr(self, action, None)
+        if function is None or action.startswith('_'):
+            if self.remoteckan is None:
+                raise NotImplementedError('Action %s is not supported by the fake CKAN!' % action)
+            return self.remoteckan.call_action(action, data_dict, context=context, apikey=apikey, files=files,
+                                               requests_kwargs=requests_kwargs)
+        data_dict = copy.deepcopy(data_dict or dict())
+        delay = self.latency
+        upload = None
+        if files:
+            upload = files[0][1]
+            size = os.fstat(upload.fileno()).st_size
+            if self.upload_rate:
+                delay += size / float(self.upload_rate)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.calls[action] += 1
+            if upload is not None:
+                self.uploaded_bytes += size
+            return copy.deepcopy(function(data_dict, upload))
+
+    def get_metrics(self):
+        """
+        Get the number of calls by action and the uploaded bytes
+        :return: dictionary of metric name -> value
+        """
+        with self.lock:
+            return {'calls': dict(self.calls), 'uploaded_bytes': self.uploaded_bytes, 'datasets': len(self.packages),
+                    'resources': len(self.resources), 'seconds': time.time() - self.started}
+
+    @staticmethod
+    def find(objects, id_or_name):
+        if id_or_name in objects:
+            return objects[id_or_name]
+        for obj in objects.values():
+            if obj.get('name') == id_or_name:
+                return obj
+        raise NotFound('Not found')
+
+    def show_package(self, package):
+        package = dict(package)
+        package['resources'] = [self.resources[x] for x in package['resources']]
+        package['num_resources'] = len(package['resources'])
+        return package
+
+    def save_resources(self, package, resources):
+        ids = list()
+        for resource in resources:
+            resource = dict(resource)
+            if resource.get('id') not in self.resources:
+                resource['id'] = str(uuid.uuid4())
+            resource['package_id'] = package['id']
+            self.resources[resource['id']] = resource
+            ids.append(resource['id'])
+        for id in package.get('resources', list()):
+            if id not in ids:
+                del self.resources[id]
+        package['resources'] = ids
+        for position, id in enumerate(ids):
+            self.resources[id]['position'] = position
+
+    def package_show(self, data_dict, upload):
+        return self.show_package(self.find(self.packages, data_dict['id']))
+
+    def package_create(self, data_dict, upload):
+        resources = data_dict.pop('resources', list())
+        package = dict(data_dict)
+        package['id'] = str(uuid.uuid4())
+        self.save_resources(package, resources)
+        self.packages[package['id']] = package
+        return self.show_package(package)
+
+    def package_update(self, data_dict, upload):
+        package = self.find(self.packages, data_dict['id'])
+        resources = data_dict.pop('resources', None)
+        package.update(data_dict)
+        if resources is not None:
+            self.save_resources(package, resources)
+        return self.show_package(package)
+
+    def package_resource_reorder(self, data_dict, upload):
+        package = self.find(self.packages, data_dict['id'])
+        order = data_dict['order']
+        ids = order + [x for x in package['resources'] if x not in order]
+        self.save_resources(package, [self.resources[x] for x in ids])
+        return {'id': package['id'], 'order': ids}
+
+    def package_hxl_update(self, data_dict, upload):
+        return self.package_show(data_dict, upload)
+
+    def package_create_default_resource_views(self, data_dict, upload):
+        return list()
+
+    def resource_show(self, data_dict, upload):
+        return self.find(self.resources, data_dict['id'])
+
+    def resource_update(self, data_dict, upload):
+        resource = self.find(self.resources, data_dict['id'])
+        resource.update(data_dict)
+        if upload is not None:
+            resource['url'] = 'https://data.humdata.org/dataset/%s/resource/%s/download/%s' % \
+                              (resource['package_id'], resource['id'], os.path.basename(upload.name))
+        return resource
+
+    def ckanext_showcase_show(self, data_dict, upload):
+        return self.find(self.showcases, data_dict['id'])
+
+    def ckanext_showcase_create(self, data_dict, upload):
+        showcase = dict(data_dict)
+        showcase['id'] = str(uuid.uuid4())
+        self.showcases[showcase['id']] = showcase
+        return showcase
+
+    def ckanext_showcase_update(self, data_dict, upload):
+        showcase = self.find(self.showcases, data_dict['id'])
+        showcase.update(data_dict)
+        return showcase
+
+    def ckanext_showcase_package_list(self, data_dict, upload):
+        showcase = self.find(self.showcases, data_dict['showcase_id'])
+        return [self.show_package(self.packages[x]) for x in self.associations.get(showcase['id'], list())]
+
+    def ckanext_showcase_package_association_create(self, data_dict, upload):
+        package_ids = self.associations.setdefault(data_dict['showcase_id'], list())
+        if data_dict['package_id'] not in package_ids:
+            package_ids.append(data_dict['package_id'])
+        return data_dict
+
+
+def setup_fake_ckan(configuration):
+    """
+    Publish to a fake CKAN instead of HDX if fake_latency is set in the publish section of the configuration.
+    Calls the fake does not implement still go to HDX.
+    :param configuration: project configuration
+    :return: FakeCKAN or None if HDX is used
+    """
+    publish = configuration.get('publish') or dict()
+    latency = publish.get('fake_latency')
+    if latency is None:
+        return None
+    fake_ckan = FakeCKAN(latency, upload_mb_per_second=publish.get('fake_upload_mb_per_second'),
+                         remoteckan=configuration.remoteckan())
+    configuration.setup_remoteckan(fake_ckan)
+    logger.info('Publishing to a fake HDX with %.2f seconds latency' % latency)
+    return fake_ckan
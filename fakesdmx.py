@@ -0,0 +1,411 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Fake SDMX:
+---------
+
+Local HTTP stand-in for the UNESCO SDMX API (api.uis.unesco.org/sdmx) serving the area codelist, structure
+(structureonly with metrics) and data (csv or SDMX-JSON) requests of the scraper from synthetic data, so that the
+whole scraper can be load tested without quota. The number of countries, years, dimensions and observations, the
+latency and injected Quota Exceeded and Not Found responses are configurable. Run it with:
+
+    python fakesdmx.py --port 8080 --countries 200
+
+and set base_url to http://localhost:8080/sdmx/ in the project configuration.
+
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import random
+import socketserver
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from hdx.location.country import Country
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = ('DEM_ECO', 'EDU_FINANCE', 'EDU_NON_FINANCE', 'EDU_REGIONAL_MODULE', 'SDG4')
+DIMENSIONS = ('UNIT_MEASURE', 'EDU_LEVEL', 'SEX', 'AGE', 'LOCATION', 'WEALTH_QUINTILE', 'EDU_TYPE', 'GRADE',
+              'SUBJECT', 'INFRASTR')
+ATTRIBUTES = (('UNIT_MULT', '0'), ('FREQ', 'A'), ('DECIMALS', '2'), ('OBS_STATUS', 'A'))
+AGGREGATES = (('40334', 'UIS: World'), ('40330', 'SDG: Africa'))
+ROWS_PER_BLOCK = 10000
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread, as http.server has only from Python 3.7"""
+    daemon_threads = True
+
+
+class SyntheticData(object):
+    """
+    Deterministic synthetic data of the endpoints. The observations of each country and endpoint are drawn from a
+    Pareto distribution around observations (up to max_observations), a fraction empty_fraction of them have no
+    data, and each observation is a distinct combination of the dimension values in a year.
+    """
+
+    def __init__(self, countries=20, endpoints=ENDPOINTS, start_year=1970, end_year=2020, dimensions=3,
+                 values_per_dimension=4, observations=1000, max_observations=100000, empty_fraction=0.1, seed=0):
+        iso2s = sorted(x for x in Country.countriesdata(use_live=False)['iso2iso3'] if len(x) == 2)
+        self.countries = [(iso2, Country.get_country_name_from_iso2(iso2) or iso2) for iso2 in iso2s[:countries]]
+        self.endpoints = list(endpoints)
+        self.years = list(range(start_year, end_year + 1))
+        self.dimensions = ['STAT_UNIT'] + list(DIMENSIONS[:dimensions])
+        self.values_per_dimension = values_per_dimension
+        self.grid = values_per_dimension ** len(self.dimensions)
+        self.observations = observations
+        self.max_observations = max_observations
+        self.empty_fraction = empty_fraction
+        self.seed = seed
+        self.cache = dict()
+        self.lock = threading.Lock()
+
+    def get_countries(self):
+        """
+        Get the items of the area codelist: the countries and some aggregates
+        :return: list of codelist items
+        """
+        return [{'id': iso2, 'names': [{'value': name, 'locale': 'en'}]}
+                for iso2, name in self.countries + list(AGGREGATES)]
+
+    def get_time_periods(self, endpoint, countryiso2):
+        """
+        Get the number of observations per year of a country and endpoint
+        :param endpoint: endpoint
+        :param countryiso2: country ISO2
+        :return: dictionary of year -> number of observations
+        """
+        key = (endpoint, countryiso2)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+        rng = random.Random('%s-%s-%s' % (self.seed, endpoint, countryiso2))
+        time_periods = dict()
+        if endpoint in self.endpoints and countryiso2 in dict(self.countries) and rng.random() >= self.empty_fraction:
+            total = min(self.max_observations, int(self.observations * rng.paretovariate(1.5)))
+            years = [year for year in self.years if rng.random() < 0.7] or self.years[-1:]
+            for i, year in enumerate(years):
+                count = min(self.grid, total // len(years) + (1 if i < total % len(years) else 0))
+                if count:
+                    time_periods[year] = count
+        with self.lock:
+            self.cache[key] = time_periods
+        return time_periods
+
+    def get_value(self, dimension, index):
+        if dimension != 'STAT_UNIT' and index == 0:
+            return '_T', 'Total'
+        return '%s%d' % (dimension[:2], index), '%s %d' % (dimension.replace('_', ' ').capitalize(), index)
+
+    def get_dimensions(self, endpoint, countryiso2s=None):
+        """
+        Get the dimensions of a structure response with the number of observations of each value
+        :param endpoint: endpoint
+        :param countryiso2s: countries to count the observations of (if None, all countries)
+        :return: list of dimensions
+        """
+        if countryiso2s is None:
+            countryiso2s = [iso2 for iso2, _ in self.countries]
+        names = dict(self.countries + list(AGGREGATES))
+        by_country = {iso2: self.get_time_periods(endpoint, iso2) for iso2 in countryiso2s}
+        by_year = Counter()
+        for time_periods in by_country.values():
+            by_year.update(time_periods)
+        total = sum(by_year.values())
+        dimensions = list()
+        for dimension in self.dimensions:
+            values = list()
+            for index in range(self.values_per_dimension):
+                id, name = self.get_value(dimension, index)
+                values.append({'id': id, 'name': name, 'inDataset': True,
+                               'actualObs': total // self.values_per_dimension})
+            dimensions.append({'id': dimension, 'name': dimension, 'role': None, 'values': values})
+        dimensions.append({'id': 'REF_AREA', 'name': 'Reference area', 'role': 'REF_AREA',
+                           'values': [{'id': iso2, 'name': names.get(iso2, iso2), 'inDataset': True,
+                                       'actualObs': sum(by_country[iso2].values())} for iso2 in countryiso2s]})
+        dimensions.append({'id': 'TIME_PERIOD', 'name': 'Time period', 'role': 'TIME_PERIOD',
+                           'values': [{'id': str(year), 'name': str(year), 'inDataset': True,
+                                       'actualObs': by_year[year]} for year in sorted(by_year, reverse=True)]})
+        for position, dimension in enumerate(dimensions):
+            dimension['keyPosition'] = position
+            dimension['maxObs'] = max([x['actualObs'] for x in dimension['values']] or [0])
+        return dimensions
+
+    def get_structure(self, endpoint, countryiso2s=None):
+        """
+        Get a structure response with metrics
+        :param endpoint: endpoint
+        :param countryiso2s: countries of the key (if None, all countries)
+        :return: SDMX-JSON structure message
+        """
+        return {'structure': {'name': 'Synthetic %s' % endpoint.replace('_', ' ').lower(),
+                              'dimensions': {'observation': self.get_dimensions(endpoint, countryiso2s)}}}
+
+    def get_observations(self, endpoint, countryiso2s, start_year, end_year):
+        """
+        Generate the observations of countries in a period
+        :param endpoint: endpoint
+        :param countryiso2s: countries
+        :param start_year: start year of the period
+        :param end_year: end year of the period
+        :return: generator of (dimension value indices, country ISO2, year, value)
+        """
+        for countryiso2 in countryiso2s:
+            offset = zlib.crc32(('%s%s' % (endpoint, countryiso2)).encode('utf-8'))
+            for year, count in sorted(self.get_time_periods(endpoint, countryiso2).items()):
+                if not start_year <= year <= end_year:
+                    continue
+                for i in range(count):
+                    indices = list()
+                    rest = i
+                    for _ in self.dimensions:
+                        rest, index = divmod(rest, self.values_per_dimension)
+                        indices.append(index)
+                    yield indices, countryiso2, year, ((offset + year * 31 + i * 7) % 100000) / 100.0
+
+    def count_observations(self, endpoint, countryiso2s, start_year, end_year):
+        return sum(count for countryiso2 in countryiso2s
+                   for year, count in self.get_time_periods(endpoint, countryiso2).items()
+                   if start_year <= year <= end_year)
+
+    def get_csv(self, endpoint, countryiso2s, start_year, end_year):
+        """
+        Generate a csv data response in blocks, with dimensions as CODE:Label like the API's labelled csv
+        :param endpoint: endpoint
+        :param countryiso2s: countries
+        :param start_year: start year of the period
+        :param end_year: end year of the period
+        :return: generator of blocks of bytes
+        """
+        names = dict(self.countries)
+        labels = [['%s:%s' % self.get_value(dimension, index) for index in range(self.values_per_dimension)]
+                  for dimension in self.dimensions]
+        attributes = [value for _, value in ATTRIBUTES]
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(self.dimensions + ['REF_AREA', 'TIME_PERIOD', 'OBS_VALUE'] + [id for id, _ in ATTRIBUTES])
+        rows = 0
+        for indices, countryiso2, year, value in self.get_observations(endpoint, countryiso2s, start_year, end_year):
+            writer.writerow([labels[i][index] for i, index in enumerate(indices)] +
+                            ['%s:%s' % (countryiso2, names[countryiso2]), year, value] + attributes)
+            rows += 1
+            if rows % ROWS_PER_BLOCK == 0:
+                yield output.getvalue().encode('utf-8')
+                output.seek(0)
+                output.truncate()
+        yield output.getvalue().encode('utf-8')
+
+    def get_json(self, endpoint, countryiso2s, start_year, end_year):
+        """
+        Get an SDMX-JSON data message with dimensionAtObservation=AllDimensions
+        :param endpoint: endpoint
+        :param countryiso2s: countries
+        :param start_year: start year of the period
+        :param end_year: end year of the period
+        :return: SDMX-JSON data message
+        """
+        dimensions = self.get_dimensions(endpoint, countryiso2s)
+        years = {int(value['id']): i for i, value in enumerate(dimensions[-1]['values'])}
+        countries = {iso2: i for i, iso2 in enumerate(countryiso2s)}
+        attributes = [0] * len(ATTRIBUTES)
+        observations = dict()
+        for indices, countryiso2, year, value in self.get_observations(endpoint, countryiso2s, start_year, end_year):
+            key = ':'.join(str(x) for x in indices + [countries[countryiso2], years[year]])
+            observations[key] = [value] + attributes
+        return {'structure': {'name': 'Synthetic %s' % endpoint, 'dimensions': {'observation': dimensions},
+                              'attributes': {'observation': [{'id': id, 'values': [{'id': value}]}
+                                                             for id, value in ATTRIBUTES]}},
+                'dataSets': [{'observations': observations}]}
+
+
+class FakeSDMX(object):
+    """
+    Threaded HTTP server of SyntheticData. Every request takes latency seconds plus latency_per_1000 seconds per
+    thousand observations of data, and fractions quota_error_rate and not_found_rate of the requests are answered
+    with 429 Quota Exceeded (with a Retry-After of retry_after seconds) and 404 Not Found. Data requests without
+    observations are Not Found, as in the API.
+    """
+
+    def __init__(self, data, host='127.0.0.1', port=0, latency=0.0, latency_per_1000=0.0, quota_error_rate=0.0,
+                 not_found_rate=0.0, retry_after=1, seed=None):
+        self.data = data
+        self.latency = latency
+        self.latency_per_1000 = latency_per_1000
+        self.quota_error_rate = quota_error_rate
+        self.not_found_rate = not_found_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.served_bytes = 0
+        self.server = ThreadingHTTPServer((host, port), FakeSDMXHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/sdmx/' % (host, port)
+
+    def draw_error(self):
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.quota_error_rate:
+            return 429, 'Quota Exceeded'
+        if draw < self.quota_error_rate + self.not_found_rate:
+            return 404, 'Not Found'
+        return None
+
+    def count(self, kind, status, size=0):
+        with self.lock:
+            self.requests[kind] += 1
+            self.statuses[status] += 1
+            self.served_bytes += size
+
+    def get_metrics(self):
+        """
+        Get the number of requests by kind and status and the bytes served
+        :return: dictionary of metric name -> value
+        """
+        with self.lock:
+            return {'requests': dict(self.requests), 'statuses': dict(self.statuses),
+                    'served_bytes': self.served_bytes}
+
+    def start(self):
+        """
+        Serve in a background thread
+        :return: None
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info('Serving synthetic SDMX API at %s' % self.base_url)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class FakeSDMXHandler(BaseHTTPRequestHandler):
+    """Request handler of FakeSDMX, answering each request with a response body or an error"""
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send(self, kind, status, reason, content_type=None, blocks=()):
+        fake = self.server.fake
+        self.send_response(status, reason)
+        if status == 429:
+            self.send_header('Retry-After', str(fake.retry_after))
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.end_headers()
+        size = 0
+        for block in blocks:
+            self.wfile.write(block)
+            size += len(block)
+        fake.count(kind, status, size)
+
+    def do_GET(self):
+        fake = self.server.fake
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        path = unquote(parts.path).split('/')
+        if fake.latency:
+            time.sleep(fake.latency)
+        kind = 'codelist' if 'codelist' in path else ('structure' if query.get('detail') == 'structureonly'
+                                                      else 'data')
+        error = fake.draw_error()
+        if error is not None:
+            self.send(kind, error[0], error[1])
+            return
+        if kind == 'codelist':
+            body = json.dumps({'Codelist': [{'items': fake.data.get_countries()}]}).encode('utf-8')
+            self.send(kind, 200, 'OK', 'application/json', [body])
+            return
+        if 'data' not in path or not path[path.index('data') + 1].startswith('UNESCO,'):
+            self.send(kind, 404, 'Not Found')
+            return
+        endpoint = path[path.index('data') + 1].split(',')[1]
+        key = path[path.index('data') + 2] if len(path) > path.index('data') + 2 else ''
+        countryiso2s = None
+        if key:
+            keyparts = key.split('.')
+            position = len(fake.data.dimensions)
+            countryiso2s = [x for x in keyparts[position].split('+') if x] if position < len(keyparts) else None
+        if endpoint not in fake.data.endpoints:
+            self.send(kind, 404, 'Not Found')
+            return
+        if kind == 'structure':
+            body = json.dumps(fake.data.get_structure(endpoint, countryiso2s)).encode('utf-8')
+            self.send(kind, 200, 'OK', 'application/json', [body])
+            return
+        if countryiso2s is None:
+            countryiso2s = [iso2 for iso2, _ in fake.data.countries]
+        start_year = int(query.get('startPeriod', fake.data.years[0]))
+        end_year = int(query.get('endPeriod', fake.data.years[-1]))
+        observations = fake.data.count_observations(endpoint, countryiso2s, start_year, end_year)
+        if observations == 0:
+            self.send(kind, 404, 'Not Found')
+            return
+        if fake.latency_per_1000:
+            time.sleep(fake.latency_per_1000 * observations / 1000.0)
+        if query.get('format') == 'sdmx-json':
+            body = json.dumps(fake.data.get_json(endpoint, countryiso2s, start_year, end_year)).encode('utf-8')
+            self.send(kind, 200, 'OK', 'application/json', [body])
+        else:
+            self.send(kind, 200, 'OK', 'text/csv', fake.data.get_csv(endpoint, countryiso2s, start_year, end_year))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic stand-in for the UNESCO SDMX API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--countries', type=int, default=20, help='number of countries (besides 2 aggregates)')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='comma separated endpoints')
+    parser.add_argument('--start-year', type=int, default=1970)
+    parser.add_argument('--end-year', type=int, default=2020)
+    parser.add_argument('--dimensions', type=int, default=3, help='dimensions besides STAT_UNIT (up to %d)'
+                                                                   % len(DIMENSIONS))
+    parser.add_argument('--values', type=int, default=4, help='values per dimension')
+    parser.add_argument('--observations', type=int, default=1000, help='typical observations per country endpoint')
+    parser.add_argument('--max-observations', type=int, default=100000, help='most observations per country endpoint')
+    parser.add_argument('--empty-fraction', type=float, default=0.1, help='fraction of country endpoints without data')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--latency-per-1000', type=float, default=0.0, help='seconds per 1000 observations of data')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help='fraction of requests over quota')
+    parser.add_argument('--not-found-rate', type=float, default=0.0, help='fraction of requests not found')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After in seconds of quota errors')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    data = SyntheticData(args.countries, args.endpoints.split(','), args.start_year, args.end_year, args.dimensions,
+                         args.values, args.observations, args.max_observations, args.empty_fraction, args.seed)
+    fake = FakeSDMX(data, args.host, args.port, args.latency, args.latency_per_1000, args.quota_error_rate,
+                    args.not_found_rate, args.retry_after, args.seed)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Served %s' % fake.get_metrics())
+    finally:
+        fake.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
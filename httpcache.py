@@ -0,0 +1,371 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+HTTP cache:
+----------
+
+Persistent on-disk cache of UNESCO API responses with ETag/Last-Modified revalidation, a time to live per class
+of URL (codelist, structure, data) and a size cap with least recently used eviction.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from os.path import exists, join
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from hdx.utilities import raisefrom
+from hdx.utilities.downloader import Download, DownloadError
+from hdx.utilities.session import get_session
+
+logger = logging.getLogger(__name__)
+
+MAX_SIZE_MB = 1024
+CHUNK_SIZE = 1024 * 1024
+TTL_HOURS = {'codelist': 720, 'structure': 24, 'data': 168}
+
+
+def cache_key_url(url):
+    """
+    URL without the subscription key, so that responses are shared whatever key fetched them
+    :param url: url
+    :return: url used as cache key
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != 'subscription-key']
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query, safe=':-'), parts.fragment))
+
+
+def url_class(url):
+    """
+    Class of a UNESCO API URL which determines how long its responses stay fresh
+    :param url: url
+    :return: 'codelist', 'structure' or 'data'
+    """
+    if '/codelist/' in url:
+        return 'codelist'
+    if 'structureonly' in url:
+        return 'structure'
+    return 'data'
+
+
+class CachedResponse(object):
+    """
+    Response served from the cache, offering the parts of requests.Response used by the scraper. The body is read
+    into memory when the response is served unless it is to be streamed, in which case the cached file is opened
+    then, so that streaming it with iter_content does not load it into memory and evicting it meanwhile does not
+    take it away.
+    """
+
+    status_code = 200
+
+    def __init__(self, url, path, headers, from_cache=True, stream=False):
+        self.url = url
+        self.path = path
+        self.headers = headers
+        self.from_cache = from_cache
+        self.body = None
+        self.file = open(path, 'rb')
+        if not stream:
+            self.body = self.file.read()
+            self.close()
+
+    @property
+    def content(self):
+        if self.body is None:
+            self.file.seek(0)
+            self.body = self.file.read()
+            self.close()
+        return self.body
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        if self.body is not None:
+            for i in range(0, len(self.body), chunk_size):
+                yield self.body[i:i + chunk_size]
+            return
+        self.file.seek(0)
+        for chunk in iter(lambda: self.file.read(chunk_size), b''):
+            yield chunk
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SessionDownload(Download):
+    """
+    Download that can send extra headers with a request, as needed for conditional requests, and can leave the body
+    to be streamed. It is shared by worker threads, so each thread gets its own session and responses are returned
+    rather than kept on the downloader, where another thread's request would close them while they are read.
+    """
+
+    def __init__(self, user_agent=None, user_agent_config_yaml=None, user_agent_lookup=None, use_env=True, **kwargs):
+        super(SessionDownload, self).__init__(user_agent, user_agent_config_yaml, user_agent_lookup, use_env, **kwargs)
+        self.session_args = (user_agent, user_agent_config_yaml, user_agent_lookup, use_env), kwargs
+        self.local = threading.local()
+        self.local.session = self.session
+        self.lock = threading.Lock()
+        self.sessions = [self.session]
+
+    def get_session(self):
+        """
+        Session of the calling thread, set up like that of the downloader
+        :return: requests.Session
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            args, kwargs = self.session_args
+            session = get_session(*args, **kwargs)
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def download(self, url, post=False, parameters=None, timeout=None, headers=None, stream=False):
+        session = self.get_session()
+        try:
+            if post:
+                full_url, parameters = self.get_url_params_for_post(url, parameters)
+                response = session.post(full_url, data=parameters, headers=headers, stream=stream, timeout=timeout)
+            else:
+                response = session.get(self.get_url_for_get(url, parameters), headers=headers, stream=stream,
+                                       timeout=timeout)
+            response.raise_for_status()
+        except Exception as e:
+            raisefrom(DownloadError, 'Download of %s failed!' % url, e)
+        return response
+
+    def close(self):
+        super(SessionDownload, self).close()
+        with self.lock:
+            for session in self.sessions[1:]:
+                session.close()
+            del self.sessions[1:]
+
+
+class HTTPCache(object):
+    """
+    Responses are stored content addressed (by hash of the body) in folder and indexed by cache_key_url.
+    The index is written when responses are stored or evicted and when the cache is closed, so that it survives
+    between runs. Times of access and revalidation are only kept in memory until then.
+    """
+
+    def __init__(self, folder, ttl_hours=None, max_size_mb=None):
+        self.folder = folder
+        self.ttls = dict(TTL_HOURS)
+        if ttl_hours:
+            self.ttls.update(ttl_hours)
+        if max_size_mb is None:
+            max_size_mb = MAX_SIZE_MB
+        self.max_size = max_size_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.changed = False
+        self.index_path = join(folder, 'index.json')
+        os.makedirs(join(folder, 'blobs'), exist_ok=True)
+        if exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = dict()
+
+    def blob_path(self, digest):
+        return join(self.folder, 'blobs', digest[:2], digest)
+
+    def size(self):
+        return sum({entry['blob']: entry['size'] for entry in self.index.values()}.values())
+
+    def save_index(self):
+        path = '%s.tmp' % self.index_path
+        with open(path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(path, self.index_path)
+        self.changed = False
+
+    def close(self):
+        """
+        Write the index if times of access or revalidation changed since it was last written
+        :return: None
+        """
+        with self.lock:
+            if self.changed:
+                self.save_index()
+
+    def get(self, url):
+        """
+        Look up a url
+        :param url: url
+        :return: (entry, fresh) where entry is None if url is not cached
+        """
+        key = cache_key_url(url)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or not exists(self.blob_path(entry['blob'])):
+                return None, False
+            ttl = self.ttls[entry['class']] * 3600
+            return dict(entry), time.time() - entry['stored'] < ttl
+
+    def response(self, url, entry, from_cache=True, stream=False):
+        """
+        Serve a cached response, marking it as recently used
+        :param url: url
+        :param entry: entry returned by get
+        :param from_cache: False if the response was just downloaded
+        :param stream: if true, the body is left in the cached file to be streamed
+        :return: CachedResponse or None if the response was evicted since entry was returned
+        """
+        with self.lock:
+            key = cache_key_url(url)
+            if key in self.index:
+                self.index[key]['accessed'] = time.time()
+                self.changed = True
+            # Under the lock, so that the blob cannot be evicted before it is read or opened
+            try:
+                return CachedResponse(url, self.blob_path(entry['blob']), entry['headers'], from_cache, stream)
+            except FileNotFoundError:
+                return None
+
+    def revalidated(self, url):
+        """
+        Record that the server confirmed a cached response is unchanged
+        :param url: url
+        :return: None
+        """
+        with self.lock:
+            entry = self.index.get(cache_key_url(url))
+            if entry is not None:
+                entry['stored'] = time.time()
+                self.changed = True
+
+    def store(self, url, response, stream=False):
+        """
+        Store a response, then evict least recently used entries beyond the size cap
+        :param url: url
+        :param response: response object
+        :param stream: if true, the body is streamed to the cache with iter_content rather than read into memory
+        :return: entry stored
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        tmp_path = join(self.folder, 'blobs', '%d.tmp' % threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            for chunk in (response.iter_content(CHUNK_SIZE) if stream else [response.content]):
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+        path = self.blob_path(digest)
+        if exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        headers = getattr(response, 'headers', None) or dict()
+        headers = {k: headers[k] for k in ('Content-Type', 'ETag', 'Last-Modified') if k in headers}
+        now = time.time()
+        key = cache_key_url(url)
+        entry = {'url': key, 'class': url_class(url), 'blob': digest, 'size': size,
+                 'headers': headers, 'stored': now, 'accessed': now}
+        with self.lock:
+            self.index[key] = entry
+            self.evict(key)
+            self.save_index()
+        return dict(entry)
+
+    def evict(self, stored_key=None):
+        size = self.size()
+        if size <= self.max_size:
+            return
+        references = Counter(entry['blob'] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda x: x[1]['accessed']):
+            if size <= self.max_size:
+                break
+            if key == stored_key:  # kept to be served even if it alone exceeds the cap
+                continue
+            del self.index[key]
+            references[entry['blob']] -= 1
+            if references[entry['blob']] == 0:
+                size -= entry['size']
+                try:
+                    os.remove(self.blob_path(entry['blob']))
+                except OSError:
+                    pass
+            logger.info('Evicted %s from cache' % key)
+
+
+class CachingDownload(object):
+    """
+    Downloader wrapper serving fresh responses from the cache. Stale responses are revalidated with
+    If-None-Match/If-Modified-Since where the server gave an ETag/Last-Modified, otherwise downloaded again.
+    Streamed responses are written straight to the cache and served from there.
+    """
+
+    def __init__(self, downloader, cache):
+        self.downloader = downloader
+        self.cache = cache
+
+    def download(self, url, *args, **kwargs):
+        stream = kwargs.get('stream', False)
+        entry, fresh = self.cache.get(url)
+        if fresh:
+            response = self.cache.response(url, entry, stream=stream)
+            if response is not None:
+                return response
+            entry = None
+        headers = dict()
+        if entry is not None:
+            if 'ETag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        if headers:
+            response = self.downloader.download(url, *args, headers=headers, **kwargs)
+        else:
+            response = self.downloader.download(url, *args, **kwargs)
+        if getattr(response, 'status_code', None) == 304:
+            self.cache.revalidated(url)
+            cached_response = self.cache.response(url, entry, stream=stream)
+            if cached_response is not None:
+                return cached_response
+            response = self.downloader.download(url, *args, **kwargs)  # evicted since it was revalidated
+        if stream:
+            try:
+                entry = self.cache.store(url, response, stream=True)
+            except Exception as e:
+                raisefrom(DownloadError, 'Download of %s failed in retrieval of stream!' % url, e)
+            finally:
+                response.close()
+            cached_response = self.cache.response(url, entry, from_cache=False, stream=True)
+            if cached_response is None:
+                raise DownloadError('Download of %s was evicted from the cache before it was read!' % url)
+            return cached_response
+        if getattr(response, 'content', None) is not None:
+            self.cache.store(url, response)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.downloader, name)
+
+
+def get_cache(configuration):
+    """
+    Create the HTTP cache from the http_cache section of the configuration
+    :param configuration: project configuration
+    :return: HTTPCache or None if no cache is configured
+    """
+    http_cache = configuration.get('http_cache')
+    if not http_cache:
+        return None
+    folder = os.path.expanduser(http_cache.get('folder', join('~', '.cache', 'hdx-scraper-unesco')))
+    return HTTPCache(folder, ttl_hours=http_cache.get('ttl_hours'), max_size_mb=http_cache.get('max_size_mb'))
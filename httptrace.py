@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+HTTP trace:
+----------
+
+Recording of every request made to the UNESCO API to a gzipped JSON lines archive (url without the subscription
+key, status, latency, size, attempt, headers and body) and replay of a run from such an archive, with optional
+simulated latency and quota errors, so that runs can be benchmarked and compared without network or quota.
+
+"""
+import base64
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from timeit import default_timer
+
+from hdx.utilities import raisefrom
+from hdx.utilities.downloader import Download, DownloadError
+
+from httpcache import cache_key_url
+
+logger = logging.getLogger(__name__)
+
+HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After')
+QUOTA_ERROR = '429 Client Error: Quota Exceeded'
+SUBSCRIPTION_KEY = re.compile(r'subscription-key=[^&\s]*')
+
+
+class TraceResponse(object):
+    """
+    Response recorded in or replayed from a trace, offering the parts of requests.Response used by the scraper
+    """
+
+    def __init__(self, url, status_code, headers, content, from_cache=False):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class TraceHTTPError(IOError):
+    """HTTP error replayed from a trace, with its response so that Retry-After can be read from it"""
+
+    def __init__(self, message, response):
+        super(TraceHTTPError, self).__init__(message)
+        self.response = response
+
+
+def get_status(error):
+    """
+    Get the HTTP status of the error behind a DownloadError
+    :param error: DownloadError
+    :return: status or None if the request failed without a response
+    """
+    response = getattr(error.__cause__, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None:
+        match = re.match(r'(\d{3}) ', str(error.__cause__))
+        if match:
+            status = int(match.group(1))
+    return status
+
+
+class TraceRecorder(object):
+    """
+    Thread safe writer of a trace. Each request is a line, numbered by the attempt at its url (so retries after
+    quota errors show as attempts above 0). Every line is written as a gzip member of its own and flushed, so that
+    a run killed at any point leaves a readable trace.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.attempts = dict()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'wb')
+
+    def record(self, url, seconds, status, headers=None, content=None, error=None):
+        """
+        Record a request
+        :param url: url requested
+        :param seconds: latency of the request
+        :param status: HTTP status or None
+        :param headers: response headers or None
+        :param content: body as bytes or None
+        :param error: error message of a failed request (any subscription key in it is removed) or None
+        :return: None
+        """
+        key = cache_key_url(url)
+        headers = headers or dict()
+        if error is not None:
+            error = SUBSCRIPTION_KEY.sub('subscription-key=', error)
+        record = {'url': key, 'status': status, 'seconds': seconds, 'error': error,
+                  'headers': {k: headers[k] for k in HEADERS if k in headers},
+                  'bytes': 0 if content is None else len(content),
+                  'body': None if content is None else base64.b64encode(content).decode('ascii')}
+        with self.lock:
+            record['attempt'] = self.attempts.get(key, 0)
+            self.attempts[key] = record['attempt'] + 1
+            self.file.write(gzip.compress(('%s\n' % json.dumps(record, sort_keys=True)).encode('utf-8')))
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info('Recorded %d requests to %d urls in %s' % (sum(self.attempts.values()), len(self.attempts),
+                                                               self.path))
+
+
+class RecordingDownload(object):
+    """
+    Downloader wrapper recording every request in a trace. Streamed bodies are read in full to be recorded and then
+    streamed from memory.
+    """
+
+    def __init__(self, downloader, recorder):
+        self.downloader = downloader
+        self.recorder = recorder
+
+    def download(self, url, *args, **kwargs):
+        start = default_timer()
+        try:
+            response = self.downloader.download(url, *args, **kwargs)
+            content = b''.join(response.iter_content(1024 * 1024)) if kwargs.get('stream') else response.content
+        except DownloadError as e:
+            response = getattr(e.__cause__, 'response', None)
+            self.recorder.record(url, default_timer() - start, get_status(e), getattr(response, 'headers', None),
+                                 error=str(e.__cause__))
+            raise
+        status = getattr(response, 'status_code', 200)
+        headers = getattr(response, 'headers', None)
+        self.recorder.record(url, default_timer() - start, status, headers, content)
+        if kwargs.get('stream'):
+            response.close()
+            return TraceResponse(url, status, headers, content)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.downloader, name)
+
+
+class ReplayDownload(object):
+    """
+    Downloader serving the responses of a trace instead of the API. Each url replays its recorded attempts in order
+    (including their errors) and then keeps serving its last one. Urls not in the trace fail as Not Found.
+    Latency is the recorded latency of each request or a fixed number of seconds, and quota errors are added to a
+    fraction quota_error_rate of the requests, with a Retry-After of quota_retry_after seconds.
+    """
+
+    def __init__(self, path, latency='recorded', quota_error_rate=0.0, quota_retry_after=1, seed=None):
+        self.path = path
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.quota_retry_after = quota_retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.records = dict()
+        self.served = dict()
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records.setdefault(record['url'], list()).append(record)
+            except (EOFError, ValueError):
+                logger.warning('Ignoring incomplete last request in trace %s' % path)
+        logger.info('Replaying %d urls from %s' % (len(self.records), path))
+
+    def next_record(self, key):
+        with self.lock:
+            records = self.records.get(key)
+            if records is None:
+                return None, False
+            if self.quota_error_rate and self.random.random() < self.quota_error_rate:
+                return records[-1], True
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+            return records[min(index, len(records) - 1)], False
+
+    def download(self, url, *args, **kwargs):
+        key = cache_key_url(url)
+        record, quota_error = self.next_record(key)
+        if record is None:
+            raisefrom(DownloadError, 'Download of %s failed!' % url, IOError('404 Client Error: Not Found for url: '
+                                                                             '%s' % key))
+        seconds = record['seconds'] if self.latency == 'recorded' else self.latency
+        if seconds:
+            time.sleep(seconds)
+        if quota_error:
+            response = TraceResponse(url, 429, {'Retry-After': str(self.quota_retry_after)}, b'')
+            raisefrom(DownloadError, 'Download of %s failed!' % url, TraceHTTPError(QUOTA_ERROR, response))
+        content = b'' if record['body'] is None else base64.b64decode(record['body'])
+        response = TraceResponse(url, record['status'], record['headers'], content)
+        if record['error'] is not None:
+            raisefrom(DownloadError, 'Download of %s failed!' % url, TraceHTTPError(record['error'], response))
+        return response
+
+    def get_full_url(self, url):
+        return url
+
+    def get_url_for_get(self, url, parameters=None):
+        return Download.get_url_for_get(url, parameters)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_replay(configuration):
+    """
+    Create the replaying downloader from the trace section of the configuration
+    :param configuration: project configuration
+    :return: ReplayDownload or None if no trace is to be replayed
+    """
+    trace = configuration.get('trace') or dict()
+    path = trace.get('replay')
+    if not path:
+        return None
+    if trace.get('record'):
+        raise ValueError('Cannot record a trace while replaying one!')
+    return ReplayDownload(os.path.expanduser(path), latency=trace.get('latency', 'recorded'),
+                          quota_error_rate=trace.get('quota_error_rate', 0.0),
+                          quota_retry_after=trace.get('quota_retry_after', 1), seed=trace.get('seed'))
+
+
+def get_recorder(configuration):
+    """
+    Create the trace recorder from the trace section of the configuration
+    :param configuration: project configuration
+    :return: TraceRecorder or None if no trace is to be recorded
+    """
+    trace = configuration.get('trace') or dict()
+    path = trace.get('record')
+    if not path:
+        return None
+    return TraceRecorder(os.path.expanduser(path))
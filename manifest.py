@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Manifest:
+--------
+
+Persisted content hashes of what was last published to HDX, so that unchanged datasets and resources are not
+uploaded again.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from os.path import dirname, exists
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path):
+    """
+    SHA-256 of a file's content
+    :param path: path to file
+    :return: hex digest
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_metadata(dataset, showcase):
+    """
+    SHA-256 of the metadata of a dataset and its showcase (not including resources)
+    :param dataset: Dataset
+    :param showcase: Showcase
+    :return: hex digest
+    """
+    metadata = {'dataset': dataset.data, 'showcase': showcase.data if showcase is not None else None}
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """
+    Hashes of the published metadata and resource files by dataset name. Datasets are named by country ISO3 and
+    endpoint and their resources by value of the column the data was split by, so each resource hash stands for a
+    (country ISO3, endpoint, resource value) triple.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = dict()
+
+    @staticmethod
+    def entry(dataset, showcase):
+        """
+        Compute the manifest entry of a generated dataset whose resources are files to upload
+        :param dataset: Dataset
+        :param showcase: Showcase
+        :return: dictionary with metadata hash and resource name -> (file path, hash)
+        """
+        resources = dict()
+        for resource in dataset.get_resources():
+            path = resource.get_file_to_upload()
+            resources[resource['name']] = (path, hash_file(path) if path else None)
+        return {'metadata': hash_metadata(dataset, showcase), 'resources': resources}
+
+    def changes(self, dataset, entry):
+        """
+        Compare an entry with what was last published
+        :param dataset: Dataset
+        :param entry: entry computed by Manifest.entry
+        :return: (metadata changed, list of names of changed resources)
+        """
+        with self.lock:
+            published = self.entries.get(dataset['name'])
+        if published is None:
+            return True, sorted(entry['resources'])
+        resources = entry['resources']
+        changed = [name for name in sorted(resources)
+                   if resources[name][1] is None or published['resources'].get(name) != resources[name][1]]
+        metadata_changed = published['metadata'] != entry['metadata'] or \
+            sorted(published['resources']) != sorted(resources)
+        return metadata_changed, changed
+
+    def record(self, dataset, entry):
+        """
+        Record a published dataset and save the manifest
+        :param dataset: Dataset
+        :param entry: entry computed by Manifest.entry
+        :return: None
+        """
+        with self.lock:
+            self.entries[dataset['name']] = {'metadata': entry['metadata'],
+                                             'resources': {name: digest
+                                                           for name, (_, digest) in entry['resources'].items()}}
+            if dirname(self.path):
+                os.makedirs(dirname(self.path), exist_ok=True)
+            path = '%s.tmp' % self.path
+            with open(path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(path, self.path)
+
+
+def get_manifest(configuration):
+    """
+    Load the manifest named in the configuration
+    :param configuration: project configuration
+    :return: Manifest or None if no manifest is configured
+    """
+    path = configuration.get('manifest')
+    if not path:
+        return None
+    return Manifest(os.path.expanduser(path))
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Metrics:
+-------
+
+Timers and counters of the stages of a run (such as downloading, processing, writing and publishing), recorded in
+a registry shared by all threads and exported at the end of a run as a Prometheus textfile and a JSON summary, so
+that it can be seen where the time of a run goes and runs of different releases can be compared.
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from timeit import default_timer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'unesco'
+
+
+class Metrics(object):
+    """
+    Thread safe registry of timers (number of calls, total and maximum seconds per stage) and counters
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = dict()
+        self.counters = dict()
+
+    def record(self, name, seconds):
+        """
+        Record a call of a stage
+        :param name: name of the stage
+        :param seconds: seconds the call took
+        :return: None
+        """
+        with self.lock:
+            timer = self.timers.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            timer['calls'] += 1
+            timer['seconds'] += seconds
+            timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+    def increment(self, name, value=1):
+        """
+        Add to a counter
+        :param name: name of the counter
+        :param value: amount to add
+        :return: None
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Get the current values of the timers and counters
+        :return: dictionary with timers (name -> calls, seconds and max_seconds) and counters (name -> value)
+        """
+        with self.lock:
+            return {'timers': {name: dict(timer) for name, timer in self.timers.items()},
+                    'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        """
+        Add the timers and counters of a snapshot, such as one taken in another process
+        :param snapshot: dictionary returned by snapshot
+        :return: None
+        """
+        with self.lock:
+            for name, other in snapshot['timers'].items():
+                timer = self.timers.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                timer['calls'] += other['calls']
+                timer['seconds'] += other['seconds']
+                timer['max_seconds'] = max(timer['max_seconds'], other['max_seconds'])
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.timers = dict()
+            self.counters = dict()
+
+
+registry = Metrics()
+
+
+@contextmanager
+def timer(name):
+    """
+    Time a block as a call of a stage, whether or not it raises
+    :param name: name of the stage
+    :return: None
+    """
+    start = default_timer()
+    try:
+        yield
+    finally:
+        registry.record(name, default_timer() - start)
+
+
+def timed_iter(name, iterable):
+    """
+    Time the work of producing the items of an iterable (not of consuming them) as one call of a stage
+    :param name: name of the stage
+    :param iterable: iterable such as a generator
+    :return: generator of the items of iterable
+    """
+    seconds = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = default_timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += default_timer() - start
+            yield item
+    finally:
+        registry.record(name, seconds)
+
+
+def record(name, seconds):
+    """
+    Record a call of a stage timed by the caller in the registry
+    :param name: name of the stage
+    :param seconds: seconds the call took
+    :return: None
+    """
+    registry.record(name, seconds)
+
+
+def increment(name, value=1):
+    """
+    Add to a counter of the registry
+    :param name: name of the counter
+    :param value: amount to add
+    :return: None
+    """
+    registry.increment(name, value)
+
+
+def merge(snapshot):
+    """
+    Add the metrics of a snapshot to the registry
+    :param snapshot: dictionary returned by Metrics.snapshot or collect
+    :return: None
+    """
+    registry.merge(snapshot)
+
+
+def collect(function, *args, **kwargs):
+    """
+    Call a function in a worker process, such as of a ProcessPoolExecutor, with a registry of its own, so that its
+    metrics can be passed back and merged into the registry of the main process. Worker processes run one call at a
+    time, so swapping the registry is safe there.
+    :param function: function to call
+    :return: (result of function, snapshot of the metrics it recorded)
+    """
+    global registry
+    parent = registry
+    registry = Metrics()
+    try:
+        return function(*args, **kwargs), registry.snapshot()
+    finally:
+        registry = parent
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+def to_prometheus(snapshot, seconds, success, labels=None):
+    """
+    Format metrics in the Prometheus text exposition format
+    :param snapshot: dictionary returned by Metrics.snapshot
+    :param seconds: duration of the run
+    :param success: whether the run completed
+    :param labels: dictionary of label -> value added to every series (such as the shard) or None
+    :return: text
+    """
+    labels = labels or dict()
+    lines = list()
+
+    def add(name, kind, description, values):
+        lines.append('# HELP %s_%s %s' % (PREFIX, name, description))
+        lines.append('# TYPE %s_%s %s' % (PREFIX, name, kind))
+        for extra, value in values:
+            series_labels = dict(labels)
+            series_labels.update(extra)
+            lines.append('%s_%s%s %s' % (PREFIX, name, format_labels(series_labels), repr(float(value))))
+
+    timers = sorted(snapshot['timers'].items())
+    add('stage_seconds_total', 'counter', 'Seconds spent in each stage, summed over threads and processes.',
+        [({'stage': name}, timer['seconds']) for name, timer in timers])
+    add('stage_calls_total', 'counter', 'Number of calls of each stage.',
+        [({'stage': name}, timer['calls']) for name, timer in timers])
+    add('stage_max_seconds', 'gauge', 'Longest call of each stage.',
+        [({'stage': name}, timer['max_seconds']) for name, timer in timers])
+    for name, value in sorted(snapshot['counters'].items()):
+        add('%s_total' % name, 'counter', 'Total %s.' % name.replace('_', ' '), [(dict(), value)])
+    add('run_seconds', 'gauge', 'Duration of the run.', [(dict(), seconds)])
+    add('run_success', 'gauge', 'Whether the run completed.', [(dict(), 1 if success else 0)])
+    add('run_timestamp_seconds', 'gauge', 'Time the run ended.', [(dict(), time.time())])
+    return '%s\n' % '\n'.join(lines)
+
+
+def get_summary(snapshot, started, seconds, success, labels=None):
+    """
+    Summarise a run: time per stage, counters and their rates over the run
+    :param snapshot: dictionary returned by Metrics.snapshot
+    :param started: time the run started (seconds since the epoch)
+    :param seconds: duration of the run
+    :param success: whether the run completed
+    :param labels: dictionary of label -> value (such as the shard) or None
+    :return: dictionary
+    """
+    stages = dict()
+    for name, timer in snapshot['timers'].items():
+        stage = dict(timer)
+        stage['mean_seconds'] = timer['seconds'] / timer['calls'] if timer['calls'] else 0.0
+        stages[name] = stage
+    return {'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)), 'seconds': seconds,
+            'success': success, 'labels': labels or dict(), 'stages': stages, 'counters': snapshot['counters'],
+            'rates_per_second': {name: value / seconds if seconds else 0.0
+                                 for name, value in snapshot['counters'].items()}}
+
+
+def write_file(path, text):
+    """Write a file atomically, so that a collector never reads it half written"""
+    path = os.path.expanduser(path)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open('%s.tmp' % path, 'w') as f:
+        f.write(text)
+    os.replace('%s.tmp' % path, path)
+
+
+@contextmanager
+def export_metrics(configuration, labels=None):
+    """
+    Reset the registry and export its metrics when the block ends, even if it raises, as the Prometheus textfile and
+    JSON summary named in the metrics section of the configuration. The stages taking the most time are logged.
+    :param configuration: project configuration
+    :param labels: dictionary of label -> value added to the metrics (such as the shard) or None
+    :return: None
+    """
+    registry.reset()
+    started = time.time()
+    start = default_timer()
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        seconds = default_timer() - start
+        snapshot = registry.snapshot()
+        for name, timer in sorted(snapshot['timers'].items(), key=lambda x: -x[1]['seconds'])[:5]:
+            logger.info('Stage %s: %d calls in %.1f seconds (longest %.1f)' % (name, timer['calls'], timer['seconds'],
+                                                                             timer['max_seconds']))
+        metrics = configuration.get('metrics') or dict()
+        if metrics.get('prometheus_textfile'):
+            write_file(metrics['prometheus_textfile'], to_prometheus(snapshot, seconds, success, labels))
+        if metrics.get('summary'):
+            write_file(metrics['summary'], '%s\n' % json.dumps(get_summary(snapshot, started, seconds, success,
+                                                                            labels), indent=1, sort_keys=True))
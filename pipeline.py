@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Pipeline:
+--------
+
+Stages of worker threads joined by bounded queues, so that network, CPU and upload work overlap. The depth of each
+stage's input queue is sampled while it runs: a stage whose queue stays full is the bottleneck.
+
+"""
+import logging
+import queue
+import threading
+from timeit import default_timer
+
+logger = logging.getLogger(__name__)
+
+END = object()
+
+
+class Stage(object):
+    """
+    Worker threads applying function to the items of a bounded input queue. function returns an iterable of items
+    for the next stage, so that an item can fan out to many items or to none.
+    """
+
+    def __init__(self, name, function, workers=1, queue_size=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.running = workers
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0.0  # seconds spent in function
+        self.blocked = 0.0  # seconds waiting for room in the next stage's queue
+        self.depths = list()
+
+    def get_metrics(self):
+        """
+        Get the metrics of the stage
+        :return: dictionary of metric name -> value
+        """
+        depths = self.depths or [0]
+        return {'stage': self.name, 'workers': self.workers, 'processed': self.processed, 'errors': self.errors,
+                'busy_seconds': self.busy, 'blocked_seconds': self.blocked, 'queue_size': self.queue_size,
+                'mean_queue_depth': sum(depths) / float(len(depths)), 'max_queue_depth': max(depths)}
+
+
+class Pipeline(object):
+    """
+    Stages run in the order they were added, each feeding the next. Items that fail in a stage are logged and
+    dropped, and the first error is raised once all other items have gone through.
+    """
+
+    def __init__(self, sample_interval=1.0):
+        self.stages = list()
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.error = None
+
+    def add_stage(self, name, function, workers=1, queue_size=None):
+        """
+        Add a stage
+        :param name: name of the stage
+        :param function: function taking an item and returning an iterable of items for the next stage
+        :param workers: number of worker threads
+        :param queue_size: maximum number of items waiting for the stage (if None, twice the number of workers)
+        :return: None
+        """
+        if queue_size is None:
+            queue_size = 2 * workers
+        self.stages.append(Stage(name, function, workers, queue_size))
+
+    def work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is END:
+                break
+            start = default_timer()
+            blocked = 0.0
+            try:
+                for output in stage.function(item) or list():
+                    if next_stage is not None:
+                        put_start = default_timer()
+                        next_stage.queue.put(output)
+                        blocked += default_timer() - put_start
+                error = False
+            except Exception as e:
+                logger.exception('Stage %s failed!' % stage.name)
+                error = True
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+            with stage.lock:
+                stage.processed += 1
+                stage.errors += error
+                stage.busy += default_timer() - start - blocked
+                stage.blocked += blocked
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last and next_stage is not None:
+            for _ in range(next_stage.workers):
+                next_stage.queue.put(END)
+
+    def sample(self, stop):
+        while not stop.wait(self.sample_interval):
+            for stage in self.stages:
+                stage.depths.append(stage.queue.qsize())
+
+    def run(self, items):
+        """
+        Feed items through the stages and wait until all are done
+        :param items: iterable of items for the first stage
+        :return: list of metrics per stage
+        """
+        threads = list()
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(index,), daemon=True)
+                thread.start()
+                threads.append(thread)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self.sample, args=(stop,), daemon=True)
+        sampler.start()
+        first_stage = self.stages[0]
+        for item in items:
+            first_stage.queue.put(item)
+        for _ in range(first_stage.workers):
+            first_stage.queue.put(END)
+        for thread in threads:
+            thread.join()
+        stop.set()
+        sampler.join()
+        metrics = self.get_metrics()
+        for stage_metrics in metrics:
+            logger.info('Stage %s: %d items (%d errors), busy %.1fs, blocked %.1fs, queue depth mean %.1f max %d of %d'
+                        % (stage_metrics['stage'], stage_metrics['processed'], stage_metrics['errors'],
+                           stage_metrics['busy_seconds'], stage_metrics['blocked_seconds'],
+                           stage_metrics['mean_queue_depth'], stage_metrics['max_queue_depth'],
+                           stage_metrics['queue_size']))
+        if self.error is not None:
+            raise self.error
+        return metrics
+
+    def get_metrics(self):
+        """
+        Get the metrics of all stages
+        :return: list of dictionaries of metric name -> value
+        """
+        return [stage.get_metrics() for stage in self.stages]
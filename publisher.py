@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Publisher:
+---------
+
+Publishes generated datasets and their showcases to HDX. Resources are created in their final sorted order, their
+files are uploaded concurrently and several datasets can be published at once through a bounded pool.
+
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+
+from hdx.data.dataset import Dataset
+
+from metrics import increment, timer
+
+logger = logging.getLogger(__name__)
+
+
+class Publisher(object):
+    """
+    Publishes datasets, skipping those the manifest (if given) shows are unchanged, and records them in the
+    checkpoint (if given). The files of all datasets being published share resource_workers upload threads. submit
+    publishes in the background with dataset_workers threads, blocking while max_pending datasets are waiting, and
+    close waits for them and raises the first error.
+    """
+
+    def __init__(self, manifest=None, resource_workers=1, dataset_workers=1, max_pending=None, checkpoint=None):
+        self.manifest = manifest
+        self.checkpoint = checkpoint
+        self.resource_executor = ThreadPoolExecutor(max_workers=resource_workers)
+        self.dataset_executor = ThreadPoolExecutor(max_workers=dataset_workers)
+        if max_pending is None:
+            max_pending = 2 * dataset_workers
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.error = None
+
+    def upload_files(self, resources, files):
+        """
+        Upload files to resources concurrently
+        :param resources: list of Resource objects in HDX
+        :param files: dictionary of resource name -> path of file to upload
+        :return: list of futures of the uploads
+        """
+        def upload(resource, path):
+            resource.set_file_to_upload(path)
+            with timer('hdx_upload'):
+                resource.update_in_hdx()
+            increment('uploaded_bytes', os.path.getsize(path))
+
+        return [self.resource_executor.submit(upload, resource, files[resource['name']])
+                for resource in resources if resource['name'] in files]
+
+    def update_resources(self, dataset, names):
+        """
+        Upload the changed resources of a dataset whose metadata is unchanged
+        :param dataset: Dataset
+        :param names: names of the changed resources
+        :return: False if the dataset has to be published in full instead, otherwise True
+        """
+        hdx_dataset = Dataset.read_from_hdx(dataset['name'])
+        if hdx_dataset is None:
+            return False
+        hdx_resources = {x['name']: x for x in hdx_dataset.get_resources()}
+        files = {x['name']: x.get_file_to_upload() for x in dataset.get_resources()}
+        if sorted(hdx_resources) != sorted(files):
+            return False
+        for future in self.upload_files([hdx_resources[name] for name in names], files):
+            future.result()
+        logger.info('Updated resources %s of %s' % (', '.join(names), dataset['name']))
+        return True
+
+    def create_dataset(self, dataset, showcase):
+        """
+        Create or update a dataset and its showcase in HDX. The dataset is saved with its resources in sorted order,
+        new resources with placeholder urls and existing ones with their urls in HDX, so that a failed upload leaves
+        the previous file in place. The files are then uploaded while the showcase is created. Resources are only
+        reordered where an existing dataset had them in another order.
+        :param dataset: Dataset
+        :param showcase: Showcase
+        :return: None
+        """
+        start = default_timer()
+        hdx_dataset = Dataset.read_from_hdx(dataset['name'])
+        urls = dict() if hdx_dataset is None else {x['name']: x['url'] for x in hdx_dataset.get_resources()}
+        resources = dataset.get_resources()
+        resources.sort(key=lambda x: x['name'])
+        files = dict()
+        for resource in resources:
+            path = resource.get_file_to_upload()
+            if path:
+                files[resource['name']] = path
+                resource.file_to_upload = None
+                resource['url'] = urls.get(resource['name'], Dataset.temporary_url)
+        with timer('hdx_create'):
+            dataset.create_in_hdx(remove_additional_resources=True, hxl_update=False)
+        resources = dataset.get_resources()
+        futures = self.upload_files(resources, files)
+        with timer('hdx_showcase'):
+            showcase.create_in_hdx()
+            showcase.add_dataset(dataset)
+        for future in futures:
+            future.result()
+        names = [x['name'] for x in resources]
+        if names != sorted(names):
+            resource_ids = [x['id'] for x in sorted(resources, key=lambda x: x['name'])]
+            with timer('hdx_reorder'):
+                dataset.reorder_resources(resource_ids, hxl_update=False)
+        logger.info('Published %s with %d files in %.1f seconds' % (dataset['name'], len(files),
+                                                                      default_timer() - start))
+
+    def publish(self, dataset, showcase):
+        """
+        Publish a dataset and its showcase unless the manifest shows they are unchanged
+        :param dataset: Dataset
+        :param showcase: Showcase
+        :return: None
+        """
+        self.publish_changes(dataset, showcase)
+        if self.checkpoint is not None:
+            self.checkpoint.published(dataset['name'])
+
+    def publish_changes(self, dataset, showcase):
+        dataset.update_from_yaml()
+        if self.manifest is not None:
+            entry = self.manifest.entry(dataset, showcase)
+            metadata_changed, changed_resources = self.manifest.changes(dataset, entry)
+            if not metadata_changed:
+                if not changed_resources:
+                    logger.info('%s is unchanged - skipping' % dataset['name'])
+                    return
+                if self.update_resources(dataset, changed_resources):
+                    self.manifest.record(dataset, entry)
+                    return
+        self.create_dataset(dataset, showcase)
+        if self.manifest is not None:
+            self.manifest.record(dataset, entry)
+
+    def submit(self, dataset, showcase):
+        """
+        Publish a dataset and its showcase in the background, waiting while too many datasets are pending
+        :param dataset: Dataset
+        :param showcase: Showcase
+        :return: None
+        """
+        self.pending.acquire()
+        try:
+            future = self.dataset_executor.submit(self.publish, dataset, showcase)
+        except Exception:
+            self.pending.release()
+            raise
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        self.pending.release()
+        error = future.exception()
+        if error is not None:
+            logger.error('Publishing failed!', exc_info=error)
+            with self.lock:
+                if self.error is None:
+                    self.error = error
+
+    def close(self):
+        """
+        Wait for all submitted datasets to be published and raise the first error
+        :return: None
+        """
+        self.dataset_executor.shutdown()
+        self.resource_executor.shutdown()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.dataset_executor.shutdown()
+            self.resource_executor.shutdown()
+
+
+def get_publisher(configuration, manifest=None, checkpoint=None):
+    """
+    Create the publisher from the publish section of the configuration
+    :param configuration: project configuration
+    :param manifest: Manifest or None
+    :param checkpoint: Checkpoint or None
+    :return: Publisher
+    """
+    publish = configuration.get('publish') or dict()
+    return Publisher(manifest, resource_workers=publish.get('resource_workers', 1),
+                     dataset_workers=publish.get('dataset_workers', 1), max_pending=publish.get('max_pending'),
+                     checkpoint=checkpoint)
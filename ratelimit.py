@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Rate limiting:
+-------------
+
+Token bucket shared by all requests to the UNESCO API, with exponential backoff when the quota is exceeded.
+
+"""
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from metrics import increment
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+PACE_SECONDS = 0.2
+
+
+def backoff_delay(attempt, base=None, maximum=None, retry_after=None):
+    """
+    Delay before retrying after the quota was exceeded: exponential in the number of attempts with jitter,
+    or the server's Retry-After (plus a little jitter so that waiting workers do not all retry at once)
+    :param attempt: number of consecutive quota errors so far (0 for the first)
+    :param base: delay of the first attempt in seconds (if None, default value is selected)
+    :param maximum: cap on the delay in seconds (if None, default value is selected)
+    :param retry_after: seconds to wait requested by the server or None
+    :return: delay in seconds
+    """
+    if base is None:
+        base = BACKOFF_BASE
+    if maximum is None:
+        maximum = BACKOFF_MAX
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 1)
+    delay = min(maximum, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header given either in seconds or as an HTTP date
+    :param value: header value or None
+    :return: seconds to wait or None if there is no usable value
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_retry_after(error):
+    """
+    Get Retry-After from the HTTP response behind a DownloadError
+    :param error: DownloadError
+    :return: seconds to wait or None
+    """
+    response = getattr(error.__cause__, 'response', None)
+    if response is None:
+        return None
+    return parse_retry_after(response.headers.get('Retry-After'))
+
+
+class RateLimiter(object):
+    """
+    Thread safe token bucket allowing requests_per_second on average with bursts of up to burst requests.
+    After the quota is exceeded, all requests are held back until the backoff delay has passed.
+    """
+
+    def __init__(self, requests_per_second, burst=1, backoff_base=None, backoff_max=None):
+        self.rate = float(requests_per_second)
+        self.burst = max(burst, 1)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()  # lies in the future while backing off
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request may be made
+        :return: seconds waited
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            self.tokens -= 1
+            wait = self.updated - now + max(-self.tokens, 0) / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Hold back all requests after the quota was exceeded
+        :param attempt: number of consecutive quota errors so far (0 for the first)
+        :param retry_after: seconds to wait requested by the server or None
+        :return: delay in seconds
+        """
+        delay = backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after)
+        with self.lock:
+            resume = time.monotonic() + delay
+            if resume > self.updated:
+                self.updated = resume
+                self.tokens = 1.0
+        return delay
+
+
+class RateLimitedDownload(object):
+    """Downloader wrapper that makes every request wait for the rate limiter"""
+
+    def __init__(self, downloader, rate_limiter):
+        self.downloader = downloader
+        self.rate_limiter = rate_limiter
+        self.local = threading.local()
+
+    def download(self, url, *args, **kwargs):
+        wait = self.rate_limiter.acquire()
+        self.local.wait = wait
+        increment('rate_limit_wait_seconds', wait)
+        return self.downloader.download(url, *args, **kwargs)
+
+    def get_wait(self):
+        """
+        Seconds the latest request of the calling thread waited for the rate limiter, so that its latency can be
+        told from its wait
+        :return: seconds waited
+        """
+        return getattr(self.local, 'wait', 0.0)
+
+    def __getattr__(self, name):
+        return getattr(self.downloader, name)
+
+
+def get_rate_limiter(configuration):
+    """
+    Create the rate limiter from the rate_limit section of the configuration. requests_per_second and burst
+    default to those of the subscription_tier.
+    :param configuration: project configuration
+    :return: RateLimiter or None if no rate limit is configured
+    """
+    rate_limit = configuration.get('rate_limit')
+    if not rate_limit:
+        return None
+    tier = rate_limit.get('tiers', dict()).get(rate_limit.get('subscription_tier'), dict())
+    requests_per_second = rate_limit.get('requests_per_second', tier.get('requests_per_second'))
+    if requests_per_second is None:
+        raise ValueError('No requests_per_second for subscription tier %s!' % rate_limit.get('subscription_tier'))
+    burst = rate_limit.get('burst', tier.get('burst', 1))
+    return RateLimiter(requests_per_second, burst,
+                       backoff_base=rate_limit.get('backoff_base'), backoff_max=rate_limit.get('backoff_max'))
+
+
+def pace(downloader):
+    """
+    Pause before the requests of each endpoint of a country as the scraper always has, unless the downloader is rate
+    limited, in which case the rate limiter paces every request
+    :param downloader: Downloader object
+    :return: seconds paused
+    """
+    if getattr(downloader, 'rate_limiter', None) is not None:
+        return 0
+    time.sleep(PACE_SECONDS)
+    return PACE_SECONDS
+
+
+def wait_for_quota(downloader, attempt, retry_after=None):
+    """
+    Back off after the quota was exceeded. A rate limited downloader holds back all workers until the delay has
+    passed, otherwise this sleeps.
+    :param downloader: Downloader object
+    :param attempt: number of consecutive quota errors so far (0 for the first)
+    :param retry_after: seconds to wait requested by the server or None
+    :return: delay in seconds
+    """
+    rate_limiter = getattr(downloader, 'rate_limiter', None)
+    if rate_limiter is None:
+        delay = backoff_delay(attempt, retry_after=retry_after)
+        logger.info('Quota exceeded - sleeping for %d seconds' % delay)
+        time.sleep(delay)
+    else:
+        delay = rate_limiter.backoff(attempt, retry_after)
+        logger.info('Quota exceeded - holding back requests for %d seconds' % delay)
+    increment('quota_exceeded')
+    increment('quota_sleep_seconds', delay)
+    return delay
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Request size:
+------------
+
+Size of data requests learned from the latency of past responses, so that requests are expected to complete within
+a target time.
+
+"""
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MIN_SAMPLES = 5
+
+
+class RequestSizer(object):
+    """
+    Thread safe linear model of the latency of data requests in the number of observations they return (a fixed
+    overhead plus a time per observation) fitted to the latest samples. The number of observations per request is
+    the number expected to take target_seconds, between min_observations and max_observations (the API limit).
+    """
+
+    def __init__(self, target_seconds, max_observations, min_observations=1000, samples=50):
+        self.target_seconds = float(target_seconds)
+        self.max_observations = max_observations
+        self.min_observations = min(min_observations, max_observations)
+        self.samples = deque(maxlen=samples)
+        self.lock = threading.Lock()
+
+    def record(self, observations, seconds):
+        """
+        Record the latency of a data request
+        :param observations: number of observations returned
+        :param seconds: seconds the request took
+        :return: None
+        """
+        with self.lock:
+            self.samples.append((observations, seconds))
+
+    def get_max_observations(self):
+        """
+        Get the number of observations per request expected to take target_seconds
+        :return: maximum number of observations per request
+        """
+        with self.lock:
+            samples = list(self.samples)
+        if len(samples) < MIN_SAMPLES:
+            return self.max_observations
+        observations, seconds = np.array(samples, dtype=float).T
+        if observations.max() > observations.min():
+            per_observation, overhead = np.polyfit(observations, seconds, 1)
+        else:
+            per_observation, overhead = seconds.mean() / max(observations.mean(), 1), 0.0
+        if per_observation <= 0:
+            return self.max_observations
+        size = int((self.target_seconds - max(overhead, 0)) / per_observation)
+        return max(self.min_observations, min(self.max_observations, size))
+
+
+class RequestSizedDownload(object):
+    """Downloader wrapper carrying the request sizer that data downloads report their latency to"""
+
+    def __init__(self, downloader, request_sizer):
+        self.downloader = downloader
+        self.request_sizer = request_sizer
+
+    def download(self, url, *args, **kwargs):
+        return self.downloader.download(url, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.downloader, name)
+
+
+def get_request_sizer(configuration, max_observations):
+    """
+    Create the request sizer from the request_size section of the configuration
+    :param configuration: project configuration
+    :param max_observations: maximum number of observations per request allowed by the API
+    :return: RequestSizer or None if no request size is configured
+    """
+    request_size = configuration.get('request_size')
+    if not request_size:
+        return None
+    return RequestSizer(request_size['target_seconds'], max_observations,
+                        min_observations=request_size.get('min_observations', 1000))
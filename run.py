@@ -4,15 +4,31 @@
 Top level script. Calls other functions that generate datasets that this script then creates in HDX.
 
 """
+import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from os.path import join, expanduser
-from timeit import default_timer
 
 from hdx.hdx_configuration import Configuration
-from hdx.utilities.downloader import Download
+from hdx.location.country import Country
 from hdx.utilities.path import temp_dir
 
-from unesco import generate_dataset_and_showcase, get_countriesdata, get_endpoints_metadata
+from checkpoint import get_checkpoint
+from countryindex import get_country_index
+from fakeckan import setup_fake_ckan
+from httpcache import CachingDownload, SessionDownload, get_cache
+from httptrace import RecordingDownload, get_recorder, get_replay
+from manifest import get_manifest
+from metrics import export_metrics
+from publisher import get_publisher
+from schema import report_coverage
+from ratelimit import RateLimitedDownload, get_rate_limiter
+from requestsize import RequestSizedDownload, get_request_sizer
+from sharding import apply_shard_paths, get_country_weights, load_assignment, merge_reports, parse_shard, \
+    select_shard, write_report
+from unesco import MAX_OBSERVATIONS, create_pipeline, generate_dataset_and_showcase, get_batched_data, \
+    get_countriesdata, get_endpoints_metadata, get_observation_indexes
 
 from hdx.facades.simple import facade
 
@@ -21,32 +37,152 @@ logger = logging.getLogger(__name__)
 lookup = 'hdx-scraper-unesco'
 
 
-def main():
-    """Generate dataset and create it in HDX"""
+def create_country_datasets(downloader, countrydata, endpoints_metadata, folder, fetch_concurrency,
+                            observation_indexes, batched_data, publisher, max_chunk_memory_mb,
+                            stream_chunksize, ingest_format, checkpoint, country_index):
+    """Generate the datasets of one country and submit them to the publisher"""
+    datasets = generate_dataset_and_showcase(downloader, countrydata, endpoints_metadata,
+                                             folder=folder,  # TODO: fix folder
+                                             merge_resources=True, single_dataset=False,
+                                             fetch_concurrency=fetch_concurrency,
+                                             observation_indexes=observation_indexes, batched_data=batched_data,
+                                             max_chunk_memory_mb=max_chunk_memory_mb,
+                                             stream_chunksize=stream_chunksize, ingest_format=ingest_format,
+                                             checkpoint=checkpoint, country_index=country_index)
+    for dataset, showcase in datasets:
+        if dataset:
+            publisher.submit(dataset, showcase)
 
-    base_url = Configuration.read()['base_url']
-    with temp_dir('UNESCO') as folder:
-        with Download(extra_params_yaml=join(expanduser('~'), '.extraparams.yml'), extra_params_lookup=lookup) as downloader:
-            endpoints = Configuration.read()['endpoints']
+
+def main(resume=False, shard=None, merge_shards=None):
+    """Generate dataset and create it in HDX, resuming the last run from its checkpoint if resume is true. With shard
+    (i/N), only the slice of countries of shard i of N is processed. With merge_shards (N), only the reports of N
+    shards are checked for full coverage."""
+
+    configuration = Configuration.read()
+    sharding = configuration.get('sharding') or dict()
+    report_folder = sharding.get('report_folder', join('~', '.cache', 'hdx-scraper-unesco', 'shards'))
+    if merge_shards is not None:
+        merge_reports(report_folder, merge_shards)
+        return
+    temp_folder = 'UNESCO'
+    labels = None
+    if shard is not None:
+        shard, shards = parse_shard(shard)
+        apply_shard_paths(configuration, shard, shards)
+        temp_folder = 'UNESCO-shard-%d-of-%d' % (shard, shards)
+        labels = {'shard': '%d/%d' % (shard, shards)}
+    base_url = configuration['base_url']
+    country_workers = configuration.get('country_workers', 1)
+    fetch_concurrency = configuration.get('fetch_concurrency', 1)
+    max_chunk_memory_mb = configuration.get('max_chunk_memory_mb')
+    stream_chunksize = configuration.get('stream_chunksize')
+    ingest_format = configuration.get('ingest_format', 'csv')
+    manifest = get_manifest(configuration)
+    fake_ckan = setup_fake_ckan(configuration)
+    # With a checkpoint, the temporary folder is kept until the run completes so that it can be resumed
+    with export_metrics(configuration, labels), temp_dir(temp_folder, delete=not configuration.get('checkpoint')) \
+            as folder:
+        checkpoint = get_checkpoint(configuration, folder, resume)
+        # A trace being replayed stands in for the UNESCO API
+        session = get_replay(configuration)
+        if session is None:
+            session = SessionDownload(extra_params_yaml=join(expanduser('~'), '.extraparams.yml'), extra_params_lookup=lookup)
+        with session as downloader:
+            recorder = get_recorder(configuration)
+            if recorder is not None:
+                downloader = RecordingDownload(downloader, recorder)
+            rate_limiter = get_rate_limiter(configuration)
+            if rate_limiter is not None:
+                downloader = RateLimitedDownload(downloader, rate_limiter)
+            request_sizer = get_request_sizer(configuration, MAX_OBSERVATIONS)
+            if request_sizer is not None:
+                downloader = RequestSizedDownload(downloader, request_sizer)
+            cache = get_cache(configuration)
+            if cache is not None:
+                downloader = CachingDownload(downloader, cache)
+            endpoints = configuration['endpoints']
             endpoints_metadata = get_endpoints_metadata(base_url, downloader, endpoints)
+            report_coverage(endpoints_metadata)
             countriesdata = get_countriesdata(base_url, downloader)
+            country_index = get_country_index(configuration)
+            if country_index is not None:
+                country_index.update(countriesdata)
+
+            observation_indexes = None
+            batched_data = None
+            weighted = sharding.get('mode', 'weighted') == 'weighted'
+            if configuration.get('observation_index') or configuration.get('batch_requests') or \
+                    (shard is not None and weighted):
+                observation_indexes = get_observation_indexes(endpoints_metadata)
+            if shard is not None:
+                allcountriesdata = countriesdata
+                weights = None
+                assignment = None
+                if weighted:
+                    weights = get_country_weights(countriesdata, observation_indexes)
+                    assignment = load_assignment(report_folder, shards, weights)
+                countriesdata = select_shard(countriesdata, shard, shards, assignment=assignment)
+                logger.info('Shard %d/%d has %d of %d countries' % (shard, shards, len(countriesdata),
+                                                                     len(allcountriesdata)))
 
             logger.info('Number of datasets to upload: %d' % len(countriesdata))
 
-            for countrydata in countriesdata:
-                for dataset, showcase in generate_dataset_and_showcase(downloader, countrydata, endpoints_metadata, folder=folder, merge_resources=True, single_dataset=False): # TODO: fix folder
-                    if dataset:
-                        dataset.update_from_yaml()
-                        start = default_timer()
-                        dataset.create_in_hdx(remove_additional_resources=True, hxl_update=False)
-                        print("total time = %d" % (default_timer() - start))
-                        resources = dataset.get_resources()
-                        resource_ids = [x['id'] for x in sorted(resources, key=lambda x: x['name'], reverse=False)]
-                        dataset.reorder_resources(resource_ids, hxl_update=False)
-                        showcase.create_in_hdx()
-                        showcase.add_dataset(dataset)
+            if configuration.get('batch_requests'):
+                batchcountriesdata = countriesdata
+                if checkpoint is not None:
+                    batchcountriesdata = checkpoint.pending(countriesdata, endpoints_metadata)
+                batched_data = get_batched_data(downloader, endpoints_metadata, observation_indexes, batchcountriesdata,
+                                                folder, concurrency=fetch_concurrency, chunksize=stream_chunksize,
+                                                ingest_format=ingest_format)
 
+            # Load the country lookup once here rather than racing to do it in the worker threads
+            Country.countriesdata()
+            pipeline_configuration = configuration.get('pipeline')
+            with get_publisher(configuration, manifest, checkpoint) as publisher:
+                if pipeline_configuration:
+                    process_workers = pipeline_configuration.get('process_workers', 1)
+                    with ProcessPoolExecutor(max_workers=process_workers) as executor:
+                        pipeline = create_pipeline(downloader, endpoints_metadata, folder, publisher.publish,
+                                                   executor=executor,
+                                                   download_workers=pipeline_configuration.get('download_workers', 1),
+                                                   process_workers=process_workers,
+                                                   write_workers=pipeline_configuration.get('write_workers', 1),
+                                                   publish_workers=pipeline_configuration.get('publish_workers', 1),
+                                                   queue_size=pipeline_configuration.get('queue_size'),
+                                                   fetch_concurrency=fetch_concurrency,
+                                                   observation_indexes=observation_indexes, batched_data=batched_data,
+                                                   max_chunk_memory_mb=max_chunk_memory_mb,
+                                                   stream_chunksize=stream_chunksize, ingest_format=ingest_format,
+                                                   checkpoint=checkpoint, country_index=country_index)
+                        pipeline.run(countriesdata)
+                else:
+                    with ThreadPoolExecutor(max_workers=country_workers) as executor:
+                        futures = [executor.submit(create_country_datasets, downloader, countrydata,
+                                                   endpoints_metadata, folder, fetch_concurrency, observation_indexes,
+                                                   batched_data, publisher, max_chunk_memory_mb, stream_chunksize,
+                                                   ingest_format, checkpoint, country_index)
+                                   for countrydata in countriesdata]
+                        for future in futures:
+                            future.result()
+            if fake_ckan is not None:
+                metrics = fake_ckan.get_metrics()
+                logger.info('Fake HDX: %d datasets, %d resources, %d calls %s, %.1f MB uploaded in %.1f seconds'
+                            % (metrics['datasets'], metrics['resources'], sum(metrics['calls'].values()),
+                               metrics['calls'], metrics['uploaded_bytes'] / 1024.0 / 1024.0, metrics['seconds']))
+            if recorder is not None:
+                recorder.close()
+            if cache is not None:
+                cache.close()
+            if shard is not None:
+                write_report(report_folder, shard, shards, allcountriesdata, countriesdata, weights)
+        if checkpoint is not None:
+            checkpoint.finish()
 
 if __name__ == '__main__':
-    facade(main, user_agent_config_yaml=join(expanduser('~'), '.useragents.yml'), user_agent_lookup=lookup, project_config_yaml=join('config', 'project_configuration.yml'))
-
+    parser = argparse.ArgumentParser(description='UNESCO scraper')
+    parser.add_argument('--resume', action='store_true', help='resume the last run from its checkpoint')
+    parser.add_argument('--shard', help='process only the countries of shard i of N given as i/N (i from 0)')
+    parser.add_argument('--merge-shards', type=int, metavar='N', help='check that N shards covered all countries')
+    args = parser.parse_args()
+    facade(partial(main, resume=args.resume, shard=args.shard, merge_shards=args.merge_shards), user_agent_config_yaml=join(expanduser('~'), '.useragents.yml'), user_agent_lookup=lookup, project_config_yaml=join('config', 'project_configuration.yml'))
@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Schema:
+------
+
+Column labels, HXL tags and the columns whose CODE:Label values are split, parsed once at import from the tables
+below into frozen lookups. The dimensions of the endpoints are checked against the tables, so that those the tables
+do not cover are reported with their names from the data structure.
+
+"""
+import logging
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+COLUMN_LABELS = """
+AGE                Age
+COUNTRY_ORIGIN     Country / region of origin
+REGION_DEST        Destination region
+EDU_FIELD          Field of education
+FUND_FLOW          Funding flow
+GRADE              Grade
+IMM_STATUS         Immigration status
+INFRASTR           Infrastructure
+EDU_LEVEL          Level of education
+EDU_ATTAIN         Level of educational attainment
+LOCATION           Location
+REF_AREA           Reference area
+SUBJECT            Subject
+SEX                Sex
+SE_BKGRD           Socioeconomic background
+STAT_UNIT          Statistical unit
+TEACH_EXPERIENCE   Teaching experience
+TIME_PERIOD        Time Period
+CONTRACT_TYPE      Type of contract
+EDU_TYPE           Type of education
+EXPENDITURE_TYPE   Type of expenditure
+UNIT_MEASURE       Unit of measure
+WEALTH_QUINTILE    Wealth quintile
+"""
+
+SPLIT_COLUMNS = """
+Age
+AGE
+Country / region of origin
+COUNTRY_ORIGIN
+Destination region
+REGION_DEST
+Field of education
+EDU_FIELD
+Funding flow
+FUND_FLOW
+Grade
+GRADE
+Immigration status
+IMM_STATUS
+Infrastructure
+INFRASTR
+Level of education
+EDU_LEVEL
+Level of educational attainment
+EDU_ATTAIN
+Location
+LOCATION
+Orientation
+Reference area
+REF_AREA
+School subject
+SUBJECT
+Sex
+SEX
+Socioeconomic background
+SE_BKGRD
+Source of funding
+Statistical unit
+STAT_UNIT
+Teaching experience
+TEACH_EXPERIENCE
+Time Period
+TIME_PERIOD
+Type of contract
+CONTRACT_TYPE
+Type of education
+EDU_TYPE
+Type of expenditure
+EXPENDITURE_TYPE
+Type of institution
+Unit of measure
+UNIT_MEASURE
+Wealth quintile
+WEALTH_QUINTILE
+"""
+
+# Columns without a tag are known and deliberately left untagged
+HXL_TAGS = """
+Age                                        #group+age
+Country / region of origin                 #country+origin
+Destination region                         #region+destination
+Field of education                         #indicator+education+field+name
+Funding flow                               #indicator+funding+flow+name
+Grade                                      #indicator+grade
+Immigration status                         #indicator+immigration+status
+Infrastructure                             #indicator+infrastructure
+Level of education                         #group+education+level
+Level of educational attainment            #group+education+level+attainment
+Location                                   #geo+location+type
+Orientation                                #indicator+orientation
+Reference area                             #geo+reference+area
+School subject                             #indicator+school+subject+name
+Sex                                        #group+sex
+Socioeconomic background                   #group+socioeconomic+background
+Source of funding                          #indicator+funding+source
+Statistical unit                           #indicator+statistical+unit
+Teaching experience                        #indicator+teaching+experience
+Time Period                                #date
+Type of contract                           #indicator+contract+name
+Type of education                          #indicator+education+type+name
+Type of expenditure                        #indicator+expenditure+type+name
+Type of institution                        #indicator+institution+type+name
+Unit of measure                            #meta+unit+measure+name
+Wealth quintile                            #indicator+wealth+quintile+name
+
+AGE                                        #group+age
+BASIC_SERVICES                             #indicator+basic+services
+CONTRACT_TYPE                              #indicator+contract+name
+CLASS_TYPE                                 #indicator+class+name
+COUNTRY_ORIGIN                             #country+origin
+EDU_ATTAIN                                 #group+education+level+attainment
+EDU_CAT                                    #indicator+education+category+name
+EDU_FIELD                                  #indicator+education+field+name
+EDU_LEVEL                                  #group+education+level
+EDU_TYPE                                   #indicator+education+type+name
+FUND_FLOW                                  #indicator+funding+flow+name
+GRADE                                      #indicator+grade
+IMM_STATUS                                 #indicator+immigration+status
+INFRASTR                                   #indicator+infrastructure
+FREQ                                       #indicator+frequency
+LOCATION                                   #geo+location+type
+REF_AREA                                   #geo+reference+area
+REGION_DEST                                #region+destination
+SUBJECT                                    #indicator+school+subject+name
+SECTOR_EDU                                 #indicator+sector+name
+SEX                                        #group+sex
+SE_BKGRD                                   #group+socioeconomic+background
+SOURCE_FUND                                #indicator+funding+source
+STAT_UNIT                                  #indicator+statistical+unit
+TEACH_EXPERIENCE                           #indicator+teaching+experience
+TIME_PERIOD                                #date
+EXPENDITURE_TYPE                           #indicator+expenditure+type+name
+UNIT_MEASURE                               #meta+unit+measure+name
+UNIT_MULT                                  #meta+unit+mult+name
+DECIMALS                                   #meta+decimals
+WEALTH_QUINTILE                            #indicator+wealth+quintile+name
+DISPERSION
+OBS_STATUS
+TEXTB_TYPE
+"""
+
+
+def parse_labels(table):
+    """
+    Parse lines of a column id followed by its label
+    :param table: string
+    :return: dictionary column id -> label
+    """
+    labels = dict()
+    for row in table.split('\n'):
+        words = row.split()
+        if len(words) >= 2:
+            labels[words[0]] = ' '.join(words[1:])
+    return labels
+
+
+def parse_split_columns(table):
+    """
+    Parse lines of a column id or label
+    :param table: string
+    :return: tuple of columns in the order of the table
+    """
+    return tuple(x.strip() for x in table.split('\n') if x.strip())
+
+
+def parse_hxl_tags(table):
+    """
+    Parse lines of a column id or label followed by its HXL tag, or by nothing if it has none
+    :param table: string
+    :return: (dictionary column -> HXL tag in the order of the table, set of columns without a tag)
+    """
+    hxltags = dict()
+    untagged = set()
+    for row in table.split('\n'):
+        v = row.split('#')
+        column = v[0].strip()
+        if len(v) == 2:
+            hxltags[column] = '#%s' % v[1].strip()
+        elif len(v) == 1 and column:
+            untagged.add(column)
+    return hxltags, untagged
+
+
+def default_label(column):
+    """
+    Label of a column missing from the tables: its id in lower case with spaces, capitalised
+    :param column: column id
+    :return: label
+    """
+    label = column.lower().replace('_', ' ')
+    return label[0].upper() + label[1:]
+
+
+class Schema(object):
+    """
+    Frozen lookups of the label and HXL tag of a column and whether its CODE:Label values are split. Columns are
+    looked up by id or label, as the tables hold both.
+    """
+
+    def __init__(self, labels, split_columns, hxltags, untagged):
+        self.labels = MappingProxyType(dict(labels))
+        self.split_columns = tuple(split_columns)
+        self.split_set = frozenset(self.split_columns)
+        self.hxltags = MappingProxyType(dict(hxltags))
+        self.untagged = frozenset(untagged)
+
+    def get_label(self, column):
+        """
+        Label of a column
+        :param column: column id
+        :return: label
+        """
+        label = self.labels.get(column)
+        if label is None:
+            label = default_label(column)
+        return label
+
+    def get_hxl_tag(self, column):
+        """
+        HXL tag of a column
+        :param column: column id or label
+        :return: HXL tag or None
+        """
+        return self.hxltags.get(column)
+
+    def is_split(self, column):
+        """
+        Whether the CODE:Label values of a column are split into code and label
+        :param column: column id or label
+        :return: bool
+        """
+        return column in self.split_set
+
+    def get_split_columns(self, columns):
+        """
+        Columns to split among those given, in the order of the table
+        :param columns: column names
+        :return: list of columns
+        """
+        columns = set(columns)
+        return [x for x in self.split_columns if x in columns]
+
+    def get_hxl_tags(self, columns, code_column_postfix=' code'):
+        """
+        HXL tags of the columns that have one, code columns getting their column's tag with +code
+        :param columns: column names
+        :param code_column_postfix: postfix of code columns
+        :return: dictionary column name -> HXL tag
+        """
+        columns = set(columns)
+        hxl = dict()
+        for column, tag in self.hxltags.items():
+            if column in columns:
+                hxl[column] = tag
+            if column + code_column_postfix in columns:
+                hxl[column + code_column_postfix] = '%s+code' % tag
+        return hxl
+
+    def get_coverage(self, dimensions):
+        """
+        Dimensions that the tables do not cover by id
+        :param dimensions: dimensions of an endpoint from its data structure
+        :return: dictionary with lists of "id (name)" of the dimensions labelled from their id ("unlabelled"),
+                 without an HXL tag ("untagged") and whose values are not split although their name is ("unsplit")
+        """
+        coverage = {'unlabelled': list(), 'untagged': list(), 'unsplit': list()}
+        for dimension in dimensions:
+            column = dimension['id']
+            name = dimension.get('name')
+            description = column if not name else '%s (%s)' % (column, name)
+            if column not in self.labels:
+                coverage['unlabelled'].append(description)
+            if column not in self.hxltags and column not in self.untagged:
+                coverage['untagged'].append(description)
+            if column not in self.split_set and name in self.split_set:
+                coverage['unsplit'].append(description)
+        return coverage
+
+
+SCHEMA = Schema(parse_labels(COLUMN_LABELS), parse_split_columns(SPLIT_COLUMNS), *parse_hxl_tags(HXL_TAGS))
+
+
+def report_coverage(endpoints_metadata):
+    """
+    Log the dimensions of each endpoint that the tables do not cover
+    :param endpoints_metadata: dictionary endpoint -> (indicator, structure url, more info url, dimensions)
+    :return: dictionary endpoint -> coverage
+    """
+    coverage = dict()
+    for endpoint, (_, _, _, dimensions) in sorted(endpoints_metadata.items()):
+        coverage[endpoint] = SCHEMA.get_coverage(dimensions)
+        for key, description in (('unlabelled', 'labelled from their id'), ('untagged', 'without an HXL tag'),
+                                 ('unsplit', 'whose values are not split by id')):
+            if coverage[endpoint][key]:
+                logger.warning('%s: dimensions %s: %s' % (endpoint, description, ', '.join(coverage[endpoint][key])))
+    return coverage
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Sharding:
+--------
+
+Splitting the countries between several processes (shards) that each run the scraper on a disjoint slice, either by
+a stable hash of the country ISO2 code or balanced by the expected work of each country. Every shard writes a
+report of the countries it covered on completion, and merging the reports checks that together they covered every
+country exactly once. A balanced split is computed once per run by the first shard and shared with the others
+through the report folder, so that shards seeing different observation counts still split the countries the same way.
+
+"""
+import hashlib
+import heapq
+import json
+import logging
+import os
+from os.path import dirname, exists, join, splitext
+from tempfile import mkstemp
+
+from countryindex import is_aggregate
+from unesco import MAX_OBSERVATIONS
+
+logger = logging.getLogger(__name__)
+
+REQUEST_COST = 1000  # observations taking as long to download as the overhead of one request
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as i/N where i is from 0 to N-1
+    :param value: shard string
+    :return: (shard, number of shards)
+    """
+    try:
+        shard, shards = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise ValueError('Shard %s is not of the form i/N!' % value)
+    if shards < 1 or not 0 <= shard < shards:
+        raise ValueError('Shard %s must be from 0/N to N-1/N!' % value)
+    return shard, shards
+
+
+def hash_shard(countryiso2, shards):
+    """
+    Shard of a country by a hash of its ISO2 code that is the same in every process
+    :param countryiso2: country ISO2
+    :param shards: number of shards
+    :return: shard
+    """
+    return int(hashlib.sha1(countryiso2.encode('utf-8')).hexdigest(), 16) % shards
+
+
+def get_country_weights(countriesdata, observation_indexes, max_observations=None, request_cost=REQUEST_COST):
+    """
+    Expected work of each country: its number of observations over all endpoints plus a cost per data request.
+    Aggregates are not processed so have no weight.
+    :param countriesdata: list of country datastructures from UNESCO API
+    :param observation_indexes: dictionary of endpoint -> ObservationIndex
+    :param max_observations: maximum number of observations per request (if None, the API limit rather than a
+    learned size, so that every shard computes the same weights)
+    :param request_cost: observations taking as long to download as the overhead of one request
+    :return: dictionary of country ISO2 -> weight
+    """
+    if max_observations is None:
+        max_observations = MAX_OBSERVATIONS
+    weights = dict()
+    for countrydata in countriesdata:
+        countryiso2 = countrydata['id']
+        weight = 0
+        if not is_aggregate(countrydata['names'][0]['value']):
+            for observation_index in observation_indexes.values():
+                observations = observation_index.get_observations(countryiso2)
+                if observations:
+                    requests = -(-observations // max_observations)
+                    weight += observations + requests * request_cost
+        weights[countryiso2] = weight
+    return weights
+
+
+def split_weighted(weights, shards):
+    """
+    Assign countries to shards, heaviest first to the least loaded shard, so that shards get similar total weights.
+    Ties are broken by ISO2 code and shard number so that every process computes the same split.
+    :param weights: dictionary of country ISO2 -> weight
+    :param shards: number of shards
+    :return: dictionary of country ISO2 -> shard
+    """
+    loads = [(0, shard) for shard in range(shards)]
+    assignment = dict()
+    for countryiso2, weight in sorted(weights.items(), key=lambda x: (-x[1], x[0])):
+        load, shard = heapq.heappop(loads)
+        assignment[countryiso2] = shard
+        heapq.heappush(loads, (load + weight, shard))
+    return assignment
+
+
+def select_shard(countriesdata, shard, shards, weights=None, assignment=None):
+    """
+    Get the countries of a shard
+    :param countriesdata: list of country datastructures from UNESCO API
+    :param shard: shard
+    :param shards: number of shards
+    :param weights: dictionary of country ISO2 -> weight to balance shards by (if None, split by hash)
+    :param assignment: dictionary of country ISO2 -> shard used instead of weights, countries missing from it being
+    split by hash
+    :return: list of country datastructures
+    """
+    if assignment is None and weights is not None:
+        assignment = split_weighted(weights, shards)
+    if assignment is None:
+        assignment = dict()
+    return [countrydata for countrydata in countriesdata
+            if assignment.get(countrydata['id'], hash_shard(countrydata['id'], shards)) == shard]
+
+
+def get_assignment_path(folder, shards):
+    return join(os.path.expanduser(folder), 'assignment-%d.json' % shards)
+
+
+def load_assignment(folder, shards, weights):
+    """
+    Get the assignment of countries to shards shared by the shards of a run. The first shard to get here writes the
+    split of its weights to the report folder and the others read it, whatever weights they computed. The
+    assignment is removed when merge_reports finds that the run covered every country.
+    :param folder: folder of the shard reports
+    :param shards: number of shards
+    :param weights: dictionary of country ISO2 -> weight
+    :return: dictionary of country ISO2 -> shard
+    """
+    path = get_assignment_path(folder, shards)
+    if not exists(path):
+        os.makedirs(dirname(path), exist_ok=True)
+        fd, temp_path = mkstemp(dir=dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(split_weighted(weights, shards), f, indent=1, sort_keys=True)
+        try:
+            os.link(temp_path, path)  # fails if another shard wrote it first
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(path) as f:
+        assignment = json.load(f)
+    missing = [countryiso2 for countryiso2 in sorted(weights) if countryiso2 not in assignment]
+    if missing:
+        logger.warning('Countries split by hash as they are not in the shared assignment: %s' % ', '.join(missing))
+    return assignment
+
+
+def shard_path(path, shard, shards):
+    """
+    Path of a file or folder specific to a shard
+    :param path: path
+    :param shard: shard
+    :param shards: number of shards
+    :return: path with the shard inserted before any extension
+    """
+    root, extension = splitext(path)
+    return '%s-shard-%d-of-%d%s' % (root, shard, shards, extension)
+
+
+def apply_shard_paths(configuration, shard, shards):
+    """
+    Give a shard its own manifest, checkpoint and HTTP cache, whose files are not safe to share between processes,
+    and its own metrics files and recorded trace
+    :param configuration: project configuration
+    :param shard: shard
+    :param shards: number of shards
+    :return: None
+    """
+    for key in ('manifest', 'checkpoint'):
+        if configuration.get(key):
+            configuration[key] = shard_path(configuration[key], shard, shards)
+    http_cache = configuration.get('http_cache')
+    if http_cache and http_cache.get('folder'):
+        http_cache['folder'] = shard_path(http_cache['folder'], shard, shards)
+    for section, keys in (('metrics', ('prometheus_textfile', 'summary')), ('trace', ('record',))):
+        paths = configuration.get(section)
+        for key in keys:
+            if paths and paths.get(key):
+                paths[key] = shard_path(paths[key], shard, shards)
+
+
+def get_report_path(folder, shard, shards):
+    return join(os.path.expanduser(folder), 'shard-%d-of-%d.json' % (shard, shards))
+
+
+def write_report(folder, shard, shards, countriesdata, selected, weights=None):
+    """
+    Write the report of a completed shard
+    :param folder: folder of the shard reports
+    :param shard: shard
+    :param shards: number of shards
+    :param countriesdata: list of all country datastructures
+    :param selected: list of the country datastructures of the shard
+    :param weights: dictionary of country ISO2 -> weight or None
+    :return: None
+    """
+    path = get_report_path(folder, shard, shards)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    countries = [countrydata['id'] for countrydata in selected]
+    report = {'shard': shard, 'shards': shards,
+              'countries': sorted(countrydata['id'] for countrydata in countriesdata), 'covered': sorted(countries),
+              'weight': None if weights is None else sum(weights.get(countryiso2, 0) for countryiso2 in countries)}
+    with open('%s.tmp' % path, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace('%s.tmp' % path, path)
+    logger.info('Shard %d/%d covered %d countries' % (shard, shards, len(countries)))
+
+
+def merge_reports(folder, shards):
+    """
+    Check that the reports of all shards together cover every country exactly once, then remove the shared
+    assignment of the run
+    :param folder: folder of the shard reports
+    :param shards: number of shards
+    :return: dictionary with the number of countries and the weight of each shard
+    """
+    problems = list()
+    reports = list()
+    for shard in range(shards):
+        path = get_report_path(folder, shard, shards)
+        if not exists(path):
+            problems.append('Shard %d/%d has not completed' % (shard, shards))
+            continue
+        with open(path) as f:
+            reports.append(json.load(f))
+    countries = set()
+    covered = dict()
+    for report in reports:
+        if countries and set(report['countries']) != countries:
+            problems.append('Shard %d/%d saw a different list of countries' % (report['shard'], shards))
+        countries.update(report['countries'])
+        for countryiso2 in report['covered']:
+            if countryiso2 in covered:
+                problems.append('%s covered by shards %d and %d' % (countryiso2, covered[countryiso2],
+                                                                    report['shard']))
+            covered[countryiso2] = report['shard']
+    missing = sorted(countries - set(covered))
+    if missing:
+        problems.append('Countries not covered: %s' % ', '.join(missing))
+    if problems:
+        raise ValueError('Shards do not cover all countries exactly once!\n%s' % '\n'.join(problems))
+    weights = [report['weight'] for report in sorted(reports, key=lambda x: x['shard'])]
+    if exists(get_assignment_path(folder, shards)):
+        os.remove(get_assignment_path(folder, shards))  # the next run splits the countries afresh
+    logger.info('%d shards covered all %d countries. Weights: %s' % (shards, len(countries), weights))
+    return {'countries': len(countries), 'weights': weights}
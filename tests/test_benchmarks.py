@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of the DataFrame transforms, run with pytest-benchmark. Frames are scaled from the EDU_FINANCE fixture
+to UNESCO_BENCHMARK_ROWS rows (comma separated, default 100000 as for an endpoint of a country, for example
+100000,1000000,10000000) with few or many STAT_UNIT values. The peak memory of each transform is measured with
+tracemalloc, saved with its timings and checked against the baseline.
+
+'''
+import json
+import os
+import tracemalloc
+from os.path import join
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from unesco import chunk_years, expand_column_labels, get_dimension_columns, get_hxl_tags, process_df, \
+    remove_useless_columns_from_df, split_columns_df, split_df_by_column
+
+ROWS = [int(x) for x in os.environ.get('UNESCO_BENCHMARK_ROWS', '100000').split(',')]
+STAT_UNITS = {'few': 3, 'many': 300}
+MEMORY_TOLERANCE = 1.1  # peak memory above the baseline's by more than this factor fails
+BASELINE_PATH = join('tests', 'fixtures', 'benchmark_baseline.json')
+
+
+def scale_fixture(rows, stat_units, seed=0):
+    """
+    Tile the EDU_FINANCE fixture to rows rows with CODE:Label dimension values read as categories, as downloaded,
+    spreading them over stat_units STAT_UNIT values, 50 years and 200 countries, with a tenth of the values blank
+    :param rows: number of rows
+    :param stat_units: number of STAT_UNIT values
+    :param seed: seed of the random values
+    :return: DataFrame
+    """
+    fixture = pd.read_csv(join('tests', 'fixtures', 'EDU_FINANCE.csv'), dtype=str)
+    rng = np.random.RandomState(seed)
+    df = fixture.iloc[np.arange(rows) % len(fixture)].reset_index(drop=True)
+    df['STAT_UNIT'] = ['SU%d' % x for x in rng.randint(0, stat_units, rows)]
+    df['REF_AREA'] = ['C%d' % x for x in rng.randint(0, 200, rows)]
+    dimensions = [{'id': c} for c in fixture.columns if c not in ('TIME_PERIOD', 'OBS_VALUE')][:11]
+    for c in get_dimension_columns(dimensions):
+        df[c] = pd.Categorical(df[c] + ':Label of ' + df[c])
+    df['TIME_PERIOD'] = 1970 + rng.randint(0, 50, rows)
+    values = rng.uniform(0, 1000, rows)
+    values[rng.uniform(0, 1, rows) < 0.1] = np.nan
+    df['OBS_VALUE'] = values
+    return df
+
+
+def get_baseline():
+    """
+    Read the peak memory of each benchmark from the pytest-benchmark JSON named by UNESCO_BENCHMARK_BASELINE, or
+    else from the baseline committed in tests/fixtures (at 100000 rows)
+    :return: dictionary of benchmark name -> peak memory in MB
+    """
+    path = os.environ.get('UNESCO_BENCHMARK_BASELINE')
+    if not path:
+        with open(BASELINE_PATH) as f:
+            return json.load(f)
+    with open(path) as f:
+        return {x['name']: x['extra_info'].get('peak_mb') for x in json.load(f)['benchmarks']}
+
+
+BASELINE = get_baseline()
+
+
+@pytest.fixture(scope='module', params=[(rows, stat_units) for rows in ROWS for stat_units in sorted(STAT_UNITS)],
+                ids=lambda x: '%d-%s' % x)
+def frame(request):
+    rows, stat_units = request.param
+    return scale_fixture(rows, STAT_UNITS[stat_units])
+
+
+@pytest.fixture(scope='module')
+def processed(frame):
+    return process_df(frame)[0]
+
+
+def run(benchmark, request, function, *args):
+    """
+    Measure the peak memory of a call of function, then benchmark it, failing if the peak memory grew beyond that
+    of the baseline
+    :return: result of function
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    peak_mb = peak / 1024.0 / 1024.0
+    benchmark.extra_info['peak_mb'] = peak_mb
+    rounds = 10 if len(args[0]) <= 100000 else 3
+    result = benchmark.pedantic(function, args=args, rounds=rounds, iterations=1)
+    baseline = BASELINE.get(request.node.name)
+    if baseline is not None:
+        assert peak_mb <= baseline * MEMORY_TOLERANCE + 1, 'Peak memory %.1f MB exceeds baseline %.1f MB' % \
+                                                            (peak_mb, baseline)
+    return result
+
+
+class TestBenchmarks:
+    def test_split_columns_df(self, benchmark, request, frame):
+        df = run(benchmark, request, split_columns_df, frame)
+        assert len(df) == len(frame)
+
+    def test_process_df(self, benchmark, request, frame):
+        df, _ = run(benchmark, request, process_df, frame)
+        assert len(df) == frame['OBS_VALUE'].notna().sum()
+
+    def test_get_hxl_tags(self, benchmark, request, processed):
+        hxltags = run(benchmark, request, lambda df: get_hxl_tags(df.columns), processed)
+        assert hxltags['OBS_VALUE'] == '#indicator+value+num'
+
+    def test_split_df_by_column(self, benchmark, request, processed):
+        parts = run(benchmark, request, lambda df: list(split_df_by_column(df, 'STAT_UNIT')), processed)
+        assert sum(len(df) for _, df in parts) == len(processed)
+
+    def test_remove_useless_columns_from_df(self, benchmark, request, processed):
+        df = run(benchmark, request, remove_useless_columns_from_df, processed)
+        assert len(df) == len(processed)
+
+    def test_expand_column_labels(self, benchmark, request, processed):
+        df = run(benchmark, request, expand_column_labels, processed)
+        assert 'Statistical unit' in df.columns
+
+    def test_chunk_years(self, benchmark, request, frame):
+        countries = frame.groupby('REF_AREA', observed=True)['TIME_PERIOD'].value_counts()
+        time_periods = [{year: count * 100 for (_, year), count in group.items()}
+                        for _, group in countries.groupby(level=0)]
+        periods = run(benchmark, request, lambda x: [list(chunk_years(y, 29990)) for y in x], time_periods)
+        assert len(periods) == len(time_periods)
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the country index.
+
+'''
+from os.path import join
+
+from hdx.location.country import Country
+from hdx.utilities.path import temp_dir
+
+from countryindex import CountryIndex, get_country_index
+from unesco import get_country
+
+
+def countrydata(countryiso2, countryname):
+    return {'id': countryiso2, 'names': [{'value': countryname}]}
+
+
+COUNTRIESDATA = [countrydata('AF', 'Afghanistan'), countrydata('XK', 'Kosovo'),
+                 countrydata('40334', 'SDG: Africa (Northern)'), countrydata('ZZ', 'Nowhere')]
+
+
+class TestCountryIndex:
+    def test_country_index(self, monkeypatch):
+        calls = list()
+        fuzzy = Country.get_iso3_country_code_fuzzy
+
+        def get_iso3_country_code_fuzzy(countryname, **kwargs):
+            calls.append(countryname)
+            return fuzzy(countryname, **kwargs)
+
+        monkeypatch.setattr(Country, 'get_iso3_country_code_fuzzy', get_iso3_country_code_fuzzy)
+        with temp_dir('UNESCO-countryindex-test') as folder:
+            configuration = {'country_index': {'path': join(folder, 'countries.json'),
+                                               'overrides': join(folder, 'overrides.yml')}}
+            country_index = get_country_index(configuration)
+            assert country_index.update(COUNTRIESDATA) == 4
+            assert sorted(calls) == ['Kosovo', 'Nowhere']
+            assert get_country(COUNTRIESDATA[0], country_index) == ('AF', 'Afghanistan', 'AFG')
+            assert get_country(COUNTRIESDATA[2], country_index) is None
+            assert country_index.resolve('40334', 'SDG: Africa (Northern)')['aggregate'] is True
+
+            calls.clear()
+            country_index = get_country_index(configuration)
+            assert country_index.update(COUNTRIESDATA) == 0
+            assert country_index.update(COUNTRIESDATA[:1] + [countrydata('XK', 'Kosovo (UNSCR 1244)')]) == 1
+            assert calls == ['Kosovo (UNSCR 1244)']
+            with open(configuration['country_index']['path']) as f:
+                assert '"XK"' in f.read()
+
+            with open(configuration['country_index']['overrides'], 'w') as f:
+                f.write('XK: XKX\nAF: null\n')
+            country_index = get_country_index(configuration)
+            assert get_country(countrydata('XK', 'Kosovo'), country_index) == ('XK', 'Kosovo', 'XKX')
+            assert get_country(COUNTRIESDATA[0], country_index) is None
+            assert CountryIndex().resolve('AF', 'Afghanistan')['match'] == 'iso2'
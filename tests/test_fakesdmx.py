@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the fake SDMX API.
+
+'''
+import pytest
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+
+import ratelimit
+from fakesdmx import FakeSDMX, SyntheticData
+from unesco import download_endpoint, get_batched_data, get_countriesdata, get_endpoints_metadata, \
+    get_observation_indexes, load_safely, plan_endpoint
+
+
+class TestFakeSDMX:
+    @pytest.fixture(scope='class')
+    def data(self):
+        return SyntheticData(countries=6, endpoints=['EDU_FINANCE', 'SDG4'], dimensions=2, values_per_dimension=3,
+                             observations=100, empty_fraction=0.3)
+
+    @pytest.fixture(scope='function')
+    def downloader(self):
+        with Download(user_agent='test') as downloader:
+            yield downloader
+
+    def test_scraper(self, data, downloader):
+        with FakeSDMX(data) as fake, temp_dir('UNESCO-fakesdmx-test') as folder:
+            endpoints_metadata = get_endpoints_metadata(fake.base_url, downloader, {'EDU_FINANCE': ' ', 'SDG4': ' '})
+            assert endpoints_metadata['SDG4'][1] == '%sdata/UNESCO,SDG4/...%%s.?' % fake.base_url
+            countriesdata = get_countriesdata(fake.base_url, downloader)
+            assert len(countriesdata) == 8
+            empty = 0
+            for countrydata in countriesdata[:6]:
+                for endpoint, endpoint_metadata in endpoints_metadata.items():
+                    expected = data.get_time_periods(endpoint, countrydata['id'])
+                    for ingest_format in ('csv', 'sdmx-json'):
+                        _, _, data_url, time_periods, periods = plan_endpoint(downloader, countrydata['id'], endpoint,
+                                                                              endpoint_metadata,
+                                                                              ingest_format=ingest_format)
+                        assert time_periods == expected
+                        df = download_endpoint(downloader, data_url, periods, endpoint_metadata[3], folder)
+                        if expected:
+                            assert len(df) == sum(expected.values())
+                            assert df['REF_AREA'].iloc[0].startswith('%s:' % countrydata['id'])
+                        else:
+                            assert df is None
+                            empty += 1
+            assert empty > 0
+            observation_indexes = get_observation_indexes(endpoints_metadata)
+            assert observation_indexes['SDG4'].get_observations('AF') == sum(data.get_time_periods('SDG4',
+                                                                                                   'AF').values())
+            batched_data = get_batched_data(downloader, endpoints_metadata, observation_indexes, countriesdata,
+                                            folder)
+            for countrydata in countriesdata[:6]:
+                dfs = batched_data.get_dfs('EDU_FINANCE', countrydata['id'])
+                assert sum(len(df) for df in dfs) == sum(data.get_time_periods('EDU_FINANCE',
+                                                                               countrydata['id']).values())
+            assert fake.get_metrics()['statuses'][200] > 0
+
+    def test_errors(self, data, downloader, monkeypatch):
+        sleeps = list()
+        monkeypatch.setattr(ratelimit.time, 'sleep', sleeps.append)
+        with FakeSDMX(data, quota_error_rate=0.5, retry_after=0, seed=1) as fake:
+            url = '%scodelist/UNESCO/CL_AREA/latest?format=sdmx-json' % fake.base_url
+            for _ in range(5):
+                assert len(load_safely(downloader, url).json()['Codelist'][0]['items']) == 8
+            assert fake.get_metrics()['statuses'][429] > 0  # retried by the session and by load_safely
+            assert fake.get_metrics()['statuses'][200] == 5
+        with FakeSDMX(data, not_found_rate=1.0) as fake:
+            assert load_safely(downloader, '%scodelist/UNESCO/CL_AREA/latest' % fake.base_url) is None
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the HTTP cache.
+
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from hdx.utilities.path import temp_dir
+
+import httpcache
+from fakesdmx import FakeSDMX, SyntheticData
+from httpcache import CachingDownload, HTTPCache, SessionDownload, cache_key_url, url_class
+
+
+class TestHTTPCache:
+    @pytest.fixture(scope='function')
+    def downloader(self):
+        class Response:
+            def __init__(self, status_code, content, headers):
+                self.status_code = status_code
+                self.content = content
+                self.headers = headers
+
+            def iter_content(self, chunk_size):
+                for i in range(0, len(self.content), 2):
+                    yield self.content[i:i + 2]
+
+            def close(self):
+                pass
+
+        class Download:
+            requests = list()
+
+            def download(self, url, headers=None, stream=False):
+                self.requests.append((url, headers))
+                if headers and headers.get('If-None-Match') == '"v1"':
+                    return Response(304, b'', dict())
+                return Response(200, b'{"a": 1}', {'ETag': '"v1"'})
+
+        return Download()
+
+    def test_cache_key_url(self):
+        url = 'http://yyyy/data/UNESCO,EDU_FINANCE/..AR.?format=csv&startPeriod=1970&subscription-key=12345'
+        assert cache_key_url(url) == 'http://yyyy/data/UNESCO,EDU_FINANCE/..AR.?format=csv&startPeriod=1970'
+        assert url_class(url) == 'data'
+        assert url_class('http://xxx/codelist/UNESCO/CL_AREA/latest?format=sdmx-json') == 'codelist'
+        assert url_class('http://yyyy/data/UNESCO,EDU_FINANCE/?detail=structureonly') == 'structure'
+
+    def test_caching_download(self, downloader, monkeypatch):
+        with temp_dir('UNESCO-cache-test') as folder:
+            url = 'http://yyyy/data/UNESCO,EDU_FINANCE/..AR.?format=csv&subscription-key=12345'
+            cachingdownloader = CachingDownload(downloader, HTTPCache(folder))
+            assert cachingdownloader.download(url).content == b'{"a": 1}'
+            assert cachingdownloader.download(url).content == b'{"a": 1}'
+            assert downloader.requests == [(url, None)]
+            now = httpcache.time.time()
+            monkeypatch.setattr(httpcache.time, 'time', lambda: now + 200 * 3600)
+            cachingdownloader = CachingDownload(downloader, HTTPCache(folder))
+            assert cachingdownloader.download(url).content == b'{"a": 1}'
+            assert downloader.requests[1] == (url, {'If-None-Match': '"v1"'})
+            assert cachingdownloader.download(url).content == b'{"a": 1}'
+            assert len(downloader.requests) == 2
+
+    def test_streamed_download(self, downloader):
+        with temp_dir('UNESCO-cache-test') as folder:
+            url = 'http://yyyy/data/UNESCO,EDU_FINANCE/..AR.?format=csv&subscription-key=12345'
+            cachingdownloader = CachingDownload(downloader, HTTPCache(folder))
+            response = cachingdownloader.download(url, stream=True)
+            assert b''.join(response.iter_content(3)) == b'{"a": 1}'
+            assert cachingdownloader.download(url).content == b'{"a": 1}'
+            assert downloader.requests == [(url, None)]
+
+    def test_eviction(self):
+        class Response:
+            def __init__(self, content):
+                self.content = content
+
+        with temp_dir('UNESCO-cache-test') as folder:
+            cache = HTTPCache(folder, max_size_mb=1.5)
+            for i in range(3):
+                cache.store('http://yyyy/%d' % i, Response(bytes([i]) * 512 * 1024))
+            cache.response('http://yyyy/0', cache.get('http://yyyy/0')[0])
+            cache.store('http://yyyy/3', Response(b'x' * 512 * 1024))
+            assert cache.get('http://yyyy/1') == (None, False)
+            for i in (0, 2, 3):
+                assert cache.get('http://yyyy/%d' % i)[1]
+
+    def test_evicted_response(self):
+        class Response:
+            def __init__(self, content):
+                self.content = content
+
+        with temp_dir('UNESCO-cache-test') as folder:
+            cache = HTTPCache(folder, max_size_mb=1)
+            cache.store('http://yyyy/0', Response(b'0' * 512 * 1024))
+            response = cache.response('http://yyyy/0', cache.get('http://yyyy/0')[0])
+            streamed_response = cache.response('http://yyyy/0', cache.get('http://yyyy/0')[0], stream=True)
+            for i in range(1, 3):
+                cache.store('http://yyyy/%d' % i, Response(bytes([i]) * 512 * 1024))
+            assert cache.get('http://yyyy/0') == (None, False)
+            assert response.content == b'0' * 512 * 1024
+            assert b''.join(streamed_response.iter_content(1024)) == b'0' * 512 * 1024
+
+    def test_index_writes(self, downloader):
+        with temp_dir('UNESCO-cache-test') as folder:
+            url = 'http://yyyy/data/UNESCO,EDU_FINANCE/..AR.?format=csv&subscription-key=12345'
+            cache = HTTPCache(folder)
+            cachingdownloader = CachingDownload(downloader, cache)
+            cachingdownloader.download(url)
+            mtime = httpcache.os.stat(cache.index_path).st_mtime_ns
+            httpcache.time.sleep(0.01)
+            for _ in range(3):
+                assert cachingdownloader.download(url).content == b'{"a": 1}'
+            assert httpcache.os.stat(cache.index_path).st_mtime_ns == mtime
+            accessed = cache.get(url)[0]['accessed']
+            cache.close()
+            assert HTTPCache(folder).get(url)[0]['accessed'] == accessed
+
+    def test_session_download_threads(self):
+        data = SyntheticData(countries=2, endpoints=['SDG4'], dimensions=3, values_per_dimension=4, observations=3000)
+        with FakeSDMX(data) as fake, SessionDownload(user_agent='test') as downloader:
+            url = '%sdata/UNESCO,SDG4/.AF.?format=csv' % fake.base_url
+            expected = downloader.download(url).content
+
+            def download(i):
+                if i % 2:
+                    return downloader.download(url).content
+                response = downloader.download(url, stream=True)
+                return b''.join(response.iter_content(1024))
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                assert all(content == expected for content in executor.map(download, range(64)))
+            assert len(downloader.sessions) > 1
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for HTTP trace recording and replay.
+
+'''
+from os.path import join
+
+from hdx.utilities.downloader import DownloadError
+from hdx.utilities.path import temp_dir
+
+import ratelimit
+from httptrace import RecordingDownload, ReplayDownload, TraceRecorder, TraceResponse
+from unesco import download_df, load_safely
+
+CSV = b'REF_AREA,TIME_PERIOD,OBS_VALUE\nAF,2010,1.5\nAF,2011,2.5\n'
+URL = 'https://api.uis.unesco.org/sdmx/data/UNESCO,SDG4/.AF.?format=csv&subscription-key=secret'
+
+
+class TestHTTPTrace:
+    def test_record_and_replay(self, monkeypatch):
+        sleeps = list()
+        monkeypatch.setattr(ratelimit.time, 'sleep', sleeps.append)
+
+        class Download:
+            calls = 0
+
+            def download(self, url, **kwargs):
+                self.calls += 1
+                if self.calls == 1:
+                    try:
+                        raise IOError('429 Client Error: Quota Exceeded for url: %s' % url)
+                    except IOError as e:
+                        raise DownloadError('Download of %s failed!' % url) from e
+                return TraceResponse(url, 200, {'Content-Type': 'text/csv'}, CSV)
+
+            def get_full_url(self, url):
+                return url
+
+        with temp_dir('UNESCO-trace-test') as folder:
+            path = join(folder, 'trace.jsonl.gz')
+            recorder = TraceRecorder(path)
+            downloader = RecordingDownload(Download(), recorder)
+            expected = download_df(downloader, URL, 2010, 2011)
+            assert len(expected) == 2
+            recorder.close()
+            with open(path, 'ab') as f:
+                f.write(b'\x1f\x8b\x08')  # a request cut short when a run was killed
+
+            replay = ReplayDownload(path, latency=0)
+            assert list(replay.records) == [URL.replace('&subscription-key=secret', '') +
+                                            '&startPeriod=2010&endPeriod=2011']
+            assert [x['attempt'] for x in replay.records[list(replay.records)[0]]] == [0, 1]
+            assert 'secret' not in str(replay.records)
+            sleeps.clear()
+            df = download_df(replay, URL.replace('secret', 'other'), 2010, 2011)
+            assert df.equals(expected)
+            assert len(sleeps) == 1  # the recorded quota error is replayed
+            assert download_df(replay, URL, 2010, 2011).equals(expected)
+            assert load_safely(replay, 'https://api.uis.unesco.org/sdmx/unknown') is None
+
+            replay = ReplayDownload(path, latency=0, quota_error_rate=0.5, quota_retry_after=0, seed=1)
+            sleeps.clear()
+            for _ in range(10):
+                assert download_df(replay, URL, 2010, 2011).equals(expected)
+            assert len(sleeps) > 1
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the publishing manifest.
+
+'''
+from os.path import join
+
+from hdx.utilities.path import temp_dir
+
+from manifest import Manifest
+
+
+class Resource(dict):
+    def __init__(self, name, path):
+        super(Resource, self).__init__(name=name)
+        self.path = path
+
+    def get_file_to_upload(self):
+        return self.path
+
+
+class Dataset(dict):
+    def __init__(self, name, resources):
+        super(Dataset, self).__init__(name=name)
+        self.data = dict(self)
+        self.resources = resources
+
+    def get_resources(self):
+        return self.resources
+
+
+class TestManifest:
+    def test_manifest(self):
+        with temp_dir('UNESCO-manifest-test') as folder:
+            paths = list()
+            for name in ('XUNIT', 'EDU_EXP'):
+                path = join(folder, 'UNESCO_ARG_EDU_FINANCE_%s.csv' % name)
+                with open(path, 'w') as f:
+                    f.write('%s,1\n' % name)
+                paths.append(path)
+            dataset = Dataset('unesco-education-financial-resources-argentina',
+                              [Resource('XUNIT', paths[0]), Resource('EDU_EXP', paths[1])])
+            manifest = Manifest(join(folder, 'manifest.json'))
+            entry = manifest.entry(dataset, None)
+            assert manifest.changes(dataset, entry) == (True, ['EDU_EXP', 'XUNIT'])
+            manifest.record(dataset, entry)
+
+            manifest = Manifest(join(folder, 'manifest.json'))
+            assert manifest.changes(dataset, manifest.entry(dataset, None)) == (False, list())
+            with open(paths[1], 'w') as f:
+                f.write('EDU_EXP,2\n')
+            assert manifest.changes(dataset, manifest.entry(dataset, None)) == (False, ['EDU_EXP'])
+            dataset.data['title'] = 'New title'
+            assert manifest.changes(dataset, manifest.entry(dataset, None)) == (True, ['EDU_EXP'])
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for metrics.
+
+'''
+import json
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
+
+import pytest
+from hdx.utilities.path import temp_dir
+
+import metrics
+from metrics import collect, export_metrics, increment, merge, timed_iter, timer
+
+
+def count_rows(rows):
+    increment('rows_processed', rows)
+    with timer('process_df'):
+        return rows * 2
+
+
+class TestMetrics:
+    @pytest.fixture(autouse=True)
+    def registry(self):
+        metrics.registry.reset()
+        yield metrics.registry
+        metrics.registry.reset()
+
+    def test_timers_and_counters(self, registry):
+        for _ in range(3):
+            with timer('download_df'):
+                increment('downloaded_bytes', 100)
+        with pytest.raises(ValueError):
+            with timer('write_csv'):
+                raise ValueError('failed')
+        assert list(timed_iter('split_df_by_column', iter(range(4)))) == [0, 1, 2, 3]
+        snapshot = registry.snapshot()
+        assert snapshot['counters'] == {'downloaded_bytes': 300}
+        assert {name: timer['calls'] for name, timer in snapshot['timers'].items()} == \
+            {'download_df': 3, 'write_csv': 1, 'split_df_by_column': 1}
+        assert snapshot['timers']['download_df']['max_seconds'] <= snapshot['timers']['download_df']['seconds']
+
+    def test_collect(self, registry):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            for rows in (10, 20):
+                result, snapshot = executor.submit(collect, count_rows, rows).result()
+                assert result == rows * 2
+                assert snapshot['counters'] == {'rows_processed': rows}
+                merge(snapshot)
+        assert registry.snapshot()['counters'] == {'rows_processed': 30}
+        assert registry.snapshot()['timers']['process_df']['calls'] == 2
+
+    def test_export_metrics(self):
+        with temp_dir('UNESCO-metrics-test') as folder:
+            configuration = {'metrics': {'prometheus_textfile': join(folder, 'unesco.prom'),
+                                         'summary': join(folder, 'summary.json')}}
+            with pytest.raises(ValueError):
+                with export_metrics(configuration, {'shard': '0/2'}):
+                    with timer('hdx_create'):
+                        increment('retries', 2)
+                    raise ValueError('failed')
+            with open(join(folder, 'unesco.prom')) as f:
+                lines = f.read().splitlines()
+            assert '# TYPE unesco_stage_seconds_total counter' in lines
+            assert 'unesco_stage_calls_total{shard="0/2",stage="hdx_create"} 1.0' in lines
+            assert 'unesco_retries_total{shard="0/2"} 2.0' in lines
+            assert 'unesco_run_success{shard="0/2"} 0.0' in lines
+            with open(join(folder, 'summary.json')) as f:
+                summary = json.load(f)
+            assert summary['success'] is False
+            assert summary['counters'] == {'retries': 2}
+            assert summary['stages']['hdx_create']['calls'] == 1
+            assert summary['labels'] == {'shard': '0/2'}
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the pipeline.
+
+'''
+import threading
+
+import pytest
+
+from pipeline import Pipeline
+
+
+class TestPipeline:
+    def test_pipeline(self):
+        results = list()
+        lock = threading.Lock()
+
+        def split(item):
+            if item == 3:
+                raise ValueError('bad item')
+            return range(item)
+
+        def square(item):
+            yield item * item
+
+        def collect(item):
+            with lock:
+                results.append(item)
+
+        pipeline = Pipeline(sample_interval=0.01)
+        pipeline.add_stage('split', split, workers=2)
+        pipeline.add_stage('square', square, workers=3, queue_size=1)
+        pipeline.add_stage('collect', collect)
+        with pytest.raises(ValueError):
+            pipeline.run([1, 2, 3, 4])
+        assert sorted(results) == [0, 0, 0, 1, 1, 4, 9]
+        metrics = {x['stage']: x for x in pipeline.get_metrics()}
+        assert metrics['split']['processed'] == 4
+        assert metrics['split']['errors'] == 1
+        assert metrics['square']['processed'] == 7
+        assert metrics['collect']['processed'] == 7
+        assert metrics['square']['max_queue_depth'] <= 1
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the publisher, using the fake CKAN.
+
+'''
+from os.path import join
+
+import pytest
+from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
+from hdx.data.resource import Resource
+from hdx.data.showcase import Showcase
+from hdx.data.vocabulary import Vocabulary
+from hdx.hdx_configuration import Configuration
+from hdx.utilities.path import temp_dir
+
+from fakeckan import FakeCKAN
+from manifest import Manifest
+from publisher import Publisher
+
+
+class TestPublisher:
+    @pytest.fixture(scope='function')
+    def fake_ckan(self):
+        Configuration._create(hdx_read_only=True, user_agent='test',
+                              project_config_yaml=join('tests', 'config', 'project_configuration.yml'))
+        Vocabulary._tags_dict = True
+        Vocabulary._approved_vocabulary = {'tags': [{'name': 'education'}],
+                                           'id': '4e61d464-4943-4e97-973a-84673c1aaa87', 'name': 'approved'}
+        fake_ckan = FakeCKAN()
+        Configuration.read().setup_remoteckan(fake_ckan)
+        return fake_ckan
+
+    tags = [{'name': 'education', 'vocabulary_id': '4e61d464-4943-4e97-973a-84673c1aaa87'}]
+
+    def generate(self, folder, country, names):
+        dataset = Dataset({'name': 'unesco-education-%s' % country, 'title': 'UNESCO Education - %s' % country,
+                           'owner_org': '18f2d467-dcf8-4b7e-bffa-b3c338ba3a7c', 'data_update_frequency': '365',
+                           'maintainer': '196196be-6037-4488-8b71-d786adf4c081', 'groups': [{'name': country}],
+                           'dataset_date': '01/01/1970-12/31/2014', 'subnational': '0', 'tags': self.tags})
+        for name in names:
+            path = join(folder, '%s_%s.csv' % (country, name))
+            with open(path, 'w') as f:
+                f.write('%s,%s\n' % (country, name))
+            resource = Resource({'name': name, 'description': name, 'format': 'csv'})
+            resource.set_file_to_upload(path)
+            dataset.add_update_resource(resource)
+        showcase = Showcase({'name': '%s-showcase' % dataset['name'], 'title': dataset['title'],
+                             'notes': 'Education', 'url': 'http://uis.unesco.org/en/country/%s' % country,
+                             'image_url': 'http://www.tellmaps.com/uis/internal/assets/uisheader-en.png', 'tags': self.tags})
+        return dataset, showcase
+
+    def test_publish(self, fake_ckan):
+        with temp_dir('UNESCO-publisher-test') as folder:
+            manifest = Manifest(join(folder, 'manifest.json'))
+            with Publisher(manifest, resource_workers=3, dataset_workers=2) as publisher:
+                for country in ('arg', 'bra', 'chl'):
+                    publisher.submit(*self.generate(folder, country, ['XUNIT', 'EDU_EXP', 'PPP']))
+            metrics = fake_ckan.get_metrics()
+            assert metrics['datasets'] == 3
+            assert metrics['calls']['resource_update'] == 9
+            assert 'package_resource_reorder' not in metrics['calls']
+            package = fake_ckan.package_show({'id': 'unesco-education-bra'}, None)
+            assert [x['name'] for x in package['resources']] == ['EDU_EXP', 'PPP', 'XUNIT']
+            assert package['resources'][0]['url'].endswith('/bra_EDU_EXP.csv')
+            showcase = fake_ckan.ckanext_showcase_show({'id': 'unesco-education-bra-showcase'}, None)
+            assert fake_ckan.associations[showcase['id']] == [package['id']]
+
+            with Publisher(manifest) as publisher:
+                publisher.publish(*self.generate(folder, 'arg', ['XUNIT', 'EDU_EXP', 'PPP']))
+            assert fake_ckan.get_metrics()['calls']['resource_update'] == 9
+
+            publisher = Publisher(resource_workers=2)
+            publisher.publish(*self.generate(folder, 'bra', ['XUNIT', 'EDU_EXP', 'ABC', 'PPP']))
+            publisher.close()
+            package = fake_ckan.package_show({'id': 'unesco-education-bra'}, None)
+            assert [x['name'] for x in package['resources']] == ['ABC', 'EDU_EXP', 'PPP', 'XUNIT']
+            assert fake_ckan.get_metrics()['calls']['package_resource_reorder'] == 1
+
+    def test_failed_upload(self, fake_ckan, monkeypatch):
+        with temp_dir('UNESCO-publisher-test') as folder:
+            with Publisher() as publisher:
+                publisher.publish(*self.generate(folder, 'arg', ['XUNIT', 'EDU_EXP']))
+
+            def update_in_hdx(resource, **kwargs):
+                raise HDXError('Upload of %s failed!' % resource['name'])
+
+            monkeypatch.setattr(Resource, 'update_in_hdx', update_in_hdx)
+            publisher = Publisher()
+            with pytest.raises(HDXError):
+                publisher.publish(*self.generate(folder, 'arg', ['XUNIT', 'EDU_EXP', 'PPP']))
+            publisher.close()
+            urls = {x['name']: x['url'] for x in fake_ckan.package_show({'id': 'unesco-education-arg'},
+                                                                       None)['resources']}
+            assert urls['XUNIT'].endswith('/arg_XUNIT.csv')
+            assert urls['EDU_EXP'].endswith('/arg_EDU_EXP.csv')
+            assert urls['PPP'] == Dataset.temporary_url
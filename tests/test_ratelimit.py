@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for rate limiting.
+
+'''
+import pytest
+from hdx.utilities.downloader import DownloadError
+
+import ratelimit
+from ratelimit import RateLimiter, backoff_delay, get_rate_limiter, pace, parse_retry_after
+from unesco import load_safely
+
+
+class TestRateLimit:
+    @pytest.fixture(scope='function')
+    def clock(self, monkeypatch):
+        class Clock:
+            now = 1000.0
+
+            def monotonic(self):
+                return self.now
+
+            def sleep(self, seconds):
+                self.now += seconds
+
+        clock = Clock()
+        monkeypatch.setattr(ratelimit.time, 'monotonic', clock.monotonic)
+        monkeypatch.setattr(ratelimit.time, 'sleep', clock.sleep)
+        return clock
+
+    def test_rate_limiter(self, clock):
+        rate_limiter = RateLimiter(2, burst=3)
+        assert [rate_limiter.acquire() for _ in range(3)] == [0, 0, 0]
+        assert rate_limiter.acquire() == 0.5
+        clock.now += 10
+        assert rate_limiter.acquire() == 0
+        delay = rate_limiter.backoff(0, retry_after=60)
+        assert 60 <= delay <= 61
+        assert rate_limiter.acquire() == pytest.approx(delay)
+        assert rate_limiter.acquire() == 0.5
+
+    def test_backoff(self):
+        for attempt, delay in [(0, 30), (1, 60), (2, 120), (10, 3600)]:
+            assert delay / 2 <= backoff_delay(attempt) <= delay
+        assert parse_retry_after('120') == 120
+        assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+        assert parse_retry_after('soon') is None
+
+    def test_get_rate_limiter(self):
+        configuration = {'rate_limit': {'subscription_tier': 'free', 'burst': 2,
+                                        'tiers': {'free': {'requests_per_second': 0.5, 'burst': 10}}}}
+        rate_limiter = get_rate_limiter(configuration)
+        assert rate_limiter.rate == 0.5
+        assert rate_limiter.burst == 2
+        assert get_rate_limiter(dict()) is None
+
+    def test_pace(self, clock):
+        class Download:
+            pass
+
+        downloader = Download()
+        start = clock.now
+        assert pace(downloader) == 0.2
+        downloader.rate_limiter = RateLimiter(1, burst=1)
+        assert pace(downloader) == 0
+        assert clock.now - start == pytest.approx(0.2)
+
+    def test_load_safely(self, clock):
+        class Download:
+            rate_limiter = RateLimiter(1, burst=1)
+            calls = 0
+
+            def download(self, url):
+                self.rate_limiter.acquire()
+                self.calls += 1
+                if self.calls < 3:
+                    try:
+                        raise IOError('429 Client Error: Quota Exceeded')
+                    except IOError as e:
+                        raise DownloadError('Download of %s failed!' % url) from e
+                return 'response'
+
+        downloader = Download()
+        start = clock.now
+        assert load_safely(downloader, 'http://xxx/') == 'response'
+        assert downloader.calls == 3
+        assert clock.now - start >= 15 + 30
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the request sizer.
+
+'''
+import time
+
+from ratelimit import RateLimitedDownload, RateLimiter
+from requestsize import RequestSizedDownload, RequestSizer
+from unesco import download_df, get_max_observations
+
+
+class TestRequestSize:
+    def test_request_sizer(self):
+        request_sizer = RequestSizer(60, 29990, min_observations=1000)
+        for observations in (1000, 5000, 10000, 20000):
+            request_sizer.record(observations, 2 + observations / 500.0)
+        assert request_sizer.get_max_observations() == 29990
+        request_sizer.record(29990, 2 + 29990 / 500.0)
+        assert abs(request_sizer.get_max_observations() - 29000) <= 1
+        request_sizer = RequestSizer(60, 29990, min_observations=1000)
+        for observations in (2000, 3000, 4000, 5000, 6000):
+            request_sizer.record(observations, observations / 10.0)
+        assert request_sizer.get_max_observations() == 1000
+
+    def test_get_max_observations(self):
+        class Download:
+            pass
+
+        downloader = Download()
+        assert get_max_observations(downloader) == 29990
+        assert get_max_observations(downloader, 5000) == 5000
+        request_sizer = RequestSizer(10, 29990, min_observations=100)
+        for observations in (1000, 2000, 3000, 4000, 5000):
+            request_sizer.record(observations, observations / 100.0)
+        assert abs(get_max_observations(RequestSizedDownload(downloader, request_sizer)) - 1000) <= 1
+
+    def test_record_transfer(self):
+        class Response:
+            content = b'REF_AREA,TIME_PERIOD,OBS_VALUE\nAF,2010,1.5\nAF,2011,\nAF,2012,2.5\n'
+
+            def iter_content(self, chunk_size):
+                yield self.content
+
+            def close(self):
+                pass
+
+        class Download:
+            def download(self, url, **kwargs):
+                time.sleep(0.01)
+                return Response()
+
+            def get_full_url(self, url):
+                return url
+
+        request_sizer = RequestSizer(10, 29990)
+        downloader = RequestSizedDownload(RateLimitedDownload(Download(), RateLimiter(4, burst=1)), request_sizer)
+        for chunksize in (None, 2):
+            df = download_df(downloader, 'http://xxx/data?format=csv', 2010, 2012, chunksize=chunksize)
+            assert len(df) == (3 if chunksize is None else 2)
+        assert [observations for observations, _ in request_sizer.samples] == [3, 3]
+        assert all(seconds < 0.2 for _, seconds in request_sizer.samples)  # not the 0.25 seconds waited
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for the schema of columns.
+
+'''
+from os.path import join
+
+import pandas as pd
+import pytest
+
+from schema import SCHEMA, report_coverage
+from tests.testing_data import observations
+from unesco import get_hxl_tags, transform_endpoint
+
+
+class TestSchema:
+    def test_tables(self):
+        assert SCHEMA.get_label('STAT_UNIT') == 'Statistical unit'
+        assert SCHEMA.get_label('EDU_CAT') == 'Edu cat'
+        assert SCHEMA.get_hxl_tag('Sex') == SCHEMA.get_hxl_tag('SEX') == '#group+sex'
+        assert SCHEMA.is_split('Orientation') and not SCHEMA.is_split('EDU_CAT')
+        assert 'OBS_STATUS' in SCHEMA.untagged
+        with pytest.raises(TypeError):
+            SCHEMA.labels['FOO'] = 'Foo'
+        assert get_hxl_tags(['SEX', 'SEX code', 'FOO']) == {'TIME_PERIOD': '#date',
+                                                             'OBS_VALUE': '#indicator+value+num',
+                                                             'SEX': '#group+sex', 'SEX code': '#group+sex+code'}
+
+    def test_header(self):
+        df = pd.read_csv(join('tests', 'fixtures', 'EDU_FINANCE.csv'))
+        _, filename, df_part, tags, _ = transform_endpoint(df, 'ARG', 'EDU_FINANCE', 'Finance', observations)[0]
+        assert filename == 'UNESCO_ARG_EDU_FINANCE_XUNIT.csv'
+        assert list(df_part.columns) == ['Funding flow', 'Level of education', 'Reference area', 'Time Period',
+                                         'Unit of measure', 'Source fund', 'Obs value', 'Unit mult', 'Freq',
+                                         'Decimals', 'Obs status', 'Country-iso3', 'Indicator name']
+        assert tags == ['#indicator+funding+flow+name', '#group+education+level', '#geo+reference+area', '#date',
+                        '#meta+unit+measure+name', '#indicator+funding+source', '#indicator+value+num',
+                        '#meta+unit+mult+name', '#indicator+frequency', '#meta+decimals', None, '#country+iso3',
+                        '#indicator+name']
+
+    def test_report_coverage(self):
+        dimensions = observations + [{'id': 'NEW_DIM', 'name': 'New dimension'}, {'id': 'OTHER_DIM'}]
+        coverage = report_coverage({'EDU_FINANCE': ('Finance', 'url', ' ', dimensions)})['EDU_FINANCE']
+        assert coverage == {'unlabelled': ['EDU_CAT (Orientation)', 'SECTOR_EDU (Type of institution)',
+                                           'SOURCE_FUND (Source of funding)', 'NEW_DIM (New dimension)', 'OTHER_DIM'],
+                            'untagged': ['NEW_DIM (New dimension)', 'OTHER_DIM'],
+                            'unsplit': ['EDU_CAT (Orientation)', 'SECTOR_EDU (Type of institution)',
+                                        'SOURCE_FUND (Source of funding)']}
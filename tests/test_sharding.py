@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Unit tests for sharding.
+
+'''
+import os
+import random
+from os.path import join
+
+import pytest
+from hdx.utilities.path import temp_dir
+
+from sharding import get_assignment_path, get_country_weights, load_assignment, merge_reports, parse_shard, \
+    select_shard, shard_path, write_report
+from unesco import ObservationIndex
+
+
+class TestSharding:
+    @pytest.fixture(scope='class')
+    def countriesdata(self):
+        countriesdata = [{'id': '%s%s' % (a, b), 'names': [{'value': 'Country %s%s' % (a, b)}]}
+                         for a in 'ABCDEFGH' for b in 'ABCDEFGH']
+        countriesdata.append({'id': 'WLD', 'names': [{'value': 'UIS: World'}]})
+        return countriesdata
+
+    @pytest.fixture(scope='class')
+    def observation_indexes(self, countriesdata):
+        random.seed(1)
+        observation_indexes = dict()
+        for endpoint in ('EDU_FINANCE', 'DEM_ECO'):
+            values = [{'id': x['id'], 'actualObs': int(random.paretovariate(1.2) * 500)} for x in countriesdata]
+            observation_indexes[endpoint] = ObservationIndex([{'id': 'REF_AREA', 'values': values}])
+        return observation_indexes
+
+    def test_parse_shard(self):
+        assert parse_shard('0/4') == (0, 4)
+        assert parse_shard('3/4') == (3, 4)
+        for value in ('4/4', '1', 'a/b', '0/0'):
+            with pytest.raises(ValueError):
+                parse_shard(value)
+        assert shard_path('~/cache/manifest.json', 1, 4) == '~/cache/manifest-shard-1-of-4.json'
+
+    def test_select_shard(self, countriesdata, observation_indexes):
+        weights = get_country_weights(countriesdata, observation_indexes)
+        assert weights['WLD'] == 0
+        total = sum(weights.values())
+        for shard_weights in (None, weights):
+            selected = [select_shard(countriesdata, shard, 4, shard_weights) for shard in range(4)]
+            ids = [x['id'] for countries in selected for x in countries]
+            assert sorted(ids) == sorted(x['id'] for x in countriesdata)
+            loads = [sum(weights[x['id']] for x in countries) for countries in selected]
+            if shard_weights is None:
+                hashed_imbalance = max(loads) * 4.0 / total
+            else:
+                assert max(loads) * 4.0 / total < 1.05
+                assert max(loads) * 4.0 / total < hashed_imbalance
+        assert select_shard(countriesdata, 2, 4, weights) == select_shard(list(countriesdata), 2, 4, dict(weights))
+
+    def test_load_assignment(self, countriesdata, observation_indexes):
+        weights = get_country_weights(countriesdata, observation_indexes)
+        changed = dict(weights, AA=weights['AA'] * 100)  # observation counts changed before the next shard started
+        with temp_dir('UNESCO-sharding-test') as folder:
+            selected = list()
+            for shard, shard_weights in enumerate((weights, changed, weights)):
+                assignment = load_assignment(folder, 3, shard_weights)
+                selected.append(select_shard(countriesdata, shard, 3, assignment=assignment))
+            assert select_shard(countriesdata, 1, 3, changed) != selected[1]
+            ids = [x['id'] for countries in selected for x in countries]
+            assert sorted(ids) == sorted(x['id'] for x in countriesdata)
+            extra = {'id': 'ZZ', 'names': [{'value': 'Country ZZ'}]}
+            assert sum(len(select_shard([extra], shard, 3, assignment=assignment)) for shard in range(3)) == 1
+            for shard in range(3):
+                write_report(folder, shard, 3, countriesdata, selected[shard], weights)
+            merge_reports(folder, 3)
+            assert not os.path.exists(get_assignment_path(folder, 3))
+
+    def test_merge_reports(self, countriesdata):
+        with temp_dir('UNESCO-sharding-test') as folder:
+            folder = join(folder, 'shards')
+            selected = [select_shard(countriesdata, shard, 3) for shard in range(3)]
+            for shard in range(2):
+                write_report(folder, shard, 3, countriesdata, selected[shard])
+            with pytest.raises(ValueError, match='Shard 2/3 has not completed'):
+                merge_reports(folder, 3)
+            write_report(folder, 2, 3, countriesdata, selected[2] + selected[1][:1])
+            with pytest.raises(ValueError, match='covered by shards 1 and 2'):
+                merge_reports(folder, 3)
+            write_report(folder, 2, 3, countriesdata, selected[2][1:])
+            with pytest.raises(ValueError, match='Countries not covered: %s' % selected[2][0]['id']):
+                merge_reports(folder, 3)
+            write_report(folder, 2, 3, countriesdata, selected[2])
+            assert merge_reports(folder, 3) == {'countries': len(countriesdata), 'weights': [None, None, None]}
@@ -4,9 +4,16 @@
 Unit tests for scrapername.
 
 '''
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from os import listdir, remove
 from os.path import join
 from pprint import pprint
 
+import numpy as np
+import pandas as pd
+
 import pytest
 from hdx.data.vocabulary import Vocabulary
 from hdx.hdx_configuration import Configuration
@@ -15,8 +22,12 @@ from hdx.location.country import Country
 from hdx.utilities.path import temp_dir
 import hdx.utilities.downloader
 
+from checkpoint import Checkpoint
 from tests.testing_data import countrydata, dimensions, observations
-from unesco import generate_dataset_and_showcase, get_countriesdata, get_endpoints_metadata
+from unesco import generate_dataset_and_showcase, get_countriesdata, get_endpoints_metadata, download_dfs, \
+    plan_data_requests, get_batched_data, get_observation_indexes, split_columns_df, process_df, \
+    union_categories, split_df_by_column, ChunkAccumulator, download_df, blank_values, \
+    decode_sdmx_json_data, chunk_years, create_pipeline, ObservationIndex, write_csv, get_time_periods_from_df
 
 
 class TestUnesco:
@@ -83,6 +94,275 @@ class TestUnesco:
         endpoints_metadata_actual = get_endpoints_metadata('http://yyyy/', downloader, endpoints)
         assert endpoints_metadata_actual == endpoints_metadata
 
+    def test_download_dfs(self, downloader):
+        csv_url = 'http://yyyy/data/UNESCO,EDU_FINANCE/..........AR.?format=csv'
+        requests = [(csv_url, 1970, 1999), (csv_url, 2000, 2009), (csv_url, 2010, 2014)]
+        expected = download_dfs(downloader, requests)
+        actual = download_dfs(downloader, requests, concurrency=3)
+        assert len(actual) == 3
+        for df_expected, df_actual in zip(expected, actual):
+            assert df_actual.equals(df_expected)
+
+    def test_download_dfs_order(self):
+        class Response:
+            def __init__(self, content):
+                self.content = content
+
+        class Download:
+            @staticmethod
+            def download(url):
+                year = int(url.split('startPeriod=')[1][:4])
+                time.sleep((2014 - year) * 0.02)  # earlier periods finish last
+                return Response(('TIME_PERIOD,OBS_VALUE\n%d,1\n' % year).encode())
+
+            @staticmethod
+            def get_full_url(url):
+                return url
+
+        requests = [('http://yyyy/?format=csv', year, year) for year in range(2010, 2015)]
+        accumulator = ChunkAccumulator()
+        download_dfs(Download(), requests, concurrency=5, accumulators=[accumulator] * len(requests))
+        assert list(accumulator.concat()['TIME_PERIOD']) == list(range(2010, 2015))
+
+    def test_download_df_streamed(self, csv_content):
+        class Response:
+            closed = False
+
+            @staticmethod
+            def iter_content(chunk_size):
+                for i in range(0, len(csv_content), 1000):
+                    yield csv_content[i:i + 1000]
+
+            def close(self):
+                self.closed = True
+
+        class Download:
+            @staticmethod
+            def download(url, stream=False):
+                response = Response()
+                if not stream:
+                    response.content = csv_content
+                return response
+
+            @staticmethod
+            def get_full_url(url):
+                return url
+
+        categorical_columns = ['STAT_UNIT', 'EDU_LEVEL', 'REF_AREA']
+        unfiltered = download_df(Download(), 'http://yyyy/data/?format=csv', 1970, 2014,
+                                 categorical_columns=categorical_columns)
+        expected = unfiltered.loc[~blank_values(unfiltered['OBS_VALUE'])]
+        actual = download_df(Download(), 'http://yyyy/data/?format=csv', 1970, 2014,
+                             categorical_columns=categorical_columns, chunksize=5)
+        assert len(actual) == len(expected)
+        assert get_time_periods_from_df(actual) == get_time_periods_from_df(unfiltered)
+        df = pd.DataFrame({'TIME_PERIOD': [2010, 2011, 2011], 'OBS_VALUE': [1.0, np.nan, 2.0]})
+        assert get_time_periods_from_df(df) == {2010: 1, 2011: 1}
+        assert get_time_periods_from_df(df.assign(OBS_VALUE=[np.nan, np.nan, 2.0])) == {2011: 1}
+        assert str(actual['EDU_LEVEL'].dtype) == 'category'
+        pd.testing.assert_frame_equal(actual, expected, check_categorical=False)
+
+    def test_decode_sdmx_json_data(self):
+        stat_unit = {'id': 'STAT_UNIT', 'keyPosition': 0, 'values': [{'id': 'XUNIT', 'name': 'Gov per student'},
+                                                                      {'id': 'EDU_EXP', 'name': 'Exp'}]}
+        ref_area = {'id': 'REF_AREA', 'keyPosition': 1, 'values': [{'id': 'AR', 'name': 'Argentina'}]}
+        time_period = {'id': 'TIME_PERIOD', 'keyPosition': 2, 'values': [{'id': '1999', 'name': '1999'},
+                                                                          {'id': '2000', 'name': '2000'}]}
+        attributes = {'observation': [{'id': 'OBS_STATUS', 'values': [{'id': 'A', 'name': 'Normal'}]}]}
+        flat = {'structure': {'dimensions': {'observation': [stat_unit, ref_area, time_period]},
+                              'attributes': attributes},
+                'dataSets': [{'observations': {'0:0:0': [1.5, 0], '1:0:1': [None, None], '0:0:1': [2.0]}}]}
+        series = {'structure': {'dimensions': {'series': [stat_unit, ref_area], 'observation': [time_period]},
+                                'attributes': attributes},
+                  'dataSets': [{'series': {'0:0': {'observations': {'0': [1.5, 0], '1': [2.0]}},
+                                           '1:0': {'observations': {'1': [None, None]}}}}]}
+        csv = pd.read_csv(BytesIO(b'STAT_UNIT,REF_AREA,TIME_PERIOD,OBS_VALUE,OBS_STATUS\n'
+                                  b'XUNIT:Gov per student,AR:Argentina,1999,1.5,A\n'
+                                  b'EDU_EXP:Exp,AR:Argentina,2000,,\n'
+                                  b'XUNIT:Gov per student,AR:Argentina,2000,2.0,\n'))
+        expected, _ = process_df(csv)
+        for message in (flat, series):
+            df = decode_sdmx_json_data(message)
+            assert list(df.columns) == ['STAT_UNIT', 'REF_AREA', 'TIME_PERIOD', 'OBS_VALUE', 'OBS_STATUS']
+            assert str(df['STAT_UNIT'].dtype) == 'category'
+            assert len(df) == 3
+            actual, _ = process_df(df)
+            assert actual.to_csv(index=False) == expected.to_csv(index=False)
+
+    def test_split_columns_df(self):
+        df = pd.DataFrame({'SEX': ['F:Female', 'M:Male', np.nan, '_T'],
+                           'EDU_LEVEL': ['L1:Primary: first', 'L1:Primary: first', 'L2:Lower', 'L2:Lower'],
+                           'TIME_PERIOD': [2001, 2000, 1999, 1998], 'OBS_VALUE': [1.5, ' ', 2.0, None]})
+        result = split_columns_df(df[['SEX', 'EDU_LEVEL']], store_code=True)
+        assert list(result.columns) == ['EDU_LEVEL', 'EDU_LEVEL code', 'SEX', 'SEX code']
+        assert list(result['EDU_LEVEL']) == ['Primary: first', 'Primary: first', 'Lower', 'Lower']
+        assert list(result['EDU_LEVEL code']) == ['L1', 'L1', 'L2', 'L2']
+        assert list(result['SEX'])[:2] + list(result['SEX'])[3:] == ['Female', 'Male', '_T']
+        assert np.isnan(result['SEX'][2])
+        result, hxltags = process_df(df)
+        assert list(result['OBS_VALUE']) == [2.0, 1.5]
+        assert list(result['TIME_PERIOD']) == [1999, 2001]
+        assert hxltags['OBS_VALUE'] == '#indicator+value+num'
+        assert hxltags['TIME_PERIOD'] == '#date'
+        assert hxltags['SEX'] == '#group+sex'
+
+    def test_categorical_columns(self):
+        df1 = pd.DataFrame({'SEX': pd.Categorical(['F:Female', 'M:Male', np.nan]), 'TIME_PERIOD': [2001, 2000, 2001],
+                            'OBS_VALUE': [1.0, 2.0, 3.0]})
+        df2 = pd.DataFrame({'SEX': pd.Categorical(['_T:Total', 'F:Female']), 'TIME_PERIOD': [1999, 1999],
+                            'OBS_VALUE': [4.0, 5.0]})
+        df1, df2 = union_categories([df1, df2])
+        df = pd.concat([df1, df2], ignore_index=True)
+        result = split_columns_df(df, store_code=True)
+        assert str(result['SEX'].dtype) == 'category'
+        assert list(result['SEX'].cat.categories) == ['Female', 'Male', 'Total']
+        assert list(result['SEX code'].astype(object).fillna('')) == ['F', 'M', '', '_T', 'F']
+
+    def test_split_df_by_column(self):
+        df = pd.DataFrame({'STAT_UNIT': ['B', 'A', np.nan, 'B', 'A'], 'OBS_VALUE': [1.0, 2.0, 3.0, 4.0, 5.0]})
+        for values in (df['STAT_UNIT'], pd.Categorical(df['STAT_UNIT'], categories=['B', 'A'])):
+            parts = list(split_df_by_column(df.assign(STAT_UNIT=values), 'STAT_UNIT'))
+            assert [value for value, _ in parts] == ['A', 'B']
+            assert [list(part['OBS_VALUE']) for _, part in parts] == [[2.0, 5.0], [1.0, 4.0]]
+            assert list(parts[0][1].columns) == ['OBS_VALUE']
+        assert list(split_df_by_column(df, None))[0][1] is df
+
+    def test_write_csv(self):
+        df = pd.DataFrame({'Reference area': ['Côte d\'Ivoire', 'Curaçao'], 'OBS_VALUE': [1.0, 2.0]})
+        with temp_dir('UNESCO') as folder:
+            path = join(folder, 'test.csv')
+            write_csv(df, path, ['#geo+reference+area', '#indicator+value+num'])
+            with open(path, 'rb') as f:
+                assert f.read().decode('utf-8') == 'Reference area,OBS_VALUE\n' \
+                    '#geo+reference+area,#indicator+value+num\nCôte d\'Ivoire,1.0\nCuraçao,2.0\n'
+
+    def test_chunk_accumulator(self):
+        with temp_dir('UNESCO') as folder:
+            accumulator = ChunkAccumulator(folder, max_memory_mb=0.001)
+            for sex in (['F:Female'] * 50, None, ['M:Male'] * 10, ['F:Female'] * 10):
+                accumulator.add(None if sex is None else pd.DataFrame({'SEX': pd.Categorical(sex),
+                                                                       'OBS_VALUE': 1.0}))
+            assert len(accumulator) == 3
+            assert len([path for path in accumulator.chunks if isinstance(path, str)]) == 2
+            df = accumulator.concat()
+            assert list(df['SEX']) == ['F:Female'] * 50 + ['M:Male'] * 10 + ['F:Female'] * 10
+            assert str(df['SEX'].dtype) == 'category'
+            assert accumulator.concat() is None
+            for index in (2, 0, 1):
+                accumulator.add(pd.DataFrame({'OBS_VALUE': [float(index)]}), index)
+            assert list(accumulator.concat()['OBS_VALUE']) == [0.0, 1.0, 2.0]
+            assert [name for name in listdir(folder) if name.startswith('chunk_')] == list()
+
+    def test_chunk_years(self):
+        time_periods = {2014: 400, 2013: 700, 2012: 0, 2011: 2500, 2010: 300, 2009: 0, 2008: 600}
+        assert list(chunk_years(time_periods, max_observations=1000)) == \
+            [(2014, 2014), (2012, 2013), (2011, 2011), (2008, 2010)]
+        assert list(chunk_years(time_periods, max_observations=1100)) == [(2012, 2014), (2011, 2011), (2008, 2010)]
+        assert list(chunk_years(time_periods, max_observations=5000)) == [(2008, 2014)]
+        assert list(chunk_years({2000: 0, 2001: 0}, max_observations=1000)) == [(2000, 2001)]
+        assert list(chunk_years(dict())) == list()
+
+    def test_plan_data_requests(self):
+        observations_by_country = {'AR': (35000, [(2001, 2001), (2000, 2000)]), 'BR': (16000, [(1999, 2000)]),
+                                   'CL': (12000, [(2010, 2010)]), 'PY': (5000, [(2001, 2001)]), 'BS': (0, list())}
+        assert plan_data_requests(observations_by_country, max_observations=30000) == \
+            [(['AR'], 2001, 2001), (['AR'], 2000, 2000), (['BR', 'CL'], 1999, 2010), (['PY'], 2001, 2001)]
+        assert plan_data_requests(observations_by_country, max_observations=30000, max_countries=1)[2:] == \
+            [(['BR'], 1999, 2000), (['CL'], 2010, 2010), (['PY'], 2001, 2001)]
+
+    def test_observation_index(self, downloader, endpoints_metadata):
+        observation_index = get_observation_indexes(endpoints_metadata)['EDU_FINANCE']
+        structure_url = endpoints_metadata['EDU_FINANCE'][1]
+        assert observation_index.get_observations('AR') == 6185
+        assert observation_index.get_time_periods(downloader, structure_url, 'XX') == dict()
+        time_periods = observation_index.get_time_periods(downloader, structure_url, 'AR')
+        assert time_periods is None
+        assert observation_index.get_periods(time_periods) == [(1970, 2014)]
+        time_periods = observation_index.get_time_periods(downloader, structure_url, 'AR', max_observations=5000)
+        assert time_periods[2014] == 325
+        assert observation_index.get_periods(time_periods, max_observations=5000) == [(1999, 2014), (1970, 1998)]
+        no_years = [dict(x, values=[dict(value, actualObs=0) for value in x['values']])
+                    if x['id'] == 'TIME_PERIOD' else x for x in endpoints_metadata['EDU_FINANCE'][3]]
+        observation_index = ObservationIndex(no_years)  # REF_AREA reports observations but no year has any
+        assert observation_index.get_periods(None) == list()
+        time_periods = observation_index.get_time_periods(downloader, structure_url, 'AR')
+        assert time_periods[2014] == 325
+        assert observation_index.get_periods(time_periods) == [(1970, 2014)]
+
+    def test_batched_data(self, configuration, downloader, endpoints_metadata):
+        with temp_dir('UNESCO') as folder:
+            expected = next(generate_dataset_and_showcase(downloader, countrydata, endpoints_metadata, folder=folder))
+            observation_indexes = get_observation_indexes(endpoints_metadata)
+            batched_data = get_batched_data(downloader, endpoints_metadata, observation_indexes, [countrydata], folder)
+            assert list(batched_data.paths) == [('EDU_FINANCE', 'AR')]
+            dataset, showcase = next(generate_dataset_and_showcase(downloader, countrydata, endpoints_metadata,
+                                                                   folder=folder,
+                                                                   observation_indexes=observation_indexes,
+                                                                   batched_data=batched_data))
+            # The years come from the data rather than the (mocked) structure response
+            assert dataset['dataset_date'] == '01/01/1998-12/31/2014'
+            del dataset['dataset_date']
+            del expected[0]['dataset_date']
+            assert dataset == expected[0]
+            assert dataset.get_resources() == expected[0].get_resources()
+            assert showcase == expected[1]
+
+    def test_create_pipeline(self, configuration, downloader, endpoints_metadata):
+        with temp_dir('UNESCO') as folder:
+            expected = next(generate_dataset_and_showcase(downloader, countrydata, endpoints_metadata, folder=folder))
+            published = list()
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                pipeline = create_pipeline(downloader, endpoints_metadata, folder,
+                                           lambda dataset, showcase: published.append((dataset, showcase)),
+                                           executor=executor, download_workers=2)
+                metrics = pipeline.run([countrydata])
+            assert [x['processed'] for x in metrics] == [1, 1, 1, 1, 1]
+            dataset, showcase = published[0]
+            assert dataset == expected[0]
+            assert dataset.get_resources() == expected[0].get_resources()
+            assert showcase == expected[1]
+
+    def test_checkpoint(self, configuration, downloader, endpoints_metadata):
+        class CountingDownload:
+            def __init__(self):
+                self.urls = list()
+
+            def download(self, url, *args, **kwargs):
+                self.urls.append(url)
+                return downloader.download(url, *args, **kwargs)
+
+            def __getattr__(self, name):
+                return getattr(downloader, name)
+
+        counting_downloader = CountingDownload()
+
+        def generate(resume):
+            checkpoint = Checkpoint(join(folder, 'checkpoint.jsonl'), folder, resume=resume)
+            datasets = list(generate_dataset_and_showcase(counting_downloader, countrydata, endpoints_metadata,
+                                                          folder=folder, checkpoint=checkpoint))
+            checkpoint.file.close()
+            return datasets
+
+        with temp_dir('UNESCO-checkpoint') as folder:
+            expected = generate(False)
+            assert len(counting_downloader.urls) == 2
+            for files_exist in (True, False):  # resume from the processed, then the fetched record
+                counting_downloader.urls = list()
+                datasets = generate(True)
+                assert counting_downloader.urls == list()
+                dataset, showcase = datasets[0]
+                assert dataset == expected[0][0]
+                assert dataset.get_resources() == expected[0][0].get_resources()
+                assert showcase == expected[0][1]
+                remove(dataset.get_resources()[0].get_file_to_upload())
+            with open(join(folder, 'checkpoint.jsonl'), 'a') as f:
+                f.write('{"stage": "fetch')  # killed while writing a record
+            checkpoint = Checkpoint(join(folder, 'checkpoint.jsonl'), folder, resume=True)
+            checkpoint.published(dataset['name'])
+            checkpoint.file.close()
+            assert generate(True) == list()
+            assert counting_downloader.urls == list()
+
     def test_generate_dataset_and_showcase(self, configuration, downloader, endpoints_metadata):
         with temp_dir('UNESCO') as folder:
             res = generate_dataset_and_showcase(downloader, countrydata, endpoints_metadata, folder=folder)
@@ -99,6 +379,10 @@ class TestUnesco:
             resources = dataset.get_resources()
 
             assert resources == [{'description': 'Government expenditure per student', 'format': 'csv', 'name': 'XUNIT', 'resource_type': 'file.upload', 'url_type': 'upload'}]
+            with open(resources[0].get_file_to_upload()) as f:
+                header, hxltags = f.readline().strip().split(','), f.readline().strip().split(',')
+            assert dict(zip(header, hxltags))['Obs value'] == '#indicator+value+num'
+            assert hxltags[-2:] == ['#country+iso3', '#indicator+name']
 
             assert showcase == {'name': 'unesco-education-financial-resources-argentina-showcase',
                                 'notes': 'Education, literacy and other indicators for Argentina',
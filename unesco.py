@@ -8,28 +8,41 @@ Reads UNESCO API and creates datasets.
 
 """
 
+import asyncio
+import csv
 import logging
-
-import time
-
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from hdx.data.dataset import Dataset
 from hdx.data.hdxobject import HDXError
 from hdx.data.resource import Resource
 from hdx.data.showcase import Showcase
-from hdx.location.country import Country
+from hdx.utilities import raisefrom
 from hdx.utilities.downloader import DownloadError
 from six import reraise
 from slugify import slugify
+from countryindex import is_aggregate, resolve_country
+from metrics import collect, increment, merge, record, timed_iter, timer
+from pipeline import Pipeline
+from ratelimit import get_retry_after, pace, wait_for_quota
+from schema import SCHEMA
 from io import BytesIO
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_categorical_dtype
 from os.path import join
+from tempfile import mkstemp
+from timeit import default_timer
 
 logger = logging.getLogger(__name__)
 
 MAX_OBSERVATIONS = 29990
+MAX_BATCH_COUNTRIES = 50
+STREAM_BLOCK_SIZE = 1024 * 1024
 dataurl_suffix = 'format=sdmx-json&detail=structureonly&includeMetrics=true'
+data_formats = {'csv': 'format=csv', 'sdmx-json': 'format=sdmx-json&dimensionAtObservation=AllDimensions'}
 
 
 def get_countriesdata(base_url, downloader):
@@ -38,12 +51,27 @@ def get_countriesdata(base_url, downloader):
     return jsonresponse['Codelist'][0]['items']
 
 
+def get_time_periods(json):
+    """
+    Get number of observations per year from a structure response
+    :param json: structure response with metrics
+    :return: dictionary of years -> number of observations
+    """
+    time_periods = dict()
+    for observation in json['structure']['dimensions']['observation']:
+        if observation['id'] == 'TIME_PERIOD':
+            for value in observation['values']:
+                time_periods[int(value['id'])] = value['actualObs']
+    return time_periods
+
+
 def get_endpoints_metadata(base_url, downloader, endpoints):
     endpoints_metadata = dict()
     for endpoint in sorted(endpoints):
         base_dataurl = '%sdata/UNESCO,%s/' % (base_url, endpoint)
         datastructure_url = '%s?%s' % (base_dataurl, dataurl_suffix)
-        response = downloader.download(datastructure_url)
+        with timer('endpoints_metadata'):
+            response = downloader.download(datastructure_url)
 #        open("endpointmeta_%s.json"%endpoint,"wb").write(response.content)  #TODO Clean
 #        print("META "+endpoint)
         json = response.json()
@@ -64,205 +92,140 @@ def get_endpoints_metadata(base_url, downloader, endpoints):
     return endpoints_metadata
 
 def expand_column_labels(df):
-    column_expansion_table = {row.split()[0]:" ".join(row.split()[1:]) for row in """
-AGE                Age
-COUNTRY_ORIGIN     Country / region of origin
-REGION_DEST        Destination region
-EDU_FIELD          Field of education
-FUND_FLOW          Funding flow
-GRADE              Grade
-IMM_STATUS         Immigration status
-INFRASTR           Infrastructure
-EDU_LEVEL          Level of education
-EDU_ATTAIN         Level of educational attainment
-LOCATION           Location
-REF_AREA           Reference area
-SUBJECT            Subject
-SEX                Sex
-SE_BKGRD           Socioeconomic background
-STAT_UNIT          Statistical unit
-TEACH_EXPERIENCE   Teaching experience
-TIME_PERIOD        Time Period
-CONTRACT_TYPE      Type of contract
-EDU_TYPE           Type of education
-EXPENDITURE_TYPE   Type of expenditure
-UNIT_MEASURE       Unit of measure
-WEALTH_QUINTILE    Wealth quintile
-    """.split("\n") if len(row.split())>=2}
-    def expand_label(label):
-        if label in column_expansion_table:
-            return column_expansion_table[label]
-        else:
-            label = label.lower().replace("_"," ")
-            label = label[0].upper()+label[1:]
-            return label
-    return df.rename(columns={c:expand_label(c) for c in df.columns})
-    
+    """
+    Replace column ids by their labels
+    :param df: DataFrame
+    :return: DataFrame
+    """
+    return df.rename(columns={c: SCHEMA.get_label(c) for c in df.columns})
+
+
+def split_code_label(values):
+    """
+    Split CODE:Label values into code and label. Each distinct value is split only once and the results are
+    spread to the rows by their factorized positions. Values that are not strings are kept in both, as are strings
+    without a code in the label. Categorical values are split on their categories and stay categorical.
+    :param values: Series
+    :return: (codes, labels) arrays
+    """
+    if is_categorical_dtype(values.dtype):
+        return split_categorical_code_label(values.values)
+    if values.dtype != object:
+        return values.values, values.values
+    positions, uniques = pd.factorize(values)
+    missing = positions < 0
+    if missing.all():
+        return values.values, values.values
+    codes = np.array([x.split(":")[0] if isinstance(x, str) else x for x in uniques], dtype=object)
+    labels = np.array([x.partition(":")[2] if isinstance(x, str) and ":" in x else x for x in uniques], dtype=object)
+    codes = codes.take(positions)
+    labels = labels.take(positions)
+    if missing.any():
+        codes[missing] = values.values[missing]
+        labels[missing] = values.values[missing]
+    return codes, labels
+
+
+def split_categorical_code_label(values):
+    """
+    Split categorical CODE:Label values on the category set rather than on every row
+    :param values: Categorical
+    :return: (codes, labels) Categoricals with sorted categories
+    """
+    categories = values.categories
+    if categories.dtype != object:
+        return values, values
+    results = list()
+    for split in (lambda x: x.split(":")[0], lambda x: x.partition(":")[2] if ":" in x else x):
+        new_categories, mapping = np.unique(np.array([split(x) for x in categories], dtype=object),
+                                            return_inverse=True)
+        codes = np.where(values.codes < 0, -1, mapping.take(np.maximum(values.codes, 0)))
+        results.append(pd.Categorical.from_codes(codes, categories=new_categories))
+    return tuple(results)
+
+
+def union_categories(dfs):
+    """
+    Give the categorical columns of several frames the same categories, so that they stay categorical when the
+    frames are concatenated
+    :param dfs: list of DataFrames
+    :return: list of DataFrames
+    """
+    if len(dfs) <= 1:
+        return dfs
+    for c in dfs[0].columns:
+        if not all(c in df.columns and is_categorical_dtype(df[c].dtype) for df in dfs):
+            continue
+        categories = sorted(set().union(*[df[c].cat.categories for df in dfs]))
+        for df in dfs:
+            df[c] = df[c].cat.set_categories(categories)
+    return dfs
+
+
+def blank_values(values):
+    """
+    Find missing values and strings that are empty or only whitespace
+    :param values: Series
+    :return: boolean array
+    """
+    blank = values.isna().values
+    if is_categorical_dtype(values.dtype):
+        blank_categories = np.array([len(str(x).strip()) == 0 for x in values.cat.categories], dtype=bool)
+        present = ~blank
+        blank[present] |= blank_categories.take(values.cat.codes.values[present])
+    elif values.dtype == object:
+        positions, uniques = pd.factorize(values)
+        blank_uniques = np.array([len(str(x).strip()) == 0 for x in uniques], dtype=bool)
+        present = positions >= 0
+        blank[present] |= blank_uniques.take(positions[present])
+    return blank
+
 
 def split_columns_df(df, code_column_postfix = " code", store_code = False):
-    split_columns = [x.strip() for x in """    
-Age
-AGE
-Country / region of origin
-COUNTRY_ORIGIN
-Destination region
-REGION_DEST
-Field of education
-EDU_FIELD
-Funding flow
-FUND_FLOW
-Grade
-GRADE
-Immigration status
-IMM_STATUS
-Infrastructure
-INFRASTR
-Level of education
-EDU_LEVEL
-Level of educational attainment
-EDU_ATTAIN
-Location
-LOCATION
-Orientation
-Reference area
-REF_AREA
-School subject
-SUBJECT
-Sex
-SEX
-Socioeconomic background
-SE_BKGRD
-Source of funding
-Statistical unit
-STAT_UNIT
-Teaching experience
-TEACH_EXPERIENCE
-Time Period
-TIME_PERIOD
-Type of contract
-CONTRACT_TYPE
-Type of education
-EDU_TYPE
-Type of expenditure
-EXPENDITURE_TYPE
-Type of institution
-Unit of measure
-UNIT_MEASURE
-Wealth quintile
-WEALTH_QUINTILE
-""".split("\n") if len(x) and x in df.columns]
-    new_df=pd.DataFrame()
+    split_columns = SCHEMA.get_split_columns(df.columns)
+    columns = dict()
+    column_order = list()
     for c in split_columns:
-#        values = [":".join(x.split(":")[1:]).replace("Not applicable","NA") for x in df[c].values]
-        def cleanval(x):
-            if isinstance(x,str):
-                if ":" in x:
-                    return ":".join(x.split(":")[1:])
-            return x
-        values = [cleanval(x) for x in df[c].values]
-        new_df[c]=values
+        codes, labels = split_code_label(df[c])
+        columns[c] = labels
+        column_order.append(c)
         if store_code:
             cc = c + code_column_postfix
-            codes = [x.split(":")[0] for x in df[c].values]
-            new_df[cc]=codes
-    for c in [x for x in df.columns if x not in split_columns]:
-        new_df[c]=df[c].values
-    return new_df
+            columns[cc] = codes
+            column_order.append(cc)
+    split_set = set(split_columns)
+    for c in [x for x in df.columns if x not in split_set]:
+        columns[c] = df[c].values
+        column_order.append(c)
+    return pd.DataFrame(columns, columns=column_order)
 
 def expand_time_columns_df(df, time_column="TIME_PERIOD", value_column="OBS_VALUE"):
     year_columns = [y for y in df.columns if str(y).isdigit()]
     copy_columns = [c for c in df.columns if c not in year_columns]
-    new_df=pd.DataFrame(columns = copy_columns+[time_column, value_column])
+    if not year_columns:
+        return pd.DataFrame(columns = copy_columns+[time_column, value_column])
     dfc = df[copy_columns]
+    dfblocks = list()
     for y in year_columns:
         dfblock = dfc.copy()
         dfblock[time_column] = y
         dfblock[value_column] = df[y].values
-        new_df = new_df.append(dfblock, ignore_index=True)
-    return new_df
-
-def add_hxl_tags(df, time_column = "TIME_PERIOD", value_column = "OBS_VALUE", code_column_postfix = " code"):
-    """Add the HXL tags to dataframe.
-    """
-    column_definition="""    
-Age                                        #group+age
-Country / region of origin                 #country+origin
-Destination region                         #region+destination
-Field of education                         #indicator+education+field+name
-Funding flow                               #indicator+funding+flow+name
-Grade                                      #indicator+grade
-Immigration status                         #indicator+immigration+status
-Infrastructure                             #indicator+infrastructure
-Level of education                         #group+education+level
-Level of educational attainment            #group+education+level+attainment
-Location                                   #geo+location+type
-Orientation                                #indicator+orientation
-Reference area                             #geo+reference+area
-School subject                             #indicator+school+subject+name
-Sex                                        #group+sex
-Socioeconomic background                   #group+socioeconomic+background
-Source of funding                          #indicator+funding+source
-Statistical unit                           #indicator+statistical+unit
-Teaching experience                        #indicator+teaching+experience
-Time Period                                #date
-Type of contract                           #indicator+contract+name
-Type of education                          #indicator+education+type+name
-Type of expenditure                        #indicator+expenditure+type+name
-Type of institution                        #indicator+institution+type+name
-Unit of measure                            #meta+unit+measure+name
-Wealth quintile                            #indicator+wealth+quintile+name
-
-AGE                                        #group+age
-BASIC_SERVICES                             #indicator+basic+services
-CONTRACT_TYPE                              #indicator+contract+name
-CLASS_TYPE                                 #indicator+class+name
-COUNTRY_ORIGIN                             #country+origin
-EDU_ATTAIN                                 #group+education+level+attainment
-EDU_CAT                                    #indicator+education+category+name
-EDU_FIELD                                  #indicator+education+field+name
-EDU_LEVEL                                  #group+education+level
-EDU_TYPE                                   #indicator+education+type+name
-FUND_FLOW                                  #indicator+funding+flow+name
-GRADE                                      #indicator+grade
-IMM_STATUS                                 #indicator+immigration+status
-INFRASTR                                   #indicator+infrastructure
-FREQ                                       #indicator+frequency
-LOCATION                                   #geo+location+type
-REF_AREA                                   #geo+reference+area
-REGION_DEST                                #region+destination
-SUBJECT                                    #indicator+school+subject+name
-SECTOR_EDU                                 #indicator+sector+name
-SEX                                        #group+sex
-SE_BKGRD                                   #group+socioeconomic+background
-SOURCE_FUND                                #indicator+funding+source
-STAT_UNIT                                  #indicator+statistical+unit
-TEACH_EXPERIENCE                           #indicator+teaching+experience
-TIME_PERIOD                                #date
-EXPENDITURE_TYPE                           #indicator+expenditure+type+name
-UNIT_MEASURE                               #meta+unit+measure+name
-UNIT_MULT                                  #meta+unit+mult+name
-DECIMALS                                   #meta+decimals
-WEALTH_QUINTILE                            #indicator+wealth+quintile+name
-DISPERSION
-OBS_STATUS
-TEXTB_TYPE
-    """.split('\n')
+        dfblocks.append(dfblock)
+    return pd.concat(dfblocks, ignore_index=True)
 
+def get_hxl_tags(columns, time_column = "TIME_PERIOD", value_column = "OBS_VALUE", code_column_postfix = " code"):
+    """
+    HXL tags of the columns of a dataframe. They are kept apart from the data (so that columns keep their types)
+    and only written out as the second row of the csv by write_csv.
+    :param columns: column names
+    :param time_column: name of the column with the year
+    :param value_column: name of the column with the values
+    :param code_column_postfix: postfix of code columns
+    :return: dictionary column name -> HXL tag
+    """
     hxl={time_column : "#date", value_column : "#indicator+value+num"}
-    for x in column_definition:
-        v=x.split("#")
-        if len(v)!=2:
-            continue
-        column_name = v[0].strip()
-        column_hxl = "#"+(" ".join(v[1:])) if len(v)>1 else ""
-        if column_name in df.columns:
-            hxl[column_name]=column_hxl
-        column_name += code_column_postfix
-        column_hxl += "+code" if len(column_hxl)>1 else ""
-        if column_name in df.columns:
-            hxl[column_name]=column_hxl
-
-    return pd.DataFrame(data=[hxl],columns=df.columns).append(df,ignore_index=True)
+    hxl.update(SCHEMA.get_hxl_tags(columns, code_column_postfix=code_column_postfix))
+    return hxl
 
 def process_df(df, code_column_postfix = " code", store_code = False, time_column = "TIME_PERIOD", value_column = "OBS_VALUE"):
     """
@@ -270,50 +233,84 @@ def process_df(df, code_column_postfix = " code", store_code = False, time_colum
     Code (id) is removed from string values and optionally (if store_code is True) saved in "code" columns (with column name postfixed by code_column_postfix).
     All time-period columns are put into separate rows, original period is stored in time_column, value in value_column.
     Rows without values are removed.
-    HXL tags are added.
+    HXL tags of the columns are returned alongside.
     :param df: DataFrame with input data
     :param code_column_postfix: postfix fo code columns (used only if store_code is True)
     :param store_code: contrrolls whether code part of string values is stored
     :param time_column: name of a column to store the year
     :param value_column: name of the column to store the values
-    :return: resulting DataFrame
+    :return: resulting DataFrame, dictionary column name -> HXL tag
     """
     #df = df.drop(columns="TIME_PERIOD") # Drop this columns because it is redundant - codes are present in string values
     df = split_columns_df(df, code_column_postfix = code_column_postfix, store_code = store_code)
     #df = expand_time_columns_df(df, time_column = time_column, value_column = value_column)
 
     # Remove rows lacking a value
-    index = ~(df[value_column].isna() | np.array([len(str(x).strip())==0 for x in df[value_column]]))
+    index = ~blank_values(df[value_column])
     df1 = df.loc[index].sort_values(by=[time_column]) # select and sort
 
-    df2 = add_hxl_tags(df1, time_column = time_column, value_column = value_column, code_column_postfix = code_column_postfix)
-    return df2
+    hxltags = get_hxl_tags(df1.columns, time_column = time_column, value_column = value_column, code_column_postfix = code_column_postfix)
+    return df1, hxltags
 
 def postprocess_df(df):
     "Do final adjustments to the dataframe before publishing."
     return expand_column_labels(df)
 
 def split_df_by_column(df, column):
+    """
+    Split dataframe into parts by value of a column in a single pass: rows are stably sorted by the (sorted) codes
+    of the column's values once and each part is a slice of that order. Rows without a value are left out.
+    :param df: DataFrame
+    :param column: column to split by or None to not split
+    :return: generator of (value, DataFrame without column) in order of value
+    """
     if column is None:
         yield None, df
+        return
+    if len(df) == 0:
+        return
+    values = df[column]
+    if is_categorical_dtype(values):
+        categories = np.asarray(values.cat.categories)
+        ranks = np.argsort(np.argsort(categories, kind='mergesort'))
+        codes = values.cat.codes.values
+        codes = np.where(codes >= 0, ranks[codes], -1)
+        categories = np.sort(categories)
     else:
-        tags = df.iloc[[0], :]
-        data = df.iloc[1:, :]
-        other_columns = [c for c in df.columns if c!=column]
-        for x in (sorted(data[column].unique())):
-            df_part = tags[other_columns].append(data.loc[data[column]==x,other_columns], ignore_index=True)
-            yield x, df_part
+        codes, categories = pd.factorize(values, sort=True)
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    data = df[[c for c in df.columns if c!=column]]
+    for start, end in zip(starts, ends):
+        code = sorted_codes[start]
+        if code >= 0:
+            yield categories[code], data.iloc[order[start:end]]
 
 def remove_useless_columns_from_df(df):
-    data = df.iloc[1:, :]
     for c in df.columns:
-        values = data[c].unique()
+        values = df[c].unique()
         if len(values)==1:
             if isinstance(values[0], str):
                 if values[0].lower() in ["total", "_t", "not applicable", "_z", "na"] or str(values[0]).lower().startswith("all "):
                     df=df.drop(columns=c)
     return df
 
+def write_csv(df, path, hxltags):
+    """
+    Write dataframe to csv with the HXL tags as the row below the header
+    :param df: DataFrame
+    :param path: path of csv file
+    :param hxltags: list of HXL tags in the order of the columns
+    :return: None
+    """
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(df.columns)
+        writer.writerow(hxltags)
+        df.to_csv(f, index=False, header=False)
+
 
 def create_dataset_showcase(name, countryname, countryiso2, countryiso3, single_dataset=False):
     slugified_name = slugify(name).lower()
@@ -350,68 +347,788 @@ def create_dataset_showcase(name, countryname, countryiso2, countryiso3, single_
 
     return dataset, showcase
 
-def load_safely(downloader, url):
+def spool_response(response, url, path):
     """
-    Safely load data from URL - wait if quota is exceeded
+    Stream the body of a response to a file
+    :param response: response object requested with stream=True
+    :param url: url the response is for
+    :param path: path of file to write
+    :return: None
+    """
+    try:
+        with open(path, 'wb') as f:
+            for block in response.iter_content(STREAM_BLOCK_SIZE):
+                f.write(block)
+    except Exception as e:
+        raisefrom(DownloadError, 'Download of %s failed in retrieval of stream!' % url, e)
+    finally:
+        response.close()
+
+
+def load_safely(downloader, url, path=None):
+    """
+    Safely load data from URL - back off if quota is exceeded
     :param downloader: Downloader object
     :param url: url to fetch
+    :param path: if given, the response is streamed to a file at path rather than read into memory
     :return: response object
     """
+    return load_timed(downloader, url, path)[0]
+
+
+def load_timed(downloader, url, path=None):
+    """
+    Safely load data from URL as load_safely does, timing the transfer of the response that succeeded. Failed
+    attempts, backing off after quota errors and waiting for the rate limiter are not included.
+    :param downloader: Downloader object
+    :param url: url to fetch
+    :param path: if given, the response is streamed to a file at path rather than read into memory
+    :return: (response object or None, seconds of the transfer)
+    """
     response = None
+    seconds = 0.0
+    attempt = 0
+    get_wait = getattr(downloader, 'get_wait', None)
     while response is None:
         try:
-            response = downloader.download(url)
+            start = default_timer()
+            if path is None:
+                response = downloader.download(url)
+            else:
+                response = downloader.download(url, stream=True)
+                spool_response(response, url, path)
+            seconds = default_timer() - start
+            if get_wait is not None:
+                seconds = max(seconds - get_wait(), 0.0)
         except DownloadError:
             exc_info = sys.exc_info()
             tp, val, tb = exc_info
             if 'Quota Exceeded' in str(val.__cause__):
-                logger.info('Sleeping for one minute')
-                time.sleep(60)
+                wait_for_quota(downloader, attempt, get_retry_after(val))
+                attempt += 1
             elif 'Not Found' in str(val.__cause__):
                 logger.exception("Resource not found: %s"%url)
-                return None
+                return None, seconds
             else:
                 logger.exception("UNFORSEEN ERROR: %s"%url)
                 response = None
                 #reraise(*exc_info)
-    return response
+            increment('retries')
+    return response, seconds
+
+
+def read_csv_in_chunks(path, categorical_columns=None, chunksize=100000, value_column='OBS_VALUE'):
+    """
+    Read a downloaded csv file in chunks of rows, dropping rows without a value as it goes
+    :param path: path of csv file
+    :param categorical_columns: columns (such as dimensions) to read as category dtype
+    :param chunksize: number of rows parsed at once
+    :param value_column: name of the column with the values
+    :return: (DataFrame, number of rows read including those without a value)
+    """
+    dtype = None
+    if categorical_columns:
+        columns = pd.read_csv(path, encoding="ISO-8859-1", nrows=0).columns
+        dtype = {c: 'category' for c in columns if c in categorical_columns}
+    dfs = list()
+    rows = 0
+    for df in pd.read_csv(path, encoding="ISO-8859-1", dtype=dtype, chunksize=chunksize):
+        rows += len(df)
+        if value_column in df.columns:
+            df = df.loc[~blank_values(df[value_column])]
+        dfs.append(df)
+    if not dfs:
+        return pd.read_csv(path, encoding="ISO-8859-1", dtype=dtype), rows
+    if len(dfs) == 1:
+        return dfs[0], rows
+    return pd.concat(union_categories(dfs)), rows
+
+
+def decode_sdmx_json_data(json, time_column='TIME_PERIOD', value_column='OBS_VALUE'):
+    """
+    Decode an SDMX-JSON data message into the dataframe a csv response of the same data parses to, with dimensions
+    as categories of "code:label" strings (so that they are processed the same way) and attributes as codes.
+    Observation keys and attribute indices are decoded with NumPy for all observations at once.
+    :param json: SDMX-JSON data message (with series or with dimensionAtObservation=AllDimensions)
+    :param time_column: name of the time dimension, which is kept as years
+    :param value_column: name of the column to store the values
+    :return: DataFrame
+    """
+    structure = json['structure']
+    dimensions = structure['dimensions'].get('series', list()) + structure['dimensions'].get('observation', list())
+    attributes = structure.get('attributes', dict())
+    series_attributes = attributes.get('series', list())
+    observation_attributes = attributes.get('observation', list())
+    datasets = json.get('dataSets', list())
+    dataset = datasets[0] if datasets else dict()
+    keys = list()
+    observations = list()
+    series_attribute_indices = list()
+    if 'series' in dataset:
+        for series_key, series in dataset['series'].items():
+            series_observations = series.get('observations', dict())
+            keys.extend('%s:%s' % (series_key, key) for key in series_observations)
+            observations.extend(series_observations.values())
+            indices = series.get('attributes', list())
+            series_attribute_indices.extend([indices] * len(series_observations))
+    else:
+        observations_by_key = dataset.get('observations', dict())
+        keys.extend(observations_by_key)
+        observations.extend(observations_by_key.values())
+    if keys:
+        positions = np.array(':'.join(keys).split(':'), dtype=np.int64).reshape(len(keys), len(dimensions))
+    else:
+        positions = np.zeros((0, len(dimensions)), dtype=np.int64)
+
+    def attribute_values(attribute, indices):
+        ids = np.array([value.get('id') for value in attribute.get('values', list())] + [np.nan], dtype=object)
+        indices = np.array([np.nan if x is None else x for x in indices], dtype=float)
+        indices[np.isnan(indices)] = len(ids) - 1
+        return pd.to_numeric(pd.Series(ids[indices.astype(np.int64)]), errors='ignore').values
+
+    columns = dict()
+    for i, dimension in sorted(enumerate(dimensions), key=lambda x: x[1].get('keyPosition', x[0])):
+        values = dimension['values']
+        if dimension['id'] == time_column:
+            columns[dimension['id']] = np.array([int(value['id']) for value in values], dtype=np.int64)[positions[:, i]]
+        else:
+            categories = ['%s:%s' % (value['id'], value['name']) for value in values]
+            columns[dimension['id']] = pd.Categorical.from_codes(positions[:, i], categories=categories)
+    columns[value_column] = np.array([np.nan if not observation or observation[0] is None else observation[0]
+                                      for observation in observations], dtype=float)
+    for i, attribute in enumerate(series_attributes):
+        columns[attribute['id']] = attribute_values(attribute, [indices[i] if i < len(indices) else None
+                                                                for indices in series_attribute_indices])
+    for i, attribute in enumerate(observation_attributes):
+        columns[attribute['id']] = attribute_values(attribute, [observation[i + 1] if len(observation) > i + 1
+                                                                else None for observation in observations])
+    return pd.DataFrame(columns, columns=list(columns))
 
 
-def download_df(downloader, csv_url, start_year, end_year):
+def download_df(downloader, csv_url, start_year, end_year, categorical_columns=None, chunksize=None):
     """
-    Download dataframe from csv_url with a specified period
+    Download dataframe from csv_url with a specified period. If csv_url asks for SDMX-JSON rather than csv, the
+    response is decoded by decode_sdmx_json_data.
     :param downloader: Downloader object
     :param csv_url: URL prefix to fetch data from
     :param start_year: start year of the period
     :param end_year: end year of the period
+    :param categorical_columns: columns (such as dimensions) to read as category dtype
+    :param chunksize: if given, a csv response is streamed to a temporary file which is parsed this many rows at a
+    time, leaving out rows without a value (if None, the response is read into memory and parsed at once)
     :return: DataFrame or None in case of a failure
     """
     assert end_year >= start_year
     url_years = '&startPeriod=%d&endPeriod=%d' % (start_year, end_year)
     url = downloader.get_full_url('%s%s' % (csv_url, url_years))
-    response = load_safely(downloader, url)
-    if response is not None:
-        return pd.read_csv(BytesIO(response.content), encoding="ISO-8859-1")
+    start = default_timer()
+    if data_formats['sdmx-json'] in csv_url:
+        response, seconds = load_timed(downloader, url)
+        size = 0 if response is None else len(response.content)
+        df = None if response is None else decode_sdmx_json_data(response.json())
+        rows = None if df is None else len(df)
+    elif chunksize is not None:
+        fd, path = mkstemp(prefix='download_', suffix='.csv')
+        os.close(fd)
+        try:
+            response, seconds = load_timed(downloader, url, path)
+            size = os.path.getsize(path)
+            df, rows = (None, None) if response is None else read_csv_in_chunks(path, categorical_columns, chunksize)
+        finally:
+            os.remove(path)
+    else:
+        response, seconds = load_timed(downloader, url)
+        size = 0 if response is None else len(response.content)
+        df = None
+        if response is not None:
+            content = BytesIO(response.content)
+            dtype = None
+            if categorical_columns:
+                columns = pd.read_csv(content, encoding="ISO-8859-1", nrows=0).columns
+                content.seek(0)
+                dtype = {c: 'category' for c in columns if c in categorical_columns}
+            df = pd.read_csv(content, encoding="ISO-8859-1", dtype=dtype)
+        rows = None if df is None else len(df)
+    record('download_df', default_timer() - start)
+    increment('cached_bytes' if getattr(response, 'from_cache', False) else 'downloaded_bytes', size)
+    request_sizer = getattr(downloader, 'request_sizer', None)
+    if request_sizer is not None and df is not None and not getattr(response, 'from_cache', False):
+        request_sizer.record(rows, seconds)  # transfer only, with every row the API returned
+    if df is not None:
+        increment('rows_downloaded', len(df))
+    return df
+
+def download_dfs(downloader, requests, concurrency=1, categorical_columns=None, accumulators=None, chunksize=None):
+    """
+    Download dataframes for several periods, possibly of several endpoints
+    :param downloader: Downloader object
+    :param requests: list of (csv_url, start_year, end_year) tuples
+    :param concurrency: maximum number of requests in flight at once (1 downloads them one after another)
+    :param categorical_columns: columns (such as dimensions) to read as category dtype
+    :param accumulators: list of ChunkAccumulator per request to add each DataFrame to as soon as it is downloaded
+    :param chunksize: if given, stream responses to temporary files and parse them this many rows at a time
+    :return: list of DataFrames (None in case of a failure or if added to an accumulator) in the order of requests
+    """
+    if concurrency <= 1 or len(requests) <= 1:
+        dfs = list()
+        for i, request in enumerate(requests):
+            df = download_df(downloader, *request, categorical_columns=categorical_columns, chunksize=chunksize)
+            if accumulators is not None:
+                accumulators[i].add(df, i)
+                df = None
+            dfs.append(df)
+        return dfs
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        return loop.run_until_complete(download_dfs_async(downloader, requests, concurrency, executor,
+                                                          categorical_columns, accumulators, chunksize))
+    finally:
+        executor.shutdown()
+        loop.close()
+
+
+async def download_dfs_async(downloader, requests, concurrency, executor=None, categorical_columns=None,
+                             accumulators=None, chunksize=None):
+    """
+    Issue all requests at once on the running event loop, keeping at most concurrency of them in flight.
+    The blocking downloader is run in executor, so Quota Exceeded and Not Found are handled as in download_df.
+    :param downloader: Downloader object
+    :param requests: list of (csv_url, start_year, end_year) tuples
+    :param concurrency: maximum number of requests in flight at once
+    :param executor: executor to run the downloads in (if None, the loop's default executor is used)
+    :param categorical_columns: columns (such as dimensions) to read as category dtype
+    :param accumulators: list of ChunkAccumulator per request to add each DataFrame to as soon as it is downloaded,
+    keyed by the index of its request so that the order of the rows does not depend on the order downloads finish
+    :param chunksize: if given, stream responses to temporary files and parse them this many rows at a time
+    :return: list of DataFrames (None in case of a failure or if added to an accumulator) in the order of requests
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_event_loop()
+
+    async def fetch(i, request):
+        async with semaphore:
+            df = await loop.run_in_executor(executor, partial(download_df, downloader, *request,
+                                                              categorical_columns=categorical_columns,
+                                                              chunksize=chunksize))
+        if accumulators is None:
+            return df
+        accumulators[i].add(df, i)  # on the event loop, so accumulators need no locking
+        return None
+
+    return await asyncio.gather(*[fetch(i, request) for i, request in enumerate(requests)])
+
+
+class ChunkAccumulator(object):
+    """
+    Collects the chunks of data downloaded for an endpoint (one per year period or batch) and concatenates them
+    once, so that time and memory grow linearly with the number of chunks. Chunks added with an index are
+    concatenated in the order of their indexes, whatever the order they arrive in. If max_memory_mb is given, chunks
+    beyond it are spilled to pickle files in folder until they are concatenated.
+    """
+
+    def __init__(self, folder=None, max_memory_mb=None):
+        self.folder = folder
+        self.max_memory = None if max_memory_mb is None else max_memory_mb * 1024 * 1024
+        self.memory = 0
+        self.chunks = list()  # DataFrames or paths of spilled DataFrames
+        self.indexes = list()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, df, index=None):
+        """
+        Add a chunk
+        :param df: DataFrame or None (which is ignored)
+        :param index: position of the chunk among those of the accumulator (if None, after those already added)
+        :return: None
+        """
+        if df is None:
+            return
+        if index is None:
+            index = max(self.indexes) + 1 if self.indexes else 0
+        self.indexes.append(index)
+        if self.max_memory is not None:
+            size = df.memory_usage(deep=True).sum()
+            if self.memory + size > self.max_memory:
+                fd, path = mkstemp(prefix='chunk_', suffix='.pkl', dir=self.folder)
+                os.close(fd)
+                df.to_pickle(path)
+                self.chunks.append(path)
+                return
+            self.memory += size
+        self.chunks.append(df)
+
+    def concat(self):
+        """
+        Concatenate the chunks in the order of their indexes (with the categories of categorical columns unioned)
+        and empty the accumulator
+        :return: DataFrame or None if there are no chunks
+        """
+        chunks, self.chunks, self.memory = self.chunks, list(), 0
+        indexes, self.indexes = self.indexes, list()
+        dfs = list()
+        for _, chunk in sorted(zip(indexes, chunks), key=lambda x: x[0]):
+            if isinstance(chunk, str):
+                dfs.append(pd.read_pickle(chunk))
+                os.remove(chunk)
+            else:
+                dfs.append(chunk)
+        if not dfs:
+            return None
+        if len(dfs) == 1:
+            return dfs[0]
+        return pd.concat(union_categories(dfs))
+
 
 def chunk_years(time_periods, max_observations=None):
     """
-    Chunk years to periods with a number of observations limited by max_observations.
+    Chunk years to periods with a number of observations limited by max_observations in one pass from the latest
+    year back. Each period takes in years until the next would exceed the limit, which gives the minimum number of
+    periods: no other chunking can end any period later. A year whose observations alone exceed the limit cannot be
+    split by the API's period parameters, so it gets a period of its own. Years without observations never start a
+    period.
     :param time_periods: dictionary of years -> number of observations
-    :param max_observations: maximum numbver of observations (if None, default value is selected)
+    :param max_observations: maximum number of observations (if None, default value is selected)
     :return: generator yielding pairs of (start year, end year)
     """
     if max_observations is None:
         max_observations=MAX_OBSERVATIONS
 
-    years = np.sort(np.array(list(time_periods.keys())))[::-1]
-    observation_per_year = np.array([time_periods.get(int(y),0) for y in years])
+    start_year = end_year = None
+    observations = 0
+    for year in sorted(time_periods, reverse=True):
+        count = time_periods[year]
+        if end_year is not None and count > 0 and observations + count > max_observations:
+            yield start_year, end_year
+            end_year = None
+        if end_year is None:
+            end_year = year
+            observations = 0
+        start_year = year
+        observations += count
+        if count > max_observations:
+            logger.warning('%d observations in %d exceed the maximum per request of %d!' %
+                           (count, year, max_observations))
+    if end_year is not None:
+        yield start_year, end_year
+
+
+def get_max_observations(downloader, max_observations=None):
+    """
+    Get the maximum number of observations per data request: the given one, else the one learned by the request
+    sizer of the downloader, else the API limit
+    :param downloader: Downloader object
+    :param max_observations: maximum number of observations per request or None
+    :return: maximum number of observations per request
+    """
+    if max_observations is not None:
+        return max_observations
+    request_sizer = getattr(downloader, 'request_sizer', None)
+    if request_sizer is None:
+        return MAX_OBSERVATIONS
+    return request_sizer.get_max_observations()
+
+
+class ObservationIndex(object):
+    """
+    Observation counts of an endpoint from its endpoint-wide structure response (the dimensions returned by
+    get_endpoints_metadata): the total per country and the years with data. SDMX only counts observations per
+    dimension value, so the counts per year of a country are fetched with a per-country structure request, and only
+    for countries whose data does not fit in one request.
+    """
+
+    def __init__(self, dimensions):
+        self.totals = dict()
+        self.years = list()
+        for dimension in dimensions:
+            if dimension['id'] == 'REF_AREA':
+                self.totals = {value['id']: value['actualObs'] for value in dimension['values']
+                               if value.get('actualObs')}
+            elif dimension['id'] == 'TIME_PERIOD':
+                self.years = sorted(int(value['id']) for value in dimension['values'] if value.get('actualObs'))
+        self.time_periods = dict()
+
+    def get_observations(self, countryiso2):
+        return self.totals.get(countryiso2, 0)
+
+    def get_time_periods(self, downloader, structure_url, countryiso2, max_observations=None):
+        """
+        Get number of observations per year for a country where they are needed to chunk its requests
+        :param downloader: Downloader object
+        :param structure_url: structure url of the endpoint with %s for the reference area
+        :param countryiso2: country ISO2
+        :param max_observations: maximum number of observations per request (if None, default value is selected)
+        :return: dictionary of years -> number of observations (empty if there is no data) or None if all the data
+        fits in one request over the endpoint's years. If the endpoint-wide response counts no years, they are
+        fetched as for a country with too much data.
+        """
+        max_observations = get_max_observations(downloader, max_observations)
+        total = self.get_observations(countryiso2)
+        if total == 0:
+            return dict()
+        if total <= max_observations and self.years:
+            return None
+        if countryiso2 not in self.time_periods:
+            with timer('structure_fetch'):
+                response = load_safely(downloader, '%s%s' % (structure_url % countryiso2, dataurl_suffix))
+            self.time_periods[countryiso2] = dict() if response is None else get_time_periods(response.json())
+        return self.time_periods[countryiso2]
+
+    def get_periods(self, time_periods, max_observations=None):
+        """
+        Get the periods to request for a country
+        :param time_periods: result of get_time_periods
+        :param max_observations: maximum number of observations per request (if None, default value is selected)
+        :return: list of (start year, end year)
+        """
+        if time_periods is None:
+            if not self.years:
+                return list()
+            return [(self.years[0], self.years[-1])]
+        return [(int(start_year), int(end_year)) for start_year, end_year in chunk_years(time_periods, max_observations)]
+
+
+def get_dimension_columns(dimensions, time_column='TIME_PERIOD'):
+    """
+    Get the columns of the coded dimensions, which are read as categories
+    :param dimensions: dimensions of an endpoint
+    :param time_column: name of the time dimension, which is not coded
+    :return: set of column names
+    """
+    return {dimension['id'] for dimension in dimensions if dimension['id'] != time_column}
+
+
+def get_observation_indexes(endpoints_metadata):
+    """
+    Build the observation index of every endpoint from its metadata
+    :param endpoints_metadata: Endpoint datastructure from UNESCO API
+    :return: dictionary of endpoint -> ObservationIndex
+    """
+    return {endpoint: ObservationIndex(dimensions)
+            for endpoint, (indicator, structure_url, more_info_url, dimensions) in endpoints_metadata.items()}
+
+
+def get_data_url(structure_url, countryiso2s, ingest_format='csv'):
+    """
+    Get the url prefix of the data of countries
+    :param structure_url: structure url of the endpoint with %s for the reference area
+    :param countryiso2s: list of country ISO2s
+    :param ingest_format: 'csv' or 'sdmx-json'
+    :return: url prefix to which the period is appended
+    """
+    return '%s%s' % (structure_url % '+'.join(countryiso2s), data_formats[ingest_format])
+
+
+def get_time_periods_from_df(df, time_column='TIME_PERIOD', value_column='OBS_VALUE'):
+    """
+    Get number of observations per year from downloaded data, leaving out rows without a value so that the years
+    are the same whether or not they were dropped as the data was read
+    :param df: DataFrame
+    :param time_column: name of the column with the year
+    :param value_column: name of the column with the values
+    :return: dictionary of years -> number of observations
+    """
+    years = df[time_column]
+    if value_column in df.columns:
+        years = years[~blank_values(df[value_column])]
+    return {int(year): int(count) for year, count in years.value_counts().items()}
+
+
+def plan_data_requests(observations_by_country, max_observations=None, max_countries=None):
+    """
+    Plan data requests for many countries. Countries whose observations fit in one request are packed together
+    (first fit, largest first) into requests for several REF_AREA codes over the union of their years, each
+    within max_observations. Larger countries get their own request per period.
+    :param observations_by_country: dictionary of country ISO2 -> (number of observations, list of periods)
+    :param max_observations: maximum number of observations per request (if None, default value is selected)
+    :param max_countries: maximum number of countries per request (if None, default value is selected)
+    :return: list of (list of country ISO2s, start year, end year)
+    """
+    if max_observations is None:
+        max_observations = MAX_OBSERVATIONS
+    if max_countries is None:
+        max_countries = MAX_BATCH_COUNTRIES
+    requests = list()
+    bins = list()
+    for countryiso2 in sorted(observations_by_country, key=lambda x: (-observations_by_country[x][0], x)):
+        observations, periods = observations_by_country[countryiso2]
+        if observations == 0 or not periods:
+            continue
+        if observations > max_observations:
+            for start_year, end_year in periods:
+                requests.append(([countryiso2], start_year, end_year))
+            continue
+        for batch in bins:
+            if batch['observations'] + observations <= max_observations and len(batch['countries']) < max_countries:
+                break
+        else:
+            batch = {'observations': 0, 'countries': list(), 'years': list()}
+            bins.append(batch)
+        batch['observations'] += observations
+        batch['countries'].append(countryiso2)
+        for period in periods:
+            batch['years'].extend(period)
+    for batch in bins:
+        requests.append((sorted(batch['countries']), min(batch['years']), max(batch['years'])))
+    return requests
+
+
+def split_df_by_country(df, ref_area_column='REF_AREA'):
+    """
+    Split data of several countries by the code in the reference area column
+    :param df: DataFrame with data of several countries
+    :param ref_area_column: column holding the country as code or CODE:Label
+    :return: generator yielding pairs of (country ISO2, DataFrame)
+    """
+    codes = df[ref_area_column].astype(str).str.split(':').str[0]
+    categorical_columns = [c for c in df.columns if is_categorical_dtype(df[c].dtype)]
+    for countryiso2 in sorted(codes.unique()):
+        df_country = df.loc[(codes == countryiso2).values].reset_index(drop=True)
+        for c in categorical_columns:
+            df_country[c] = df_country[c].cat.remove_unused_categories()
+        yield countryiso2, df_country
+
+
+class BatchedData(object):
+    """
+    Data of many countries downloaded with multi-country requests. The data is split back per country and
+    spooled to folder, so that it does not have to be held in memory until each country is processed.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.paths = dict()
+
+    def fetch(self, downloader, endpoint, structure_url, observation_index, countryiso2s, max_observations=None,
+              concurrency=1, categorical_columns=None, chunksize=None, ingest_format='csv'):
+        """
+        Download the data of an endpoint for many countries
+        :param downloader: Downloader object
+        :param endpoint: endpoint
+        :param structure_url: structure url of the endpoint with %s for the reference area
+        :param observation_index: ObservationIndex of the endpoint
+        :param countryiso2s: list of country ISO2s
+        :param max_observations: maximum number of observations per request (if None, default value is selected)
+        :param concurrency: maximum number of requests in flight at once
+        :param categorical_columns: columns (such as dimensions) to read as category dtype
+        :param chunksize: if given, stream responses to temporary files and parse them this many rows at a time
+        :param ingest_format: format in which to download the data: 'csv' or 'sdmx-json'
+        :return: number of requests made
+        """
+        max_observations = get_max_observations(downloader, max_observations)
+        observations_by_country = dict()
+        for countryiso2 in countryiso2s:
+            time_periods = observation_index.get_time_periods(downloader, structure_url, countryiso2, max_observations)
+            if time_periods == dict():
+                continue
+            observations_by_country[countryiso2] = (observation_index.get_observations(countryiso2),
+                                                    observation_index.get_periods(time_periods, max_observations))
+        requests = plan_data_requests(observations_by_country, max_observations)
+        logger.info('Downloading %s for %d countries in %d requests' %
+                    (endpoint, len(observations_by_country), len(requests)))
+        group_size = max(concurrency, 1)
+        for i in range(0, len(requests), group_size):
+            group = requests[i:i + group_size]
+            dfs = download_dfs(downloader, [(get_data_url(structure_url, countries, ingest_format), start_year, end_year)
+                                            for countries, start_year, end_year in group], concurrency=concurrency,
+                               categorical_columns=categorical_columns, chunksize=chunksize)
+            for (countries, start_year, end_year), df in zip(group, dfs):
+                if df is None:
+                    continue
+                for countryiso2, df_country in split_df_by_country(df):
+                    path = join(self.folder, 'batch_%s_%s_%d_%d.pkl' % (endpoint, countryiso2, start_year, end_year))
+                    df_country.to_pickle(path)
+                    self.paths.setdefault((endpoint, countryiso2), list()).append(path)
+        return len(requests)
+
+    def get_dfs(self, endpoint, countryiso2):
+        return [pd.read_pickle(path) for path in self.paths.get((endpoint, countryiso2), list())]
+
+    def get_accumulator(self, endpoint, countryiso2, max_chunk_memory_mb=None):
+        """
+        Get the data of an endpoint for a country
+        :param endpoint: endpoint
+        :param countryiso2: country ISO2
+        :param max_chunk_memory_mb: memory for chunks of data beyond which they are spilled to folder
+        :return: ChunkAccumulator with the data
+        """
+        accumulator = ChunkAccumulator(self.folder, max_chunk_memory_mb)
+        for df in self.get_dfs(endpoint, countryiso2):
+            accumulator.add(df)
+        return accumulator
+
+
+def get_batched_data(downloader, endpoints_metadata, observation_indexes, countriesdata, folder, concurrency=1,
+                     chunksize=None, ingest_format='csv'):
+    """
+    Download the data of all endpoints for all countries with multi-country requests
+    :param downloader: Downloader object
+    :param endpoints_metadata: Endpoint datastructure from UNESCO API
+    :param observation_indexes: dictionary of endpoint -> ObservationIndex
+    :param countriesdata: Countries datastructure from UNESCO API
+    :param folder: temporary folder
+    :param concurrency: maximum number of requests in flight at once
+    :param chunksize: if given, stream responses to temporary files and parse them this many rows at a time
+    :param ingest_format: format in which to download the data: 'csv' or 'sdmx-json'
+    :return: BatchedData
+    """
+    batched_data = BatchedData(folder)
+    countryiso2s = [countrydata['id'] for countrydata in countriesdata
+                    if not is_aggregate(countrydata['names'][0]['value'])]
+    for endpoint in sorted(endpoints_metadata):
+        indicator, structure_url, more_info_url, dimensions = endpoints_metadata[endpoint]
+        batched_data.fetch(downloader, endpoint, structure_url, observation_indexes[endpoint], countryiso2s,
+                           concurrency=concurrency, categorical_columns=get_dimension_columns(dimensions),
+                           chunksize=chunksize, ingest_format=ingest_format)
+    return batched_data
+
+
+def get_country(countrydata, country_index=None):
+    """
+    Get the codes and name of a country, ignoring aggregates
+    :param countrydata: Country datastructure from UNESCO API
+    :param country_index: CountryIndex of resolved CL_AREA entries or None to resolve the entry here
+    :return: (country ISO2, country name, country ISO3) or None if it is an aggregate or has no ISO3 code
+    """
+    countryiso2 = countrydata['id']
+    countryname = countrydata['names'][0]['value']
+    logger.info("Processing %s"%countryname)
+
+    if country_index is None:
+        entry = resolve_country(countryiso2, countryname)
+    else:
+        entry = country_index.resolve(countryiso2, countryname)
+    if entry['aggregate']:
+        logger.info('Ignoring %s!' % countryname)
+        return None
+    countryiso3 = entry['iso3']
+    if countryiso3 is None:
+        logger.exception('Cannot get iso3 code for %s!' % countryname)
+        return None
+    if entry['match'] == 'fuzzy':
+        logger.info('Matched %s to %s!' % (countryname, countryiso3))
+    return countryiso2, countryname, countryiso3
+
+
+def plan_endpoint(downloader, countryiso2, endpoint, endpoint_metadata, merge_resources=True,
+                  observation_index=None, max_observations=None, ingest_format='csv'):
+    """
+    Get the time periods of an endpoint for a country and the periods to request
+    :param downloader: Downloader object
+    :param countryiso2: country ISO2
+    :param endpoint: endpoint
+    :param endpoint_metadata: (indicator, structure url, more info url, dimensions) of the endpoint
+    :param merge_resources: if true, merge resources for all time periods
+    :param observation_index: ObservationIndex used instead of a structure request when merging resources
+    :param max_observations: maximum number of observations per request (if None, default value is selected)
+    :param ingest_format: format in which to download the data: 'csv' or 'sdmx-json'
+    :return: (endpoint, structure name, data url, time periods, periods). time periods is None if only the number of
+    observations is known.
+    """
+    indicator, structure_url, more_info_url, dimensions = endpoint_metadata
+    if observation_index is None or not merge_resources:
+        with timer('structure_fetch'):
+            response = load_safely(downloader, '%s%s' % (structure_url % countryiso2, dataurl_suffix))
+        json = response.json()
+        structure_name = json['structure']['name']
+        time_periods = get_time_periods(json)
+        periods = list(chunk_years(time_periods, max_observations))
+    else:
+        structure_name = indicator
+        time_periods = observation_index.get_time_periods(downloader, structure_url, countryiso2, max_observations)
+        periods = list() if time_periods == dict() else observation_index.get_periods(time_periods, max_observations)
+    data_url = get_data_url(structure_url, [countryiso2], ingest_format)
+    return endpoint, structure_name, data_url, time_periods, periods
+
+
+def download_endpoint(downloader, data_url, periods, dimensions, folder, max_chunk_memory_mb=None,
+                      stream_chunksize=None, accumulator=None, concurrency=1):
+    """
+    Download the data of an endpoint for a country, unless it was downloaded already
+    :param downloader: Downloader object
+    :param data_url: url prefix of the data
+    :param periods: list of (start year, end year) to request
+    :param dimensions: dimensions of the endpoint
+    :param folder: temporary folder
+    :param max_chunk_memory_mb: memory for downloaded chunks of data beyond which they are spilled to folder
+    :param stream_chunksize: if given, stream data responses to temporary files and parse them this many rows at a time
+    :param accumulator: ChunkAccumulator with the data if it was downloaded already or None
+    :param concurrency: maximum number of period downloads in flight at once
+    :return: DataFrame or None if there is no data
+    """
+    if accumulator is None:
+        accumulator = ChunkAccumulator(folder, max_chunk_memory_mb)
+        download_dfs(downloader, [(data_url, start_year, end_year) for start_year, end_year in periods],
+                     concurrency=concurrency, categorical_columns=get_dimension_columns(dimensions),
+                     accumulators=[accumulator] * len(periods), chunksize=stream_chunksize)
+    return accumulator.concat()
+
+
+def get_description(indicator, more_info_url):
+    description = more_info_url
+    if description != ' ':
+        description = '[Info on %s](%s)' % (indicator, description)
+    return 'To save, right click download button & click Save Link/Target As  \n%s' % description
+
+
+def transform_endpoint(df, countryiso3, endpoint, indicator, dimensions, split_to_resources_by_column="STAT_UNIT",
+                       remove_useless_columns=True):
+    """
+    Process the data of an endpoint for a country into the parts published as resources. Only uses pandas, so that
+    it can run in another process.
+    :param df: DataFrame with the downloaded data
+    :param countryiso3: country ISO3
+    :param endpoint: endpoint
+    :param indicator: name of the endpoint
+    :param dimensions: dimensions of the endpoint
+    :param split_to_resources_by_column: split data into multiple resorces (csv) based on a value in the specified column
+    :param remove_useless_columns: if true, drop columns with a single uninformative value
+    :return: list of (resource name, csv file name, DataFrame, HXL tags, resource description)
+    """
+    stat = {x["id"]: x["name"] for d in dimensions if d["id"] == "STAT_UNIT" for x in d["values"]}
+    increment('rows_processed', len(df))
+    with timer('process_df'):
+        df, hxltags = process_df(df)
+    hxltags['country-iso3'] = '#country+iso3'
+    hxltags['Indicator name'] = '#indicator+name'
+    parts = list()
+    for value, df_part in timed_iter('split_df_by_column', split_df_by_column(df, split_to_resources_by_column)):
+        filename = ("UNESCO_%s_%s.csv" % (countryiso3, endpoint + ("" if value is None else "_"+value))
+                    ).replace(" ", "-").replace(":", "-").replace("/","-").replace(",","-").replace("(","-")\
+            .replace(")","-")
+        if remove_useless_columns:
+            df_part = remove_useless_columns_from_df(df_part)
+        df_part = df_part.assign(**{"country-iso3": countryiso3, "Indicator name": value})
+        tags_part = [hxltags.get(c) for c in df_part.columns]
+        df_part = postprocess_df(df_part)
+        description_part = stat.get(value,'Info on %s%s' % ("" if value is None else value+" in ", indicator))
+        parts.append((value, filename, df_part, tags_part, description_part))
+    return parts
+
+
+def write_resources(dataset, folder, parts):
+    """
+    Write the parts of an endpoint's data to csv files and add them to a dataset as resources
+    :param dataset: Dataset
+    :param folder: folder to write to
+    :param parts: list returned by transform_endpoint
+    :return: None
+    """
+    for value, filename, df_part, tags_part, description_part in parts:
+        file_csv = join(folder, filename)
+        with timer('write_csv'):
+            write_csv(df_part, file_csv, tags_part)
+        increment('rows_written', len(df_part))
+        resource = Resource({
+            'name': value,
+            'description': description_part
+        })
+        resource.set_file_type('csv')
+        resource.set_file_to_upload(file_csv)
+        dataset.add_update_resource(resource)
 
-    while len(years):
-        cumulative_sum = np.cumsum(observation_per_year)
-        selection =  cumulative_sum <= max(max_observations, cumulative_sum[0])
-        yield years[selection].min(),years[selection].max()
-        years = years[~selection]
-        observation_per_year=observation_per_year[~selection]
 
 def generate_dataset_and_showcase(downloader,
                                   countrydata,
@@ -420,7 +1137,15 @@ def generate_dataset_and_showcase(downloader,
                                   merge_resources=True,
                                   single_dataset=False,
                                   split_to_resources_by_column = "STAT_UNIT",
-                                  remove_useless_columns = True):
+                                  remove_useless_columns = True,
+                                  fetch_concurrency = 1,
+                                  observation_indexes = None,
+                                  batched_data = None,
+                                  max_chunk_memory_mb = None,
+                                  stream_chunksize = None,
+                                  ingest_format = 'csv',
+                                  checkpoint = None,
+                                  country_index = None):
     """
     https://api.uis.unesco.org/sdmx/data/UNESCO,DEM_ECO/....AU.?format=csv-:-tab-true-y&locale=en&subscription-key=...
 
@@ -432,27 +1157,26 @@ def generate_dataset_and_showcase(downloader,
     :param single_dataset: if true, put all endpoints into a single dataset
     :param split_to_resources_by_column: split data into multiple resorces (csv) based on a value in the specified column
     :param remove_useless_columns:
+    :param fetch_concurrency: maximum number of period downloads in flight at once across all endpoints
+    :param observation_indexes: dictionary of endpoint -> ObservationIndex used instead of per-country structure requests
+    when merging resources
+    :param batched_data: BatchedData already downloaded for many countries at once (needs observation_indexes)
+    :param max_chunk_memory_mb: memory for downloaded chunks of data beyond which they are spilled to folder
+    (if None, they are all kept in memory)
+    :param stream_chunksize: if given, stream data responses to temporary files and parse them this many rows at a
+    time (if None, responses are read into memory)
+    :param ingest_format: format in which to download the data: 'csv' or 'sdmx-json' (resources linking to the data
+    when not merging are always csv)
+    :param checkpoint: Checkpoint recording the data fetched and datasets generated per endpoint, from which
+    endpoints recorded in an interrupted run are resumed (only used for a dataset per endpoint with merged resources)
+    :param country_index: CountryIndex of resolved CL_AREA entries or None to resolve the country here
     :return: generator yielding (dataset, showcase) tuples. It may yield None, None.
     """
-    countryiso2 = countrydata['id']
-    countryname = countrydata['names'][0]['value']
-    logger.info("Processing %s"%countryname)
-
-    if countryname[:4] in ['WB: ', 'SDG:', 'MDG:', 'UIS:', 'EFA:'] or countryname[:5] in ['GEMR:', 'AIMS:'] or \
-            countryname[:7] in ['UNICEF:', 'UNESCO:']:
-        logger.info('Ignoring %s!' % countryname)
+    country = get_country(countrydata, country_index)
+    if country is None:
         yield None, None
         return
-
-    countryiso3 = Country.get_iso3_from_iso2(countryiso2)
-
-    if countryiso3 is None:
-        countryiso3, _ = Country.get_iso3_country_code_fuzzy(countryname)
-        if countryiso3 is None:
-            logger.exception('Cannot get iso3 code for %s!' % countryname)
-            yield None, None
-            return
-        logger.info('Matched %s to %s!' % (countryname, countryiso3))
+    countryiso2, countryname, countryiso3 = country
 
     earliest_year = 10000
     latest_year = 0
@@ -464,82 +1188,95 @@ def generate_dataset_and_showcase(downloader,
         if dataset is None:
             return
 
+    if single_dataset or not merge_resources:
+        checkpoint = None
+    max_observations = get_max_observations(downloader)
+    endpoints = list()
+    resumed = dict()
     for endpoint in sorted(endpoints_metadata):
-        time.sleep(0.2)
+        checkpoint_record = None if checkpoint is None else checkpoint.get(countryiso2, endpoint)
+        if checkpoint_record is None:
+            pace(downloader)
+            observation_index = None if observation_indexes is None else observation_indexes[endpoint]
+            endpoints.append(plan_endpoint(downloader, countryiso2, endpoint, endpoints_metadata[endpoint],
+                                           merge_resources, observation_index, max_observations, ingest_format))
+        elif checkpoint_record['stage'] != 'published':
+            resumed[endpoint] = checkpoint_record
+            endpoints.append((endpoint, None, None, None, list()))
+
+    # Use data already downloaded in batches, or with concurrent fetching, download the periods of all endpoints
+    # together so that their requests overlap
+    downloaded = dict()
+    if merge_resources and batched_data is not None:
+        for endpoint, _, _, _, _ in endpoints:
+            if endpoint not in resumed:
+                downloaded[endpoint] = batched_data.get_accumulator(endpoint, countryiso2, max_chunk_memory_mb)
+    elif merge_resources and fetch_concurrency > 1:
+        requests = list()
+        accumulators = list()
+        for endpoint, _, data_url, _, periods in endpoints:
+            downloaded[endpoint] = ChunkAccumulator(folder, max_chunk_memory_mb)
+            for start_year, end_year in periods:
+                requests.append((data_url, start_year, end_year))
+                accumulators.append(downloaded[endpoint])
+        categorical_columns = set().union(*[get_dimension_columns(endpoints_metadata[endpoint][3])
+                                            for endpoint, _, _, _, _ in endpoints])
+        download_dfs(downloader, requests, concurrency=fetch_concurrency, categorical_columns=categorical_columns,
+                     accumulators=accumulators, chunksize=stream_chunksize)
+
+    for endpoint, structure_name, data_url, time_periods, periods in endpoints:
         indicator, structure_url, more_info_url, dimensions = endpoints_metadata[endpoint]
-        structure_url = structure_url % countryiso2
-        response = load_safely(downloader, '%s%s' % (structure_url, dataurl_suffix))
-        json = response.json()
+        checkpoint_record = resumed.get(endpoint)
+        df = None
+        if checkpoint_record is not None:
+            if checkpoint_record['stage'] == 'processed':
+                yield checkpoint.load_processed(checkpoint_record)
+                continue
+            structure_name, time_periods, df = checkpoint.load_fetched(checkpoint_record)
         if not single_dataset:
-            name = 'UNESCO %s - %s' % (json["structure"]["name"], countryname)
+            name = 'UNESCO %s - %s' % (structure_name, countryname)
             dataset, showcase = create_dataset_showcase(name, countryname, countryiso2, countryiso3, single_dataset=single_dataset)
             if dataset is None:
                 continue
-        observations = json['structure']['dimensions']['observation']
-        time_periods = dict()
-        for observation in observations:
-            if observation['id'] == 'TIME_PERIOD':
-                for value in observation['values']:
-                    time_periods[int(value['id'])] = value['actualObs']
-        if len(time_periods) == 0:
+
+        if merge_resources and checkpoint_record is None:
+            df = download_endpoint(downloader, data_url, periods, dimensions, folder, max_chunk_memory_mb,
+                                   stream_chunksize, downloaded.pop(endpoint, None))
+            if time_periods is None:  # only the number of observations was known up front
+                time_periods = dict() if df is None else get_time_periods_from_df(df)
+            if checkpoint is not None:
+                checkpoint.fetched(countryiso2, endpoint, structure_name, time_periods, df)
+        if not time_periods:
             logger.warning('No time periods for endpoint %s for country %s!' % (indicator, countryname))
             continue
 
         earliest_year = min(earliest_year, *time_periods.keys())
         latest_year = max(latest_year,*time_periods.keys())
 
-        csv_url = '%sformat=csv' % structure_url
-
-        description = more_info_url
-        if description != ' ':
-            description = '[Info on %s](%s)' % (indicator, description)
-        description = 'To save, right click download button & click Save Link/Target As  \n%s' % description
+        description = get_description(indicator, more_info_url)
 
-        df = None
-        for start_year, end_year in chunk_years(time_periods):
-            if merge_resources:
-                df1 = download_df(downloader, csv_url, start_year, end_year)
-                if df1 is not None:
-                    df = df1 if df is None else df.append(df1)
-            else:
+        if not merge_resources:
+            for start_year, end_year in periods:
                 url_years = '&startPeriod=%d&endPeriod=%d' % (start_year, end_year)
                 resource = {
                     'name': '%s (%d-%d)' % (indicator, start_year, end_year),
                     'description': description,
                     'format': 'csv',
-                    'url': downloader.get_full_url('%s%s' % (csv_url, url_years))
+                    'url': downloader.get_full_url('%s%s' % (get_data_url(structure_url, [countryiso2]), url_years))
                 }
                 dataset.add_update_resource(resource)
 
         if df is not None:
-            stat = {x["id"]: x["name"] for d in dimensions if d["id"] == "STAT_UNIT" for x in d["values"]}
-            for value, df_part in split_df_by_column(process_df(df), split_to_resources_by_column):
-                file_csv = join(folder,
-                                ("UNESCO_%s_%s.csv" % (countryiso3, endpoint + ("" if value is None else "_"+value))
-                                 ).replace(" ", "-").replace(":", "-").replace("/","-").replace(",","-")
-                                .replace("(","-").replace(")","-"))
-                if remove_useless_columns:
-                    df_part = remove_useless_columns_from_df(df_part)
-                df_part["country-iso3"]=countryiso3
-                df_part.iloc[0,df_part.columns.get_loc("country-iso3")]="#country+iso3"
-                df_part["Indicator name"]=value
-                df_part.iloc[0,df_part.columns.get_loc("Indicator name")]="#indicator+name"
-                df_part = postprocess_df(df_part)
-                df_part.to_csv(file_csv, index=False)
-                description_part = stat.get(value,'Info on %s%s' % ("" if value is None else value+" in ", indicator))
-                resource = Resource({
-                    'name': value,
-                    'description': description_part
-                })
-                resource.set_file_type('csv')
-                resource.set_file_to_upload(file_csv)
-                dataset.add_update_resource(resource)
+            write_resources(dataset, folder, transform_endpoint(df, countryiso3, endpoint, indicator, dimensions,
+                                                                split_to_resources_by_column, remove_useless_columns))
 
         if not single_dataset:
             if dataset is None or len(dataset.get_resources()) == 0:
                 logger.error('No resources created for country %s, %s!' % (countryname, endpoint))
             else:
                 dataset.set_dataset_year_range(min(time_periods.keys()),max(time_periods.keys()))
+                if checkpoint is not None:
+                    checkpoint.processed(countryiso2, endpoint, dataset, showcase)
                 yield dataset, showcase
 
     if single_dataset:
@@ -548,3 +1285,118 @@ def generate_dataset_and_showcase(downloader,
         else:
             dataset.set_dataset_year_range(earliest_year, latest_year)
             yield dataset, showcase
+
+
+def create_pipeline(downloader, endpoints_metadata, folder, publish, executor=None, download_workers=1,
+                    process_workers=1, write_workers=1, publish_workers=1, queue_size=None, fetch_concurrency=1,
+                    observation_indexes=None, batched_data=None, max_chunk_memory_mb=None, stream_chunksize=None,
+                    ingest_format='csv', checkpoint=None, country_index=None):
+    """
+    Create a pipeline generating a dataset per country and endpoint (merging resources) from country data items, as
+    generate_dataset_and_showcase does one country at a time. Its stages are: planning the requests of each endpoint,
+    downloading, processing (in executor if given, such as a process pool), writing the csv files and publishing.
+    :param downloader: Downloader object
+    :param endpoints_metadata: Endpoint datastructure from UNESCO API
+    :param folder: temporary folder
+    :param publish: function taking a dataset and showcase to publish
+    :param executor: executor to process the data in (if None, it is processed in the stage's threads)
+    :param download_workers: number of endpoints downloaded at once
+    :param process_workers: number of endpoints processed at once
+    :param write_workers: number of endpoints whose csv files are written at once
+    :param publish_workers: number of datasets published at once
+    :param queue_size: maximum number of items waiting for each stage (if None, twice its number of workers)
+    :param fetch_concurrency: maximum number of period downloads in flight at once for an endpoint
+    :param observation_indexes: dictionary of endpoint -> ObservationIndex used instead of per-country structure requests
+    :param batched_data: BatchedData already downloaded for many countries at once (needs observation_indexes)
+    :param max_chunk_memory_mb: memory for downloaded chunks of data beyond which they are spilled to folder
+    :param stream_chunksize: if given, stream data responses to temporary files and parse them this many rows at a time
+    :param ingest_format: format in which to download the data: 'csv' or 'sdmx-json'
+    :param checkpoint: Checkpoint recording the data fetched and datasets generated per endpoint, from which
+    endpoints recorded in an interrupted run are resumed
+    :param country_index: CountryIndex of resolved CL_AREA entries or None to resolve each country when planning
+    :return: Pipeline to run with the country data items
+    """
+
+    def plan(countrydata):
+        country = get_country(countrydata, country_index)
+        if country is None:
+            return
+        max_observations = get_max_observations(downloader)
+        for endpoint in sorted(endpoints_metadata):
+            checkpoint_record = None if checkpoint is None else checkpoint.get(country[0], endpoint)
+            if checkpoint_record is None:
+                pace(downloader)
+                observation_index = None if observation_indexes is None else observation_indexes[endpoint]
+                yield country, plan_endpoint(downloader, country[0], endpoint, endpoints_metadata[endpoint], True,
+                                             observation_index, max_observations, ingest_format), None
+            elif checkpoint_record['stage'] != 'published':
+                yield country, (endpoint, None, None, None, list()), checkpoint_record
+
+    def download(job):
+        country, (endpoint, structure_name, data_url, time_periods, periods), checkpoint_record = job
+        indicator, _, _, dimensions = endpoints_metadata[endpoint]
+        if checkpoint_record is None:
+            accumulator = None
+            if batched_data is not None:
+                accumulator = batched_data.get_accumulator(endpoint, country[0], max_chunk_memory_mb)
+            df = download_endpoint(downloader, data_url, periods, dimensions, folder, max_chunk_memory_mb,
+                                   stream_chunksize, accumulator, fetch_concurrency)
+            if time_periods is None:  # only the number of observations was known up front
+                time_periods = dict() if df is None else get_time_periods_from_df(df)
+            if checkpoint is not None:
+                checkpoint.fetched(country[0], endpoint, structure_name, time_periods, df)
+        elif checkpoint_record['stage'] == 'processed':  # passed on to the write stage which loads the dataset
+            yield country, endpoint, None, None, checkpoint_record
+            return
+        else:
+            structure_name, time_periods, df = checkpoint.load_fetched(checkpoint_record)
+        if not time_periods:
+            logger.warning('No time periods for endpoint %s for country %s!' % (indicator, country[1]))
+            return
+        yield country, endpoint, structure_name, time_periods, df
+
+    def process(job):
+        country, endpoint, structure_name, time_periods, df = job
+        if structure_name is None:
+            yield job
+            return
+        parts = list()
+        if df is not None:
+            indicator, _, _, dimensions = endpoints_metadata[endpoint]
+            if executor is None:
+                parts = transform_endpoint(df, country[2], endpoint, indicator, dimensions)
+            else:
+                parts, snapshot = executor.submit(collect, transform_endpoint, df, country[2], endpoint, indicator,
+                                                  dimensions).result()
+                merge(snapshot)
+        yield country, endpoint, structure_name, time_periods, parts
+
+    def write(job):
+        (countryiso2, countryname, countryiso3), endpoint, structure_name, time_periods, parts = job
+        if structure_name is None:
+            yield checkpoint.load_processed(parts)
+            return
+        name = 'UNESCO %s - %s' % (structure_name, countryname)
+        dataset, showcase = create_dataset_showcase(name, countryname, countryiso2, countryiso3)
+        if dataset is None:
+            return
+        write_resources(dataset, folder, parts)
+        if len(dataset.get_resources()) == 0:
+            logger.error('No resources created for country %s, %s!' % (countryname, endpoint))
+            return
+        dataset.set_dataset_year_range(min(time_periods.keys()), max(time_periods.keys()))
+        if checkpoint is not None:
+            checkpoint.processed(countryiso2, endpoint, dataset, showcase)
+        yield dataset, showcase
+
+    def publish_dataset(job):
+        publish(*job)
+        return list()
+
+    pipeline = Pipeline()
+    pipeline.add_stage('plan', plan, queue_size=queue_size)
+    pipeline.add_stage('download', download, workers=download_workers, queue_size=queue_size)
+    pipeline.add_stage('process', process, workers=process_workers, queue_size=queue_size)
+    pipeline.add_stage('write', write, workers=write_workers, queue_size=queue_size)
+    pipeline.add_stage('publish', publish_dataset, workers=publish_workers, queue_size=queue_size)
+    return pipeline